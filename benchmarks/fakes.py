@@ -0,0 +1,225 @@
+import asyncio
+import hashlib
+import random
+import time
+from typing import Any, AsyncIterator, List, Optional
+import numpy as np
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+class Latency:
+    """
+    Log-normal latency distribution given by its median (ms) and sigma; sigma=0 is a
+    constant delay. Long right tails like this are what hosted APIs actually show.
+    """
+    def __init__(self, median_ms: float, sigma: float = 0.3, rng: random.Random = None):
+        self.median_ms = median_ms
+        self.sigma = sigma
+        self.rng = rng or random.Random()
+
+    def sample(self) -> float:
+        """Seconds."""
+        if self.median_ms <= 0:
+            return 0.0
+        if self.sigma <= 0:
+            return self.median_ms / 1000
+        return self.rng.lognormvariate(0, self.sigma) * self.median_ms / 1000
+
+
+def fake_vector(text: str, dim: int) -> list:
+    """Deterministic pseudo-embedding, so equal texts get equal vectors."""
+    seed = int(hashlib.md5(text.encode("utf-8")).hexdigest()[:8], 16)
+    return np.random.default_rng(seed).standard_normal(dim).astype(np.float32).tolist()
+
+
+class FakeChatModel(BaseChatModel):
+    """
+    Stand-in for Gemini. Recognizes the pipeline's prompts by their wording: judge prompts
+    are rejected with probability `reject_rate`, everything else gets an answer of
+    `answer_tokens` words streamed at `token_ms` per token after the call latency.
+    """
+    latency: Any
+    token_ms: float = 0.0
+    answer_tokens: int = 150
+    reject_rate: float = 0.0
+    rng: Any = None
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-benchmark"
+
+    def _reply(self, prompt: str) -> str:
+        if "SATISFACTORY" in prompt:
+            # Judge, light judge or comparative judge
+            if self.rng.random() < self.reject_rate:
+                return "Best: 1\nStatus: UNSATISFACTORY\nFeedback: The answer misses the key details."
+            return "Best: 1\nStatus: SATISFACTORY\nFeedback:"
+        if "rewritten query" in prompt or "search query improver" in prompt:
+            return f"standalone search query {self.rng.randrange(1000)}"
+        if "search queries that could" in prompt:
+            return "\n".join(f"alternative query {self.rng.randrange(1000)}" for _ in range(4))
+        return " ".join(f"word{i}" for i in range(self.answer_tokens))
+
+    @staticmethod
+    def _prompt_text(messages: List[BaseMessage]) -> str:
+        return "\n".join(str(m.content) for m in messages)
+
+    def _result(self, prompt: str, text: str) -> ChatResult:
+        usage = {"input_tokens": len(prompt) // 4, "output_tokens": len(text.split()), "total_tokens": len(prompt) // 4 + len(text.split())}
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=text, usage_metadata=usage))])
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs) -> ChatResult:
+        prompt = self._prompt_text(messages)
+        text = self._reply(prompt)
+        time.sleep(self.latency.sample() + self.token_ms * len(text.split()) / 1000)
+        return self._result(prompt, text)
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager: Optional[AsyncCallbackManagerForLLMRun] = None, **kwargs) -> ChatResult:
+        prompt = self._prompt_text(messages)
+        text = self._reply(prompt)
+        await asyncio.sleep(self.latency.sample() + self.token_ms * len(text.split()) / 1000)
+        return self._result(prompt, text)
+
+    async def _astream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager: Optional[AsyncCallbackManagerForLLMRun] = None, **kwargs) -> AsyncIterator[ChatGenerationChunk]:
+        prompt = self._prompt_text(messages)
+        await asyncio.sleep(self.latency.sample())
+        words = self._reply(prompt).split()
+        started = time.perf_counter()
+        for i, word in enumerate(words):
+            # Pace against the clock rather than sleeping per token, sleep overhead would add up
+            ahead = started + (i + 1) * self.token_ms / 1000 - time.perf_counter()
+            if ahead > 0.001:
+                await asyncio.sleep(ahead)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=word if i == 0 else " " + word))
+
+
+class FakeInference:
+    """Pinecone Inference stand-in (`pc.inference.embed`), sync flavour."""
+    def __init__(self, latency: Latency, dim: int):
+        self.latency = latency
+        self.dim = dim
+        self.calls = 0
+
+    def _embed(self, inputs):
+        self.calls += 1
+        return [{"values": fake_vector(text, self.dim)} for text in inputs]
+
+    def embed(self, model, inputs, parameters=None):
+        time.sleep(self.latency.sample())
+        return self._embed(inputs)
+
+class AsyncFakeInference(FakeInference):
+    async def embed(self, model, inputs, parameters=None):
+        await asyncio.sleep(self.latency.sample())
+        return self._embed(inputs)
+
+
+class FakeIndex:
+    """Pinecone index stand-in: exact cosine search over a random corpus of `size` chunks."""
+    def __init__(self, latency: Latency, dim: int, size: int = 2000, seed: int = 0):
+        self.latency = latency
+        rng = np.random.default_rng(seed)
+        vectors = rng.standard_normal((size, dim)).astype(np.float32)
+        self.vectors = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+        self.records = [
+            (f"doc{i // 20}.pdf_chunk_{i % 20}", {"text": f"Synthetic passage {i} about topic {i % 37}. " * 20, "source": f"doc{i // 20}.pdf", "chunk_index": i % 20})
+            for i in range(size)
+        ]
+
+    def _search(self, vector, top_k):
+        v = np.asarray(vector, dtype=np.float32)
+        v /= np.linalg.norm(v) or 1.0
+        scores = self.vectors @ v
+        top = np.argsort(-scores)[:top_k]
+        return {"matches": [{"id": self.records[i][0], "score": float(scores[i]), "metadata": dict(self.records[i][1])} for i in top]}
+
+    def query(self, vector, top_k, namespace=None, include_values=False, include_metadata=True, filter=None):
+        time.sleep(self.latency.sample())
+        return self._search(vector, top_k)
+
+    def describe_index_stats(self):
+        # The whole corpus lives in the default namespace
+        return {"namespaces": {"default": {"vector_count": len(self.records)}}}
+
+class AsyncFakeIndex(FakeIndex):
+    def __init__(self, sync_index: FakeIndex):
+        self.latency = sync_index.latency
+        self.vectors = sync_index.vectors
+        self.records = sync_index.records
+
+    async def query(self, vector, top_k, namespace=None, include_values=False, include_metadata=True, filter=None):
+        await asyncio.sleep(self.latency.sample())
+        return self._search(vector, top_k)
+
+    async def describe_index_stats(self):
+        return FakeIndex.describe_index_stats(self)
+
+
+class _InsertResult:
+    def __init__(self, inserted_id):
+        self.inserted_id = inserted_id
+
+class FakeCollection:
+    """MongoDB collection stand-in covering the calls main.py makes."""
+    def __init__(self, latency: Latency):
+        self.latency = latency
+        self.documents = []
+
+    def insert_one(self, document):
+        time.sleep(self.latency.sample())
+        document.setdefault("_id", f"fake{len(self.documents)}")
+        self.documents.append(document)
+        return _InsertResult(document["_id"])
+
+    def insert_many(self, documents, ordered=True):
+        time.sleep(self.latency.sample())
+        self.documents.extend(documents)
+
+    def update_one(self, filter, update, upsert=False):
+        time.sleep(self.latency.sample())
+
+    def find_one(self, filter, projection=None):
+        time.sleep(self.latency.sample())
+        return None
+
+    def find_one_and_update(self, filter, update, projection=None):
+        time.sleep(self.latency.sample())
+        return None
+
+
+def install(rag_chain_module, main_module=None, llm_latency: Latency = None, token_ms: float = 0.0, answer_tokens: int = 150,
+            reject_rate: float = 0.0, embed_latency: Latency = None, index_latency: Latency = None, mongo_latency: Latency = None,
+            dim: int = 64, corpus_size: int = 2000, seed: int = 0) -> dict:
+    """
+    Swaps the Gemini, Pinecone and MongoDB clients used by `rag_chain` (and `main`) for
+    the fakes above. Returns the installed fakes.
+    """
+    rng = random.Random(seed)
+    llm = FakeChatModel(latency=llm_latency or Latency(0), token_ms=token_ms, answer_tokens=answer_tokens, reject_rate=reject_rate, rng=rng)
+    inference = FakeInference(embed_latency or Latency(0), dim)
+    async_inference = AsyncFakeInference(inference.latency, dim)
+    index = FakeIndex(index_latency or Latency(0), dim, corpus_size, seed)
+    async_index = AsyncFakeIndex(index)
+
+    class _Client:
+        pass
+    client, async_client = _Client(), _Client()
+    client.inference, async_client.inference = inference, async_inference
+
+    async def get_async_pinecone():
+        return async_client, async_index
+
+    rag_chain_module.pc = client
+    rag_chain_module._get_index = lambda: index
+    rag_chain_module._get_async_pinecone = get_async_pinecone
+    rag_chain_module.rag_chain.llm = llm
+    fakes = {"llm": llm, "inference": inference, "index": index}
+    if main_module is not None:
+        collection = FakeCollection(mongo_latency or Latency(0))
+        main_module.interactions = collection
+        main_module.interaction_writer.collection = collection
+        main_module.session_store.collection = FakeCollection(mongo_latency or Latency(0))
+        fakes["interactions"] = collection
+    return fakes
@@ -0,0 +1,326 @@
+"""
+Offline latency / throughput benchmark of the RAG pipeline.
+
+Gemini, Pinecone and MongoDB are replaced by the in-process fakes in benchmarks/fakes.py,
+with configurable latency distributions and judge rejection rate, so runs are
+reproducible on a laptop or in CI. From the project root:
+
+    python -m benchmarks.run_benchmark --targets invoke rag ws --requests 200 --concurrency 16
+
+Results (p50/p95/p99 latency, throughput, stage breakdown) are written as JSON; pass
+--baseline with an earlier result file to print the differences.
+
+The time to `import main` in a fresh interpreter (what a cold start pays before serving)
+is measured too, and the run exits with status 1 if it is over --import-budget.
+"""
+import os
+import sys
+import statistics
+import json
+import time
+import socket
+import random
+import asyncio
+import argparse
+import threading
+import subprocess
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+
+# The real clients are never used, but their constructors want these set
+os.environ.setdefault("GOOGLE_API_KEY", "benchmark")
+os.environ.setdefault("PINECONE_API_KEY", "benchmark")
+os.environ.setdefault("MONGO_URI", "mongodb://localhost:27017")
+
+import numpy as np
+from benchmarks.fakes import Latency, install
+
+TOPICS = ["gradient descent", "convolutional networks", "attention", "dynamic programming", "graph traversal",
+          "thermodynamics", "eigenvalues", "regularization", "transformers", "hash tables"]
+
+def make_requests(n: int, history_rate: float, rng: random.Random, duplicate_rate: float = 0.0, window: int = 8) -> list:
+    """
+    Distinct questions; a `history_rate` share are follow-ups with a chat history, and a
+    `duplicate_rate` share repeat one of the previous `window` requests (students asking
+    the same thing at the same time).
+    """
+    requests = []
+    for i in range(n):
+        if requests and rng.random() < duplicate_rate:
+            requests.append(requests[rng.randrange(max(0, i - window), i)])
+            continue
+        topic = TOPICS[i % len(TOPICS)]
+        query = f"Question {i}: explain {topic} as covered in the course notes"
+        history = []
+        if rng.random() < history_rate:
+            history = [{"role": "user", "content": f"Tell me about {topic}"}, {"role": "assistant", "content": f"{topic} is a core topic."}]
+            query = f"Question {i}: and how is it used in practice?"
+        requests.append((query, history))
+    return requests
+
+def summarize(latencies: list, errors: int, wall_seconds: float, extra: dict = None) -> dict:
+    values = np.asarray(latencies) * 1000
+    result = {
+        "requests": len(latencies) + errors,
+        "errors": errors,
+        "wall_s": round(wall_seconds, 3),
+        "throughput_rps": round(len(latencies) / wall_seconds, 2) if wall_seconds else 0.0,
+    }
+    if len(values):
+        result.update({
+            "mean_ms": round(float(values.mean()), 1),
+            "p50_ms": round(float(np.percentile(values, 50)), 1),
+            "p95_ms": round(float(np.percentile(values, 95)), 1),
+            "p99_ms": round(float(np.percentile(values, 99)), 1),
+            "max_ms": round(float(values.max()), 1),
+        })
+    result.update(extra or {})
+    return result
+
+def stage_breakdown(timings: list) -> dict:
+    """Mean per-stage time over per-request timing breakdowns."""
+    totals, counts = {}, {}
+    for timing in timings:
+        for stage, ms in (timing or {}).get("stages_ms", {}).items():
+            totals[stage] = totals.get(stage, 0.0) + ms
+            counts[stage] = counts.get(stage, 0) + 1
+    return {stage: round(totals[stage] / counts[stage], 1) for stage in totals}
+
+# -- targets -----------------------------------------------------------------
+
+def bench_invoke(rag_chain, requests: list, concurrency: int, bypass_cache: bool, deadline_ms: int = None) -> dict:
+    """RAGChain.invoke (the sync API) from `concurrency` threads."""
+    def one(request):
+        started = time.perf_counter()
+        answer = rag_chain.invoke(request[0], request[1], bypass_cache=bypass_cache, deadline=deadline_ms / 1000 if deadline_ms else None)
+        return time.perf_counter() - started, answer.response_metadata.get("rag", {}).get("timings")
+
+    latencies, timings, errors = [], [], 0
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for future in [pool.submit(one, request) for request in requests]:
+            try:
+                latency, timing = future.result()
+                latencies.append(latency)
+                timings.append(timing)
+            except Exception as e:
+                print(f"invoke error: {e}")
+                errors += 1
+    return summarize(latencies, errors, time.perf_counter() - started, {"stages_mean_ms": stage_breakdown(timings)})
+
+async def _run_clients(requests: list, concurrency: int, one) -> tuple:
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, extras, errors = [], [], 0
+
+    async def guarded(request):
+        nonlocal errors
+        async with semaphore:
+            try:
+                latency, extra = await one(request)
+                latencies.append(latency)
+                extras.append(extra)
+            except Exception as e:
+                print(f"request error: {e}")
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(guarded(request) for request in requests))
+    return latencies, extras, errors, time.perf_counter() - started
+
+def bench_rag(base_url: str, requests: list, concurrency: int, bypass_cache: bool, deadline_ms: int = None) -> dict:
+    import httpx
+
+    async def main():
+        async with httpx.AsyncClient(base_url=base_url, timeout=300, limits=httpx.Limits(max_connections=concurrency)) as client:
+            async def one(request):
+                started = time.perf_counter()
+                response = await client.post("/rag", json={"query": request[0], "history": request[1], "bypass_cache": bypass_cache, "deadline_ms": deadline_ms})
+                response.raise_for_status()
+                return time.perf_counter() - started, None
+            return await _run_clients(requests, concurrency, one)
+
+    latencies, _, errors, wall = asyncio.run(main())
+    return summarize(latencies, errors, wall)
+
+def bench_ws(ws_url: str, requests: list, concurrency: int, bypass_cache: bool, deadline_ms: int = None) -> dict:
+    """One websocket per concurrent client; also measures time to first answer token."""
+    import websockets
+
+    async def main():
+        async def one(request):
+            started = time.perf_counter()
+            first_token = None
+            async with websockets.connect(ws_url, max_size=None) as ws:
+                await ws.send(json.dumps({"query": request[0], "history": request[1], "bypass_cache": bypass_cache, "deadline_ms": deadline_ms}))
+                while True:
+                    frame = await ws.recv()
+                    if frame == "<<END>>":
+                        break
+                    if first_token is None and not frame.startswith("<<"):
+                        first_token = time.perf_counter() - started
+            return time.perf_counter() - started, first_token
+        return await _run_clients(requests, concurrency, one)
+
+    latencies, first_tokens, errors, wall = asyncio.run(main())
+    first_tokens = np.asarray([t for t in first_tokens if t is not None]) * 1000
+    extra = {}
+    if len(first_tokens):
+        extra = {"ttft_p50_ms": round(float(np.percentile(first_tokens, 50)), 1), "ttft_p95_ms": round(float(np.percentile(first_tokens, 95)), 1)}
+    return summarize(latencies, errors, wall, extra)
+
+def measure_import(module: str, runs: int) -> list:
+    """Seconds to import `module` in `runs` fresh interpreters."""
+    code = f"import time; started = time.perf_counter(); import {module}; print(time.perf_counter() - started)"
+    return [float(subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True).stdout.strip().splitlines()[-1]) for _ in range(runs)]
+
+# -- server ------------------------------------------------------------------
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def start_server(app):
+    """Runs the FastAPI app with uvicorn in a background thread, like production does."""
+    import uvicorn
+    port = _free_port()
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning", ws_max_size=16 * 1024 * 1024))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    return server, thread, port
+
+def wait_ready(base_url: str, timeout: float = 60.0) -> float:
+    """Seconds until /readyz reports the startup warmup done, or None on timeout."""
+    import httpx
+    started = time.perf_counter()
+    while time.perf_counter() - started < timeout:
+        if httpx.get(f"{base_url}/readyz").status_code == 200:
+            return time.perf_counter() - started
+        time.sleep(0.02)
+    return None
+
+# -- reporting ---------------------------------------------------------------
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+def print_comparison(results: dict, baseline: dict):
+    print("\nChange vs baseline:")
+    for target, current in results.items():
+        previous = baseline.get("results", {}).get(target)
+        if not previous:
+            continue
+        parts = []
+        for key in ("p50_ms", "p95_ms", "p99_ms", "throughput_rps"):
+            if key in current and previous.get(key):
+                parts.append(f"{key} {previous[key]} -> {current[key]} ({(current[key] - previous[key]) / previous[key] * 100:+.1f}%)")
+        print(f"  {target}: " + ", ".join(parts))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the RAG pipeline against local stand-ins for Gemini, Pinecone and MongoDB.")
+    parser.add_argument("--targets", nargs="+", choices=["invoke", "rag", "ws"], default=["invoke", "rag", "ws"])
+    parser.add_argument("--requests", type=int, default=100, help="Requests per target")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--llm-ms", type=float, default=400, help="Median LLM call latency (time to first token)")
+    parser.add_argument("--llm-sigma", type=float, default=0.35, help="Log-normal sigma of the LLM latency")
+    parser.add_argument("--token-ms", type=float, default=2, help="Per generated token delay")
+    parser.add_argument("--answer-tokens", type=int, default=150)
+    parser.add_argument("--reject-rate", type=float, default=0.2, help="Probability the judge rejects an answer")
+    parser.add_argument("--embed-ms", type=float, default=40)
+    parser.add_argument("--index-ms", type=float, default=30)
+    parser.add_argument("--mongo-ms", type=float, default=5)
+    parser.add_argument("--io-sigma", type=float, default=0.3, help="Log-normal sigma of embed / index / Mongo latency")
+    parser.add_argument("--history-rate", type=float, default=0.3, help="Share of follow-up requests with chat history")
+    parser.add_argument("--duplicate-rate", type=float, default=0.0, help="Share of requests repeating a recent one, to exercise request coalescing")
+    parser.add_argument("--deadline-ms", type=int, default=None, help="Per-request latency budget passed to the pipeline")
+    parser.add_argument("--use-cache", action="store_true", help="Let requests hit the semantic answer cache")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--import-budget", type=float, default=1.5, help="Max median seconds to import main (0 = not enforced)")
+    parser.add_argument("--import-runs", type=int, default=3)
+    parser.add_argument("--output", default=None, help="Result JSON path (default: benchmarks/results/<timestamp>.json)")
+    parser.add_argument("--baseline", default=None, help="Earlier result JSON to compare against")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    import_times = measure_import("main", args.import_runs)
+    cold_start = {"import_main_s": round(statistics.median(import_times), 3), "import_budget_s": args.import_budget}
+    print(f"import main: {cold_start['import_main_s']}s median of {args.import_runs} (budget {args.import_budget or 'off'})")
+
+    import rag_chain as rag_chain_module
+    import main as main_module
+    fakes = install(
+        rag_chain_module, main_module,
+        llm_latency=Latency(args.llm_ms, args.llm_sigma, rng),
+        token_ms=args.token_ms,
+        answer_tokens=args.answer_tokens,
+        reject_rate=args.reject_rate,
+        embed_latency=Latency(args.embed_ms, args.io_sigma, rng),
+        index_latency=Latency(args.index_ms, args.io_sigma, rng),
+        mongo_latency=Latency(args.mongo_ms, args.io_sigma, rng),
+        seed=args.seed,
+    )
+    bypass_cache = not args.use_cache
+    rag_chain = rag_chain_module.rag_chain
+
+    server = None
+    if {"rag", "ws"} & set(args.targets):
+        server, thread, port = start_server(main_module.app)
+        ready = wait_ready(f"http://127.0.0.1:{port}")
+        cold_start["ready_s"] = round(ready, 3) if ready is not None else None
+        print(f"ready after {cold_start['ready_s']}s: {main_module.readiness['components']}")
+
+    results = {}
+    for target in args.targets:
+        requests = make_requests(args.requests, args.history_rate, rng, args.duplicate_rate, args.concurrency)
+        coalesced_before = rag_chain.coalescer.stats() if rag_chain.coalescer else None
+        documents_before = len(fakes["interactions"].documents)
+        print(f"Running {target}: {args.requests} requests, concurrency {args.concurrency}...")
+        if target == "invoke":
+            results[target] = bench_invoke(rag_chain, requests, args.concurrency, bypass_cache, args.deadline_ms)
+        elif target == "rag":
+            results[target] = bench_rag(f"http://127.0.0.1:{port}", requests, args.concurrency, bypass_cache, args.deadline_ms)
+        else:
+            results[target] = bench_ws(f"ws://127.0.0.1:{port}/ws/stream", requests, args.concurrency, bypass_cache, args.deadline_ms)
+        if target != "invoke":
+            # The API stores each request's timing breakdown on its interaction document
+            main_module.interaction_writer.flush()
+            documents = fakes["interactions"].documents[documents_before:]
+            results[target]["stages_mean_ms"] = stage_breakdown([doc.get("timings") for doc in documents])
+        if coalesced_before is not None:
+            stats = rag_chain.coalescer.stats()
+            leaders, followers = stats["leaders"] - coalesced_before["leaders"], stats["followers"] - coalesced_before["followers"]
+            results[target]["coalescing"] = {"runs": leaders, "coalesced": followers, "ratio": round(followers / (leaders + followers), 3) if leaders + followers else 0.0}
+        print(json.dumps(results[target], indent=2))
+
+    if server is not None:
+        server.should_exit = True
+        thread.join(timeout=10)
+
+    report = {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "commit": _git_commit(),
+        "config": vars(args),
+        "cold_start": cold_start,
+        "results": results,
+    }
+    output = args.output or os.path.join("benchmarks", "results", datetime.now().strftime("%Y%m%d-%H%M%S") + ".json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            print_comparison(results, json.load(f))
+
+    if args.import_budget and cold_start["import_main_s"] > args.import_budget:
+        print(f"FAIL: importing main took {cold_start['import_main_s']}s, over the {args.import_budget}s budget")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
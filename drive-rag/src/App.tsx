@@ -31,6 +31,13 @@ function App() {
     sessionStorage.setItem('chat_history', JSON.stringify(messages));
   }, [messages]);
 
+  // Server-side conversation id; the history lives on the server once it is set
+  const [sessionId, setSessionId] = useState<string>(() => sessionStorage.getItem('session_id') || '');
+
+  useEffect(() => {
+    sessionStorage.setItem('session_id', sessionId);
+  }, [sessionId]);
+
   const [isStreaming, setIsStreaming] = useState<boolean>(false);
   const [currentResponse, setCurrentResponse] = useState<string>('');
   const [sidebarOpen, setSidebarOpen] = useState<boolean>(true);
@@ -76,6 +83,7 @@ function App() {
 
   const handleNewChat = () => {
     setMessages([]);
+    setSessionId('');
     setQuery('');
     setCurrentResponse('');
   };
@@ -218,18 +226,47 @@ function App() {
     // Websocket On Open Action
     websocket.onopen = () => {
       console.log("Websocket connection established.");
-      websocket.send(JSON.stringify({ query: userMessage, history: messages }))
+      // Without a session yet, the local history seeds a new one
+      websocket.send(JSON.stringify(sessionId ? { query: userMessage, session_id: sessionId } : { query: userMessage, history: messages }))
     };
 
     // ON MESSAGE HANDLER
     websocket.onmessage = (event) => {
       const data = event.data;
 
+      if (data.startsWith('<<SID:')) {
+        setSessionId(data.replace('<<SID:', '').replace('>>', ''));
+        return;
+      }
+
+      // The server is overloaded; the partial answer (if any) is dropped
+      if (data.startsWith('<<E:BUSY:')) {
+        const seconds = data.replace('<<E:BUSY:', '').replace('>>', '');
+        accumulatedResponse = `The assistant is busy right now, please try again in ${seconds} seconds.`;
+        return;
+      }
+
+      // The query failed on the server; <<END>> follows
+      if (data == '<<E:ERROR>>') {
+        accumulatedResponse = 'Something went wrong while answering, please try again.';
+        return;
+      }
+
       if (data.startsWith('<<ID:')) {
         currentInteractionId = data.replace('<<ID:', '').replace('>>', '');
         return;
       }
 
+      // Pipeline progress events; a retracted draft was rejected by the judge
+      if (data.startsWith('<<EV:')) {
+        const ev = JSON.parse(data.slice('<<EV:'.length, -'>>'.length));
+        if (ev.type === 'retracted') {
+          accumulatedResponse = '';
+          setCurrentResponse('');
+        }
+        return;
+      }
+
       if (data == '<<END>>') {
         // Add the complete response to messages before closing
         if (accumulatedResponse) {
@@ -1,24 +1,97 @@
 from fastapi import FastAPI, HTTPException, status, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import RedirectResponse
+from fastapi.responses import RedirectResponse, Response, JSONResponse
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
 import base64
 #from rag_chain import text_splitter, vector_store
-from rag_chain import rag_chain
+from rag_chain import rag_chain, answer_cache, warmup, llm_scheduler, aclose_clients
 import io
-from pypdf import PdfReader
+from utils.tracing import start_trace, span, REQUEST_SECONDS, REQUESTS, CANCELLED
+from utils.interaction_writer import InteractionWriter
+from utils.llm_scheduler import SchedulerFull, set_priority, INTERACTIVE, STANDARD
+from utils.sessions import SessionStore
+from typing import List, Optional
+from contextlib import asynccontextmanager
+import asyncio
+import threading
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
 import os
 from pymongo import MongoClient
 from datetime import datetime
 from bson import ObjectId
+import json
 
-# Initialize MongoDB
+# Initialize MongoDB. The client is created on first use (or by the startup warmup):
+# with a mongodb+srv URI its constructor does DNS lookups, which would slow every cold start.
 MONGO_URI = os.getenv("MONGO_URI")
-mongo_client = MongoClient(MONGO_URI)
-db = mongo_client["rag_db"]
-interactions = db["interactions"]
+_mongo_client = None
+_mongo_lock = threading.Lock()
 
-app = FastAPI()
+def get_mongo_client() -> MongoClient:
+    global _mongo_client
+    with _mongo_lock:
+        if _mongo_client is None:
+            _mongo_client = MongoClient(MONGO_URI)
+    return _mongo_client
+
+class _LazyCollection:
+    """Stands in for db[name] and resolves it on first use."""
+    def __init__(self, name: str):
+        self.name = name
+
+    def __getattr__(self, attr):
+        return getattr(get_mongo_client()["rag_db"][self.name], attr)
+
+interactions = _LazyCollection("interactions")
+sessions = _LazyCollection("sessions")
+
+# Conversations are stored once per session; interactions reference their turn
+session_store = SessionStore(sessions, capacity=int(os.getenv("SESSION_CACHE_SIZE", "1024")))
+
+# Interactions are written to Mongo in the background, in batches
+interaction_writer = InteractionWriter(
+    interactions,
+    max_queue=int(os.getenv("INTERACTION_QUEUE_SIZE", "10000")),
+    batch_size=int(os.getenv("INTERACTION_BATCH_SIZE", "100")),
+    flush_interval=float(os.getenv("INTERACTION_FLUSH_INTERVAL", "0.5")),
+    overflow=os.getenv("INTERACTION_OVERFLOW", "drop"),
+    spill_path=os.getenv("INTERACTION_SPILL_PATH", "interaction_spill.jsonl"),
+)
+
+# Startup warmup: connects Mongo, creates the Gemini client and embeds and searches a canary
+# query, in the background so the server starts accepting connections right away.
+# /readyz reports 503 until it has succeeded.
+WARMUP_ENABLED = os.getenv("WARMUP_ENABLED", "1") == "1"
+readiness = {"ready": not WARMUP_ENABLED, "components": {}}
+
+async def warmup_components():
+    components = {}
+    try:
+        with span("warmup_mongo"):
+            await run_in_threadpool(interactions.find_one, {}, projection={"_id": 1})
+        components["mongo"] = "ok"
+    except Exception as e:
+        print(f"Warmup of mongo failed: {e}")
+        components["mongo"] = f"error: {e}"
+    components.update(await warmup())
+    readiness["components"] = components
+    readiness["ready"] = all(state == "ok" for state in components.values())
+    print(f"Warmup finished: {components}")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    interaction_writer.start()
+    warmup_task = asyncio.create_task(warmup_components()) if WARMUP_ENABLED else None
+    yield
+    if warmup_task is not None:
+        warmup_task.cancel()
+    # Flush whatever is still queued before the process exits
+    await run_in_threadpool(interaction_writer.close)
+    await run_in_threadpool(session_store.close)
+    await aclose_clients()
+
+app = FastAPI(lifespan=lifespan)
 
 # CORS middleware for frontend
 app.add_middleware(
@@ -29,6 +102,15 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.exception_handler(SchedulerFull)
+async def scheduler_full_handler(request, exc: SchedulerFull):
+    # Overloaded: refuse quickly and tell the client when to come back instead of queueing
+    return JSONResponse(
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        content={"detail": str(exc)},
+        headers={"Retry-After": str(exc.retry_after)},
+    )
+
 # Dummy admin credentials
 ADMIN_USERNAME = "admin"
 ADMIN_PASSWORD = "admin123"
@@ -37,6 +119,23 @@ ADMIN_PASSWORD = "admin123"
 def root():
     return RedirectResponse('/docs')
 
+@app.get('/healthz', tags=["General"])
+def healthz():
+    # Liveness: the process is up and serving
+    return {"status": "ok"}
+
+@app.get('/readyz', tags=["General"])
+def readyz(response: Response):
+    # Readiness: warmup has connected every backend
+    if not readiness["ready"]:
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    return {"ready": readiness["ready"], "components": readiness["components"]}
+
+@app.get('/metrics', tags=["General"])
+def metrics():
+    # Prometheus scrape endpoint: per-stage latency histograms, token and retry counters
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
 # Auth Models and Endpoint
 class LoginRequest(BaseModel):
     username: str
@@ -69,16 +168,10 @@ def upload_file(request:FileRequest):
         
         if request.filename.lower().endswith('.pdf'):
             pdf_file = io.BytesIO(decoded_bytes)
-            reader = PdfReader(pdf_file)
-            
-            # Extract text from all pages
-            text_content = []
-            for page in reader.pages:
-                text = page.extract_text()
-                if text:
-                    text_content.append(text)
             
-            file_str = "\n".join(text_content)
+            # Extract text page by page (same extractor as upload_to_pinecone.py)
+            from utils.pdfreader import iter_pdf_pages
+            file_str = "\n".join(text for _, text in iter_pdf_pages(pdf_file) if text)
         else:
             # Default to text file handling
             file_str = decoded_bytes.decode("utf-8")
@@ -110,57 +203,154 @@ def upload_file(request:FileRequest):
         'uploaded_ids' : ids
     }
 '''
-class SearchRequest(BaseModel):
-    search_str : str
-    n: int = 2
+# One request is embedded with a single inference call, which takes up to 96 inputs
+VECTOR_SEARCH_MAX_BATCH = int(os.getenv("VECTOR_SEARCH_MAX_BATCH", "96"))
+VECTOR_SEARCH_MAX_K = int(os.getenv("VECTOR_SEARCH_MAX_K", "100"))
+
+class VectorQuery(BaseModel):
+    query: str
+    k: int = 5
+    filter: Optional[dict] = None  # Pinecone metadata filter, e.g. {"source": "thermo/lecture1.pdf"}
+    min_score: Optional[float] = None  # drop matches with a lower similarity
+    collections: Optional[List[str]] = None  # collections to search, default: DEFAULT_COLLECTIONS
+
+class VectorSearchRequest(BaseModel):
+    queries: List[VectorQuery]
+    include_text: bool = False
+    include_metadata: bool = False
+
+async def _unknown_collections(collections: Optional[List[str]]) -> List[str]:
+    try:
+        return await rag_chain.retriever.aunknown_collections(collections)
+    except Exception as e:
+        raise HTTPException(status_code=status.HTTP_502_BAD_GATEWAY, detail=f"Vector store error: {e}")
+
+@app.get('/collections',tags=["VectorDB"])
+async def list_collections():
+    """Collections (index namespaces) that requests can scope retrieval to."""
+    try:
+        collections = await rag_chain.retriever.alist_collections()
+    except Exception as e:
+        raise HTTPException(status_code=status.HTTP_502_BAD_GATEWAY, detail=f"Vector store error: {e}")
+    return {'collections': collections, 'default': rag_chain.retriever.collections}
 
 @app.post('/vector_search',tags=["VectorDB"])
-def similarity_search(request:SearchRequest):
+async def vector_search(request:VectorSearchRequest):
+    """
+    Retrieval only, no LLM calls: dense search for a batch of queries, one result list
+    per query in request order. Meant for tooling and evaluation scripts.
+    """
+    if not request.queries:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="No queries given")
+    if len(request.queries) > VECTOR_SEARCH_MAX_BATCH:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"At most {VECTOR_SEARCH_MAX_BATCH} queries per request")
+    if any(not 1 <= q.k <= VECTOR_SEARCH_MAX_K for q in request.queries):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"k must be between 1 and {VECTOR_SEARCH_MAX_K}")
+    unknown = await _unknown_collections([c for q in request.queries for c in q.collections or []])
+    if unknown:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Unknown collections: {', '.join(unknown)}")
+
+    trace = start_trace()
     try:
-        results = vector_store.similarity_search(
-            request.search_str,
-            k = request.n
+        result_lists = await rag_chain.retriever.asearch(
+            [q.query for q in request.queries],
+            [q.k for q in request.queries],
+            [q.filter for q in request.queries],
+            [q.collections for q in request.queries],
         )
-
-        return{
-            'status' : status.HTTP_200_OK,
-            'results' : results
-        }
     except Exception as e:
+        # Bad filters come back as ValueError (local index) or HTTP 400 (Pinecone)
+        bad_request = isinstance(e, ValueError) or getattr(e, "status", None) == 400
         raise HTTPException(
-            status_code = status.HTTP_400_BAD_REQUEST,
-            detail = f"{e}"
+            status_code=status.HTTP_400_BAD_REQUEST if bad_request else status.HTTP_502_BAD_GATEWAY,
+            detail=f"Vector search error: {e}"
         )
-    
+
+    results = []
+    for q, docs in zip(request.queries, result_lists):
+        matches = []
+        for doc in docs:
+            if q.min_score is not None and doc.metadata["score"] < q.min_score:
+                continue
+            match = {"id": doc.id, "score": doc.metadata["score"], "source": doc.metadata.get("source")}
+            if request.include_text:
+                match["text"] = doc.page_content
+            if request.include_metadata:
+                match["metadata"] = {k: v for k, v in doc.metadata.items() if k != "score"}
+            matches.append(match)
+        results.append({"query": q.query, "matches": matches})
+    REQUESTS.labels("vector_search", "bypass").inc()
+    REQUEST_SECONDS.labels("vector_search").observe(trace.summary()["total_ms"] / 1000)
+
+    return {
+        'status': status.HTTP_200_OK,
+        'results': results,
+        'timings': trace.summary()
+    }
+
 class RAGRequest(BaseModel):
     query: str
-    history: list = []
+    session_id: Optional[str] = None  # returned by the first request of a conversation
+    history: list = []  # only used to seed a new session
+    bypass_cache: bool = False  # skip the semantic answer cache for this request
+    deadline_ms: Optional[int] = None  # latency budget; later pipeline steps are dropped to meet it
+    collections: Optional[List[str]] = None  # search only these collections (e.g. one course)
+
+# Latency budget for requests that do not set one (0 = none)
+REQUEST_DEADLINE_MS = int(os.getenv("REQUEST_DEADLINE_MS", "0"))
+
+def _deadline_seconds(deadline_ms: Optional[int]) -> Optional[float]:
+    deadline_ms = deadline_ms or REQUEST_DEADLINE_MS
+    return deadline_ms / 1000 if deadline_ms > 0 else None
 
 @app.post('/rag',tags=["RAG"])
-def rag_chain_invoke(request:RAGRequest):
+async def rag_chain_invoke(request:RAGRequest):
     query = request.query
     if not query:
         raise HTTPException(
             status_code = status.HTTP_400_BAD_REQUEST,
             detail = "Error in request: Empty or None String Value in Query..."
         )
+    unknown = await _unknown_collections(request.collections)
+    if unknown:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Unknown collections: {', '.join(unknown)}")
     
-    response = rag_chain.invoke(query, request.history)
+    trace = start_trace()
+    set_priority(STANDARD)
+    llm_scheduler.check_admission()
+    session = await run_in_threadpool(session_store.get_or_create, request.session_id, request.history)
+    response = await rag_chain.ainvoke(query, session, bypass_cache=request.bypass_cache, deadline=_deadline_seconds(request.deadline_ms),
+                                       collections=request.collections)
+    rag_info = response.response_metadata.get("rag", {})
+    turn = session_store.append(session, [{"role": "user", "content": query}, {"role": "assistant", "content": response.content}])
     
     # Store interaction
     interaction = {
         "query": query,
         "response": response.content,
-        "history": request.history,
+        "session_id": session.id,
+        "turn": turn,
         "timestamp": datetime.utcnow(),
-        "feedback": None
+        "feedback": None,
+        "cache_entry": rag_info.get("cache_entry"),
+        "coalesced": rag_info.get("coalesced", False),
+        "degraded": rag_info.get("degraded", []),
+        "collections": request.collections,
+        "packing": {"context": rag_info.get("context"), "history": rag_info.get("history")},
+        "timings": trace.summary()
     }
-    inserted_id = interactions.insert_one(interaction).inserted_id
+    # Queued for the background writer; the id is assigned up front
+    with span("log_interaction"):
+        inserted_id = interaction_writer.submit(interaction)
+    REQUESTS.labels("rag", rag_info.get("cache", "bypass")).inc()
+    REQUEST_SECONDS.labels("rag").observe(trace.summary()["total_ms"] / 1000)
 
     return{
         'status' : status.HTTP_200_OK,
         'response' : response,
-        'interactionId': str(inserted_id)
+        'interactionId': str(inserted_id),
+        'sessionId': session.id,
+        'degraded': rag_info.get("degraded", [])
     }
 
 class FeedbackRequest(BaseModel):
@@ -170,49 +360,169 @@ class FeedbackRequest(BaseModel):
 @app.post('/feedback', tags=["Feedback"])
 def submit_feedback(request: FeedbackRequest):
     try:
-        interactions.update_one(
-            {"_id": ObjectId(request.interactionId)},
-            {"$set": {"feedback": request.feedback}}
-        )
+        interaction_id = ObjectId(request.interactionId)
+        # The interaction may still be waiting in the writer queue
+        interaction = interaction_writer.update(interaction_id, {"feedback": request.feedback})
+        if interaction is None:
+            interaction = interactions.find_one_and_update(
+                {"_id": interaction_id},
+                {"$set": {"feedback": request.feedback}},
+                projection={"cache_entry": 1}
+            )
+        # Upvoted answers become preferred cache entries, downvoted ones are evicted
+        if answer_cache is not None and interaction and interaction.get("cache_entry") is not None:
+            answer_cache.record_feedback(interaction["cache_entry"], request.feedback)
         return {"status": "success", "message": "Feedback received"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+# Per-socket cap on queries in flight at once
+WS_MAX_IN_FLIGHT = int(os.getenv("WS_MAX_IN_FLIGHT", "4"))
+
 @app.websocket("/ws/stream")
 async def chat_stream(websocket:WebSocket):
     await websocket.accept()
-    try:
+    # Queries run as tasks, so the socket keeps listening while they stream: a cancel frame
+    # or a disconnect cancels the pipeline, with its pending LLM and Pinecone calls.
+    # Queries sent with a request_id run concurrently and each of their frames is prefixed
+    # with <<R:request_id>>; queries without one run one after another, unprefixed.
+    tasks = {}       # request_id -> latest task
+    running = set()  # every unfinished task, including queued ones without a request_id
+    send_lock = asyncio.Lock()
+    session = None
+
+    async def send(request_id, frame: str):
+        async with send_lock:
+            await websocket.send_text(frame if request_id is None else f'<<R:{request_id}>>{frame}')
+
+    async def answer(request_id, data: dict, session, previous: Optional[asyncio.Task]):
+        if previous is not None:
+            await asyncio.wait([previous])
+        query = data['query']
         resp = ''
-        while True:
-            data = await websocket.receive_json()
-            if 'query' not in data:
-                await websocket.send_text('<<E:NO_QUERY>>')
-                break
-            query = data['query']
-            history = data.get('history', [])
-            
-            for token in rag_chain.stream(query, history):
-                await websocket.send_text(token.content)
-                resp += token.content
-            
+        final_answer = None
+        trace = start_trace()
+        # Someone is watching the tokens arrive, so these calls go first
+        set_priority(INTERACTIVE)
+        try:
+            await send(request_id, f'<<SID:{session.id}>>')
+
+            # Frames: <<SID:session id>> first, answer tokens as plain text, pipeline progress
+            # as <<EV:{json}>> (rewrite, retrieval, judge, retracted, refine, degraded).
+            # A "retracted" event means the draft streamed so far was rejected by the judge.
+            # <<E:BUSY:seconds>> means the LLM queue is full and the client should retry later,
+            # <<E:ERROR>> that the query failed and <<E:UNKNOWN_COLLECTIONS:names>> that the
+            # index has no such collections; all are followed by <<END>>.
+            unknown = await rag_chain.retriever.aunknown_collections(data.get('collections'))
+            if unknown:
+                await send(request_id, f'<<E:UNKNOWN_COLLECTIONS:{",".join(unknown)}>>')
+                await send(request_id, '<<END>>')
+                return
+            try:
+                llm_scheduler.check_admission()
+                async for event in rag_chain.astream(query, session, bypass_cache=data.get('bypass_cache', False), deadline=_deadline_seconds(data.get('deadline_ms')),
+                                                     collections=data.get('collections')):
+                    if event['type'] == 'token':
+                        await send(request_id, event['content'])
+                        resp += event['content']
+                    elif event['type'] == 'final':
+                        final_answer = event['answer']
+                    else:
+                        if event['type'] == 'retracted':
+                            resp = ''
+                        await send(request_id, f'<<EV:{json.dumps(event)}>>')
+            except SchedulerFull as e:
+                await send(request_id, f'<<E:BUSY:{e.retry_after}>>')
+                await send(request_id, '<<END>>')
+                return
+
+            rag_info = final_answer.response_metadata.get("rag", {}) if final_answer else {}
+            turn = session_store.append(session, [{"role": "user", "content": query}, {"role": "assistant", "content": resp}])
+
             # Store interaction
             try:
                 interaction = {
                     "query": query,
                     "response": resp,
+                    "session_id": session.id,
+                    "turn": turn,
                     "timestamp": datetime.utcnow(),
-                    "feedback": None
+                    "feedback": None,
+                    "cache_entry": rag_info.get("cache_entry"),
+                    "coalesced": rag_info.get("coalesced", False),
+                    "degraded": rag_info.get("degraded", []),
+                    "collections": data.get('collections'),
+                    "packing": {"context": rag_info.get("context"), "history": rag_info.get("history")},
+                    "timings": trace.summary()
                 }
-                inserted_id = interactions.insert_one(interaction).inserted_id
-                
+                with span("log_interaction"):
+                    inserted_id = interaction_writer.submit(interaction)
+
                 # Send ID to client
-                await websocket.send_text(f'<<ID:{str(inserted_id)}>>')
+                await send(request_id, f'<<ID:{str(inserted_id)}>>')
             except Exception as e:
                 print(f"Error logging to Mongo: {e}")
+            REQUESTS.labels("ws", rag_info.get("cache", "bypass")).inc()
+            REQUEST_SECONDS.labels("ws").observe(trace.summary()["total_ms"] / 1000)
+
+            await send(request_id, '<<END>>')
+        except WebSocketDisconnect:
+            pass
+        except Exception as e:
+            # The query failed (LLM or Pinecone error); tell the client instead of leaving it waiting
+            print(f"Error during execution, {e}")
+            try:
+                await send(request_id, '<<E:ERROR>>')
+                await send(request_id, '<<END>>')
+            except Exception:
+                pass
+
+    async def cancel(task: asyncio.Task, reason: str):
+        if not task.done():
+            task.cancel()
+            CANCELLED.labels("ws", reason).inc()
+        await asyncio.wait([task])
+
+    try:
+        while True:
+            data = await websocket.receive_json()
+            tasks = {key: task for key, task in tasks.items() if not task.done()}
+            request_id = data.get('request_id')
+            request_id = None if request_id is None else str(request_id)
+
+            if data.get('type') == 'cancel':
+                # The cancelled query ends with <<E:CANCELLED>> and <<END>>; nothing is stored.
+                # Queries without a request_id cannot be told apart, so they cannot be cancelled.
+                if request_id is None:
+                    await send(None, '<<E:NO_REQUEST_ID>>')
+                elif request_id in tasks:
+                    await cancel(tasks.pop(request_id), "client")
+                    await send(request_id, '<<E:CANCELLED>>')
+                    await send(request_id, '<<END>>')
+                continue
+            if 'query' not in data:
+                await send(request_id, '<<E:NO_QUERY>>')
+                break
+            if request_id is not None and request_id in tasks:
+                await send(request_id, '<<E:DUPLICATE_ID>>')
+                continue
+            if request_id is not None and len(tasks) >= WS_MAX_IN_FLIGHT:
+                await send(request_id, '<<E:TOO_MANY>>')
+                await send(request_id, '<<END>>')
+                continue
 
-            await websocket.send_text('<<END>>')
-            resp = '' # Reset buffer
+            # The session is kept for the lifetime of the socket; a client reconnecting
+            # sends its session_id (or, the first time, the history to seed it with)
+            if session is None or data.get('session_id') not in (None, session.id):
+                session = await run_in_threadpool(session_store.get_or_create, data.get('session_id'), data.get('history', []))
+            task = tasks[request_id] = asyncio.create_task(answer(request_id, data, session, tasks.get(request_id)))
+            running.add(task)
+            task.add_done_callback(running.discard)
     except WebSocketDisconnect:
         print("Websocket Disconnected")
     except Exception as e:
-        print(f"Error during execution, {e}")
\ No newline at end of file
+        print(f"Error during execution, {e}")
+    finally:
+        # Nobody is left to read the answers
+        for task in list(running):
+            await cancel(task, "disconnect")
@@ -1,87 +1,551 @@
 from dotenv import load_dotenv
 load_dotenv(".env")
 import os
+import math
+import time
+import asyncio
 import logging
+import atexit
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 
 logging.getLogger("chromadb").setLevel(logging.CRITICAL)
 
-from langchain_core.vectorstores.base import VectorStoreRetriever
-from langchain_google_genai import ChatGoogleGenerativeAI, GoogleGenerativeAIEmbeddings
 from langchain_core.prompts import PromptTemplate
 from langchain_core.retrievers import BaseRetriever
-from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.callbacks import CallbackManagerForRetrieverRun, AsyncCallbackManagerForRetrieverRun
 from langchain_core.documents import Document
-from typing import List
-from pinecone import Pinecone
-from utils.query_retrieve import retrieve_query
-from utils.format_docs import format_docs
-from utils.prompt import rag_prompt, judge_prompt, query_refining_prompt
+from langchain_core.messages import AIMessage
+from typing import List, Optional, TYPE_CHECKING
+from utils.query_retrieve import aretrieve_query, needs_rewrite, is_near_identical, RewriteCache
+from utils.sessions import format_history, history_digest
+from utils.format_docs import format_docs, ContextPacker
+from utils.embedding_cache import EmbeddingCache, normalize_query
+from utils.semantic_cache import SemanticCache
+from utils.fusion import reciprocal_rank_fusion, merge_by_score
+from utils.local_index import LocalVectorIndex
+from utils.bm25 import BM25Index
+from utils.prompt import rag_prompt, judge_prompt, query_refining_prompt, light_judge_prompt, query_variants_prompt, comparative_judge_prompt
+from utils.reflection import ReflectionPolicy, parse_judge_response, SKIP, LIGHT, FULL
+from utils.tracing import span, record_tokens, record_retry, current_trace, start_trace
+from utils.coalesce import SingleFlight
+from utils.llm_scheduler import LLMScheduler, get_priority, set_priority
+from utils.deadline import Deadline, LatencyEstimator
+from utils.speculative import TokenBudget, estimate_tokens, parse_variants, format_candidates, parse_comparative_response
 
-# Initialize Gemini LLM
-llm = ChatGoogleGenerativeAI(model="gemini-2.5-flash")
+if TYPE_CHECKING:
+    from langchain_core.vectorstores.base import VectorStoreRetriever
+    from langchain_google_genai import ChatGoogleGenerativeAI
 
 PINECONE_API_KEY = os.getenv("PINECONE_API_KEY")
-if not PINECONE_API_KEY:
-    raise ValueError("PINECONE_API_KEY not found in environment variables")
 
-pc = Pinecone(api_key=PINECONE_API_KEY)
+# The Gemini (`llm`) and Pinecone (`pc`) clients are created on first use, or by warmup(),
+# so importing this module stays cheap: langchain_google_genai alone takes over a second
+# to import. Assigning rag_chain.llm / rag_chain.pc replaces them (e.g. with test fakes).
+def _make_llm():
+    from langchain_google_genai import ChatGoogleGenerativeAI
+    # Rate limit retries are left to llm_scheduler, which backs off across all requests
+    return ChatGoogleGenerativeAI(model="gemini-2.5-flash", max_retries=1)
+
+def _pinecone_api_key() -> str:
+    if not PINECONE_API_KEY:
+        raise ValueError("PINECONE_API_KEY not found in environment variables")
+    return PINECONE_API_KEY
+
+def _make_pinecone():
+    from pinecone import Pinecone
+    return Pinecone(api_key=_pinecone_api_key())
+
+_CLIENT_FACTORIES = {"llm": _make_llm, "pc": _make_pinecone}
+_clients_lock = threading.Lock()
+
+def _client(name: str):
+    client = globals().get(name)
+    if client is None:
+        with _clients_lock:
+            client = globals().get(name)
+            if client is None:
+                client = globals()[name] = _CLIENT_FACTORIES[name]()
+    return client
+
+def __getattr__(name):
+    # Module attribute fallback (PEP 562): `rag_chain.llm` / `rag_chain.pc` are created on access
+    if name in _CLIENT_FACTORIES:
+        return _client(name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 # These constants should match what was used in upload_to_pinecone.py
 INDEX_NAME = "acadgpt" 
 MODEL_NAME = "llama-text-embed-v2"
 NAMESPACE = "default"
 
+# Collections (one namespace each, see upload_to_pinecone.find_pdfs) searched when a request
+# names none, comma-separated; "*" searches every namespace in the index.
+DEFAULT_COLLECTIONS = [c.strip() for c in os.getenv("DEFAULT_COLLECTIONS", NAMESPACE).split(",") if c.strip()]
+# How long the namespace list behind "*" is reused before the index is asked again
+COLLECTIONS_TTL = float(os.getenv("COLLECTIONS_TTL", "300"))
+
+# Retrieval backend: "pinecone" (hosted index) or "local" (in-process index written by
+# `python upload_to_pinecone.py --backend local`). Query embeddings come from Pinecone
+# Inference in both cases so the vectors stay compatible.
+RETRIEVER_BACKEND = os.getenv("RETRIEVER_BACKEND", "pinecone")
+LOCAL_INDEX_DIR = os.getenv("LOCAL_INDEX_DIR", "local_index")
+
+# "hybrid" fuses dense hits with BM25 hits from the inverted index written at ingest time.
+# HYBRID_ALPHA is the weight of the dense side in the fusion (BM25 gets 1 - alpha).
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "dense")
+BM25_INDEX_DIR = os.getenv("BM25_INDEX_DIR", "bm25_index")
+HYBRID_ALPHA = float(os.getenv("HYBRID_ALPHA", "0.5"))
+
+# Query embedding cache, optionally persisted to EMBED_CACHE_PATH across restarts
+embedding_cache = EmbeddingCache(
+    max_size=int(os.getenv("EMBED_CACHE_SIZE", "4096")),
+    ttl=float(os.getenv("EMBED_CACHE_TTL", str(7 * 24 * 3600))),
+    path=os.getenv("EMBED_CACHE_PATH"),
+)
+atexit.register(embedding_cache.save)
+
+# upload_to_pinecone.py touches this file after every ingestion run
+CORPUS_VERSION_PATH = os.getenv("CORPUS_VERSION_PATH", ".corpus_version")
+
+# Sync index handle, created once and shared; its HTTP connection pool is reused
+# across requests. Batch queries fan out over _query_pool.
+_index = None
+_index_lock = threading.Lock()
+_query_pool = ThreadPoolExecutor(max_workers=int(os.getenv("PINECONE_QUERY_CONCURRENCY", "8")), thread_name_prefix="pinecone-query")
+
+def _get_index():
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = _client("pc").Index(INDEX_NAME)
+    return _index
+
+# Async Pinecone clients hold an aiohttp session, which is bound to the event loop
+# that created it, so we keep one client/index pair per running loop.
+_async_pinecone = weakref.WeakKeyDictionary()
+_index_host = None
+
+async def _create_async_pinecone():
+    global _index_host
+    from pinecone import PineconeAsyncio
+    client = PineconeAsyncio(api_key=_pinecone_api_key())
+    try:
+        if _index_host is None:
+            _index_host = (await client.describe_index(INDEX_NAME)).host
+        return client, client.IndexAsyncio(host=_index_host)
+    except BaseException:
+        await client.close()
+        raise
+
+async def _get_async_pinecone():
+    """Returns the (client, index) pair for the running event loop, creating it on first use.
+
+    Concurrent first callers share one creation task, so a loop never ends up with a
+    second client whose session is left open.
+    """
+    loop = asyncio.get_running_loop()
+    pending = _async_pinecone.get(loop)
+    if pending is None:
+        pending = _async_pinecone[loop] = loop.create_task(_create_async_pinecone())
+    try:
+        return await asyncio.shield(pending)
+    except Exception:
+        # Let the next caller retry instead of replaying the same failure forever
+        if _async_pinecone.get(loop) is pending:
+            del _async_pinecone[loop]
+        raise
+
+async def _close_async_pinecone():
+    """Closes the running loop's client/index pair, if one was ever created."""
+    pending = _async_pinecone.pop(asyncio.get_running_loop(), None)
+    if pending is None:
+        return
+    try:
+        client, index = await pending
+    except Exception:
+        return
+    await index.close()
+    await client.close()
+
+def _matches_to_documents(results) -> List[Document]:
+    documents = []
+    for match in results['matches']:
+        metadata = match['metadata']
+        # Reconstruct document content if stored in metadata
+        content = metadata.get('text', '')
+        # Clean up metadata to remove the text field if you don't want it duplicated
+        doc_metadata = {k: v for k, v in metadata.items() if k != 'text'}
+        doc_metadata['score'] = match['score']
+
+        documents.append(Document(id=match['id'], page_content=content, metadata=doc_metadata))
+
+    return documents
+
 class PineconeRetriever(BaseRetriever):
-    def _get_relevant_documents(
-        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
-    ) -> List[Document]:
-        # Embed the query using Pinecone Inference
+    embedding_cache: Optional[EmbeddingCache] = None
+    top_k: int = 5
+    bm25: Optional[BM25Index] = None  # set for hybrid retrieval
+    hybrid_alpha: float = 0.5
+    collections: List[str] = [NAMESPACE]  # searched when a request names none; "*" = all
+    listed_collections: tuple = (0.0, [])  # (expiry, namespaces) cached for "*"
+
+    def list_collections(self) -> List[str]:
+        return sorted(_get_index().describe_index_stats()["namespaces"])
+
+    async def alist_collections(self) -> List[str]:
+        _, index = await _get_async_pinecone()
+        return sorted((await index.describe_index_stats())["namespaces"])
+
+    def _scope(self, collections: List[str], listed: List[str]) -> tuple:
+        """
+        Returns (namespaces, bm25 filter) for a request's collections. The BM25 index is
+        shared by all collections, so a scoped search filters it by the chunks' collection
+        (chunks ingested before collections existed have none and belong to the default).
+        """
+        collections = list(collections or self.collections)
+        if "*" in collections:
+            return listed or [NAMESPACE], None
+        members = collections + [None] if NAMESPACE in collections else collections
+        return collections, {"collection": {"$in": members}}
+
+    def _listed(self) -> List[str]:
+        expires, listed = self.listed_collections
+        if time.monotonic() > expires:
+            listed = self.list_collections()
+            self.listed_collections = (time.monotonic() + COLLECTIONS_TTL, listed)
+        return listed
+
+    async def _alisted(self, refresh: bool = False) -> List[str]:
+        expires, listed = self.listed_collections
+        if refresh or time.monotonic() > expires:
+            listed = await self.alist_collections()
+            self.listed_collections = (time.monotonic() + COLLECTIONS_TTL, listed)
+        return listed
+
+    def _resolve(self, collections: List[str] = None) -> tuple:
+        listed = self._listed() if "*" in (collections or self.collections) else None
+        return self._scope(collections, listed)
+
+    async def _aresolve(self, collections: List[str] = None) -> tuple:
+        listed = await self._alisted() if "*" in (collections or self.collections) else None
+        return self._scope(collections, listed)
+
+    async def aunknown_collections(self, collections: List[str] = None) -> List[str]:
+        """Requested collections the index has no namespace for ("*" always exists)."""
+        requested = [c for c in collections or [] if c != "*"]
+        if not requested:
+            return []
+        listed = await self._alisted()
+        if any(c not in listed for c in requested):
+            # The cached list may predate a collection ingested since
+            listed = await self._alisted(refresh=True)
+        return [c for c in requested if c not in listed]
+
+    def _split_cached(self, queries: List[str]):
+        """
+        Returns (vectors, missing) where vectors has None for every query not in the cache.
+        """
+        vectors = [None] * len(queries)
+        if self.embedding_cache is not None:
+            vectors = [self.embedding_cache.get(q, MODEL_NAME) for q in queries]
+        missing = [i for i, v in enumerate(vectors) if v is None]
+        return vectors, missing
+
+    def _store_embeddings(self, queries: List[str], vectors: list, missing: List[int], embeddings):
+        for i, embedding_obj in zip(missing, embeddings):
+            vectors[i] = embedding_obj['values']
+            if self.embedding_cache is not None:
+                self.embedding_cache.put(queries[i], MODEL_NAME, vectors[i])
+        return vectors
+
+    def embed_queries(self, queries: List[str]) -> List[list]:
+        """
+        Embeds several queries with a single inference call (cached queries are skipped).
+        """
+        vectors, missing = self._split_cached(queries)
+        if not missing:
+            return vectors
+
+        # Embed the queries using Pinecone Inference
         # input_type="query" is important for asymmetric retrieval models
-        embeddings = pc.inference.embed(
-            model=MODEL_NAME,
-            inputs=[query],
-            parameters={"input_type": "query"}
+        with span("embed"):
+            embeddings = _client("pc").inference.embed(
+                model=MODEL_NAME,
+                inputs=[queries[i] for i in missing],
+                parameters={"input_type": "query"}
+            )
+        return self._store_embeddings(queries, vectors, missing, embeddings)
+
+    async def aembed_queries(self, queries: List[str]) -> List[list]:
+        vectors, missing = self._split_cached(queries)
+        if not missing:
+            return vectors
+
+        client, _ = await _get_async_pinecone()
+        with span("embed"):
+            embeddings = await client.inference.embed(
+                model=MODEL_NAME,
+                inputs=[queries[i] for i in missing],
+                parameters={"input_type": "query"}
+            )
+        return self._store_embeddings(queries, vectors, missing, embeddings)
+
+    def embed_query(self, query: str) -> list:
+        return self.embed_queries([query])[0]
+
+    async def aembed_query(self, query: str) -> list:
+        return (await self.aembed_queries([query]))[0]
+
+    def _query_index(self, vector: list, top_k: int, filter: dict = None, namespace: str = NAMESPACE) -> List[Document]:
+        results = _get_index().query(
+            namespace=namespace,
+            vector=vector,
+            top_k=top_k,
+            filter=filter,
+            include_values=False,
+            include_metadata=True
         )
-        query_embedding = embeddings[0]['values']
-
-        # Query the index
-        index = pc.Index(INDEX_NAME)
-        results = index.query(
-            namespace=NAMESPACE,
-            vector=query_embedding,
-            top_k=5, 
+        return _matches_to_documents(results)
+
+    async def _aquery_index(self, vector: list, top_k: int, filter: dict = None, namespace: str = NAMESPACE) -> List[Document]:
+        _, index = await _get_async_pinecone()
+        results = await index.query(
+            namespace=namespace,
+            vector=vector,
+            top_k=top_k,
+            filter=filter,
             include_values=False,
             include_metadata=True
         )
+        return _matches_to_documents(results)
 
-        documents = []
-        for match in results['matches']:
-            metadata = match['metadata']
-            # Reconstruct document content if stored in metadata
-            content = metadata.get('text', '')
-            # Clean up metadata to remove the text field if you don't want it duplicated
-            doc_metadata = {k: v for k, v in metadata.items() if k != 'text'}
-            doc_metadata['score'] = match['score']
-            
-            documents.append(Document(page_content=content, metadata=doc_metadata))
-        
-        return documents
+    def _query_many(self, requests: list) -> List[List[Document]]:
+        """
+        Runs (vector, top_k, filter, namespaces) index queries. Every namespace of every
+        query goes to _query_pool at once; hits from several namespaces are merged by score.
+        """
+        pairs = [(i, namespace) for i, request in enumerate(requests) for namespace in request[3]]
+        hits = _query_pool.map(lambda pair: self._query_index(*requests[pair[0]][:3], pair[1]), pairs)
+        grouped = [[] for _ in requests]
+        for (i, _), docs in zip(pairs, hits):
+            grouped[i].append(docs)
+        return [lists[0] if len(lists) == 1 else merge_by_score(lists, request[1]) for lists, request in zip(grouped, requests)]
+
+    async def _aquery_many(self, requests: list) -> List[List[Document]]:
+        async def one(vector, top_k, filter, namespaces):
+            if len(namespaces) == 1:
+                return await self._aquery_index(vector, top_k, filter, namespaces[0])
+            hits = await asyncio.gather(*(self._aquery_index(vector, top_k, filter, namespace) for namespace in namespaces))
+            return merge_by_score(hits, top_k)
+        return list(await asyncio.gather(*(one(*request) for request in requests)))
+
+    def _fuse(self, queries: List[str], dense_lists: List[List[Document]], sparse_lists: List[List[Document]], top_k: int, weights: List[float] = None) -> List[Document]:
+        weights = weights or [1.0] * len(queries)
+        if self.bm25 is None:
+            return reciprocal_rank_fusion(dense_lists, weights, top_k=top_k)
+        return reciprocal_rank_fusion(
+            dense_lists + sparse_lists,
+            [w * self.hybrid_alpha for w in weights] + [w * (1 - self.hybrid_alpha) for w in weights],
+            top_k=top_k
+        )
+
+    def _sparse_search(self, queries: List[str], top_k: int, filter: dict = None) -> List[List[Document]]:
+        if self.bm25 is None:
+            return []
+        return [self.bm25.search(q, top_k, filter=filter) for q in queries]
+
+    def batch_retrieve(self, queries: List[str], top_k: int = None, weights: List[float] = None, collections: List[str] = None) -> List[Document]:
+        """
+        Retrieves for several query variants at once: one embed call, concurrent index
+        queries, results merged with reciprocal rank fusion (together with BM25 hits
+        in hybrid mode). With several `collections` each namespace is searched
+        concurrently and the hits merged by score before fusion.
+        """
+        top_k = top_k or self.top_k
+        namespaces, bm25_filter = self._resolve(collections)
+        vectors = self.embed_queries(queries)
+        with span("index_query"):
+            dense_lists = self._query_many([(v, top_k, None, namespaces) for v in vectors])
+            sparse_lists = self._sparse_search(queries, top_k, bm25_filter)
+        return self._fuse(queries, dense_lists, sparse_lists, top_k, weights)
+
+    async def abatch_retrieve(self, queries: List[str], top_k: int = None, weights: List[float] = None, collections: List[str] = None) -> List[Document]:
+        top_k = top_k or self.top_k
+        namespaces, bm25_filter = await self._aresolve(collections)
+        vectors = await self.aembed_queries(queries)
+        with span("index_query"):
+            dense_lists, sparse_lists = await asyncio.gather(
+                self._aquery_many([(v, top_k, None, namespaces) for v in vectors]),
+                asyncio.to_thread(self._sparse_search, queries, top_k, bm25_filter)
+            )
+        return self._fuse(queries, dense_lists, sparse_lists, top_k, weights)
+
+    def search(self, queries: List[str], top_k: List[int], filters: List[dict] = None, collections: List[List[str]] = None) -> List[List[Document]]:
+        """
+        Dense search for a batch of independent queries, one result list per query (no
+        fusion): one embed call for the distinct queries, concurrent index queries, each
+        with its own top_k, metadata filter and collections.
+        """
+        filters = filters or [None] * len(queries)
+        scopes = [self._resolve(c)[0] for c in collections or [None] * len(queries)]
+        distinct = list(dict.fromkeys(queries))
+        vector_of = dict(zip(distinct, self.embed_queries(distinct)))
+        with span("index_query"):
+            return self._query_many([(vector_of[q], k, f, n) for q, k, f, n in zip(queries, top_k, filters, scopes)])
 
-# Set Pinecone as the Retriever
-retriever = PineconeRetriever()
+    async def asearch(self, queries: List[str], top_k: List[int], filters: List[dict] = None, collections: List[List[str]] = None) -> List[List[Document]]:
+        filters = filters or [None] * len(queries)
+        scopes = [(await self._aresolve(c))[0] for c in collections or [None] * len(queries)]
+        distinct = list(dict.fromkeys(queries))
+        vector_of = dict(zip(distinct, await self.aembed_queries(distinct)))
+        with span("index_query"):
+            return await self._aquery_many([(vector_of[q], k, f, n) for q, k, f, n in zip(queries, top_k, filters, scopes)])
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        namespaces, _ = self._resolve()
+        if self.bm25 is not None or len(namespaces) > 1:
+            return self.batch_retrieve([query])
+        vector = self.embed_query(query)
+        with span("index_query"):
+            return self._query_index(vector, self.top_k, namespace=namespaces[0])
+
+    async def _aget_relevant_documents(
+        self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        # Same as above, but through the asyncio client so the event loop stays free
+        namespaces, _ = await self._aresolve()
+        if self.bm25 is not None or len(namespaces) > 1:
+            return await self.abatch_retrieve([query])
+        vector = await self.aembed_query(query)
+        with span("index_query"):
+            return await self._aquery_index(vector, self.top_k, namespace=namespaces[0])
+
+class LocalRetriever(PineconeRetriever):
+    """
+    Same interface as PineconeRetriever, but searches a LocalVectorIndex in-process
+    instead of making a network hop to the hosted index.
+    """
+    index: LocalVectorIndex
+
+    def list_collections(self) -> List[str]:
+        return self.index.list_namespaces()
+
+    async def alist_collections(self) -> List[str]:
+        return self.index.list_namespaces()
+
+    def _query_index(self, vector: list, top_k: int, filter: dict = None, namespace: str = NAMESPACE) -> List[Document]:
+        return _matches_to_documents(self.index.query(vector=vector, top_k=top_k, namespace=namespace, filter=filter))
+
+    async def _aquery_index(self, vector: list, top_k: int, filter: dict = None, namespace: str = NAMESPACE) -> List[Document]:
+        # The scan releases the GIL in NumPy, so a worker thread keeps the loop responsive
+        return await asyncio.to_thread(self._query_index, vector, top_k, filter, namespace)
+
+# Set the Retriever
+hybrid_options = {}
+if RETRIEVAL_MODE == "hybrid":
+    hybrid_options = {"bm25": BM25Index(BM25_INDEX_DIR), "hybrid_alpha": HYBRID_ALPHA}
+
+if RETRIEVER_BACKEND == "local":
+    retriever = LocalRetriever(
+        embedding_cache=embedding_cache,
+        collections=DEFAULT_COLLECTIONS,
+        index=LocalVectorIndex(LOCAL_INDEX_DIR, nprobe=int(os.getenv("LOCAL_INDEX_NPROBE", "8"))),
+        **hybrid_options
+    )
+else:
+    retriever = PineconeRetriever(embedding_cache=embedding_cache, collections=DEFAULT_COLLECTIONS, **hybrid_options)
 
 custom_rag_prompt = rag_prompt()
 custom_judge_prompt = judge_prompt()
 custom_refine_prompt = query_refining_prompt()
+custom_light_judge_prompt = light_judge_prompt()
+custom_variants_prompt = query_variants_prompt()
+custom_comparative_judge_prompt = comparative_judge_prompt()
+
+# Adaptive reflection: skip or shorten the judge call when retrieval confidence is high.
+# MAX_LLM_CALLS caps rewrite + generate + judge + refine calls for a single request.
+reflection_policy = None
+if os.getenv("ADAPTIVE_REFLECTION", "1") == "1":
+    reflection_policy = ReflectionPolicy(
+        high_score=float(os.getenv("REFLECTION_HIGH_SCORE", "0.6")),
+        medium_score=float(os.getenv("REFLECTION_MEDIUM_SCORE", "0.45")),
+    )
+MAX_LLM_CALLS = int(os.getenv("MAX_LLM_CALLS", "8"))
+
+# Speculative mode: instead of sequential judge -> refine retries, generate candidates for
+# several query variants concurrently and keep the first one the judge accepts.
+# 0 keeps the sequential loop.
+SPECULATIVE_CANDIDATES = int(os.getenv("SPECULATIVE_CANDIDATES", "0"))
+SPECULATIVE_CONCURRENCY = int(os.getenv("SPECULATIVE_CONCURRENCY", "3"))
+SPECULATIVE_TOKEN_BUDGET = int(os.getenv("SPECULATIVE_TOKEN_BUDGET", "0")) or None
+
+# Follow-up rewrites are cached per (query, chat history); first-turn queries are not rewritten.
+# While a rewrite runs, retrieval on the raw query starts in parallel and is used if the
+# rewrite takes longer than REWRITE_TIMEOUT seconds or barely changes the query. A late
+# rewrite keeps running in the background so the next turn finds it in the cache.
+REWRITE_CACHE_SIZE = int(os.getenv("REWRITE_CACHE_SIZE", "1024"))
+REWRITE_TIMEOUT = float(os.getenv("REWRITE_TIMEOUT", "3.0"))
+rewrite_cache = RewriteCache(max_size=REWRITE_CACHE_SIZE) if REWRITE_CACHE_SIZE > 0 else None
+# With a request deadline, the rewrite waits at most this share of the remaining time
+REWRITE_DEADLINE_SHARE = float(os.getenv("REWRITE_DEADLINE_SHARE", "0.2"))
+
+# Prompt token budgets for retrieved context and chat history (0 = unlimited). Adjacent
+# chunks are merged and their overlap dropped; CHUNK_OVERLAP is shared with the ingester.
+context_packer = ContextPacker(
+    context_tokens=int(os.getenv("CONTEXT_TOKEN_BUDGET", "3000")),
+    history_tokens=int(os.getenv("HISTORY_TOKEN_BUDGET", "1000")),
+    max_overlap=int(os.getenv("CHUNK_OVERLAP", "200")),
+)
+
+# Every Gemini call goes through one scheduler: a concurrency cap, a token bucket of
+# LLM_RATE_LIMIT calls per minute (0 = off), jittered backoff on 429s and priority for
+# interactive traffic. With LLM_QUEUE_SIZE calls waiting, requests get a 429.
+llm_scheduler = LLMScheduler(
+    max_concurrency=int(os.getenv("LLM_MAX_CONCURRENCY", "16")),
+    rate_per_minute=float(os.getenv("LLM_RATE_LIMIT", "0")),
+    burst=int(os.getenv("LLM_RATE_BURST", "10")),
+    max_queue=int(os.getenv("LLM_QUEUE_SIZE", "200")),
+    max_retries=int(os.getenv("LLM_MAX_RETRIES", "4")),
+)
+
+# Identical concurrent requests (same normalized query and chat history) share one pipeline run
+coalescer = SingleFlight() if os.getenv("COALESCE_REQUESTS", "1") == "1" else None
+
+# Semantic answer cache in front of the LLM pipeline
+answer_cache = None
+if os.getenv("ANSWER_CACHE_ENABLED", "1") == "1":
+    answer_cache = SemanticCache(
+        capacity=int(os.getenv("ANSWER_CACHE_SIZE", "1024")),
+        threshold=float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95")),
+        version_path=CORPUS_VERSION_PATH,
+    )
 
 
 class RAGChain:
     def __init__(
             self,
-            llm:ChatGoogleGenerativeAI,
-            retriever:VectorStoreRetriever,
+            llm:"ChatGoogleGenerativeAI",
+            retriever:"VectorStoreRetriever",
             prompt:PromptTemplate,
             judge_prompt:PromptTemplate,
-            refine_prompt:PromptTemplate
+            refine_prompt:PromptTemplate,
+            answer_cache:SemanticCache = None,
+            reflection_policy:ReflectionPolicy = None,
+            light_judge_prompt:PromptTemplate = None,
+            max_llm_calls:int = 8,
+            speculative_candidates:int = 0,
+            speculative_concurrency:int = 3,
+            speculative_token_budget:int = None,
+            variants_prompt:PromptTemplate = None,
+            compare_prompt:PromptTemplate = None,
+            rewrite_cache:RewriteCache = None,
+            rewrite_timeout:float = None,
+            context_packer:ContextPacker = None,
+            coalescer:SingleFlight = None,
+            scheduler:LLMScheduler = None
     ):
         self.llm = llm
         self.retriever = retriever
@@ -89,94 +553,630 @@ class RAGChain:
         self.judge_prompt = judge_prompt
         self.refine_prompt = refine_prompt
         self.max_retries = 3
+        self.answer_cache = answer_cache
+        self.reflection_policy = reflection_policy
+        self.light_judge_prompt = light_judge_prompt or judge_prompt
+        self.max_llm_calls = max_llm_calls
+        self.speculative_candidates = speculative_candidates
+        self.speculative_concurrency = speculative_concurrency
+        self.speculative_token_budget = speculative_token_budget
+        self.variants_prompt = variants_prompt or query_variants_prompt()
+        self.compare_prompt = compare_prompt or comparative_judge_prompt()
+        self.rewrite_cache = rewrite_cache
+        self.rewrite_timeout = rewrite_timeout
+        self.context_packer = context_packer
+        self.coalescer = coalescer
+        self.scheduler = scheduler
+        # Observed step latencies, to tell whether another step fits in a request's deadline
+        self.latency = LatencyEstimator()
+
+    @property
+    def llm(self):
+        # Without an explicit model the shared Gemini client is created on first use
+        if self._llm is None:
+            self._llm = _client("llm")
+        return self._llm
+
+    @llm.setter
+    def llm(self, llm):
+        self._llm = llm
 
-    def _get_judge_feedback(self, query: str, answer: str) -> tuple[bool, str]:
+    @property
+    def _scheduled_llm(self):
+        """The LLM with its calls queued by the scheduler, when there is one."""
+        return self.scheduler.bind(self.llm) if self.scheduler is not None else self.llm
+
+    async def _allm(self, stage: str, prompt: str):
+        """One traced, non-streaming LLM call."""
+        started = time.perf_counter()
+        with span(stage):
+            response = await self._scheduled_llm.ainvoke(prompt)
+        self.latency.observe(stage, time.perf_counter() - started)
+        record_tokens(stage, response, prompt)
+        return response
+
+    async def _aget_judge_feedback(self, query: str, answer: str, light: bool = False) -> tuple[bool, str]:
         """
         Returns (is_satisfactory, feedback)
         """
-        judge_input = self.judge_prompt.format(query=query, answer=answer)
-        response = self.llm.invoke(judge_input).content
-        
-        is_satisfactory = "SATISFACTORY" in response
-        feedback = ""
-        if not is_satisfactory:
-            # simple parsing assuming the format is strictly followed or at least contains Feedback:
-            parts = response.split("Feedback:")
-            if len(parts) > 1:
-                feedback = parts[1].strip()
+        prompt = self.light_judge_prompt if light else self.judge_prompt
+        judge_input = prompt.format(query=query, answer=answer)
+        response = (await self._allm("judge", judge_input)).content
+        return parse_judge_response(response)
+
+    async def _agenerate(self, prompt: str, stream_tokens: bool):
+        """
+        Yields ("token", text) chunks when stream_tokens is set, then ("answer", message)
+        """
+        if not stream_tokens:
+            yield "answer", await self._allm("generate", prompt)
+            return
+
+        answer = None
+        started = time.perf_counter()
+        # The span includes the time the consumer takes per token (e.g. websocket sends)
+        with span("generate"):
+            async for chunk in self._scheduled_llm.astream(prompt):
+                answer = chunk if answer is None else answer + chunk
+                if chunk.content:
+                    yield "token", chunk.content
+        self.latency.observe("generate", time.perf_counter() - started)
+        record_tokens("generate", answer, prompt)
+        yield "answer", answer
+
+    def _build_prompt(self, query: str, docs: List[Document], formatted_history: str) -> tuple[str, dict]:
+        """The answer prompt for `docs`, and context packing stats (None without a packer)."""
+        with span("prompt"):
+            stats = None
+            if self.context_packer is None:
+                context = format_docs(docs)
             else:
-                feedback = response # fallback
-        
-        return is_satisfactory, feedback
+                context, stats = self.context_packer.pack_context(docs)
+            # Use original user query for answer generation
+            return self.prompt.format(context=context, query=query, chat_history=formatted_history), stats
 
-    def invoke(self, query: str, chat_history: list = None):
-        current_query = query
-        final_answer = ""
-        
-        # Initial Retrieval
-        retrieved_query_obj = retrieve_query(current_query, self.llm, chat_history)
-        search_query = retrieved_query_obj.content
+    async def _aretrieve(self, query_variants: list, search_query: str, collections: list = None) -> List[Document]:
+        """
+        Searches with all query variants in one batch, giving the current search query the
+        most weight, in `collections` (the retriever's default ones if None). Retrievers
+        without batch support only search with the current query.
+        """
+        started = time.perf_counter()
+        if hasattr(self.retriever, "abatch_retrieve"):
+            weights = [2.0 if q == search_query else 1.0 for q in query_variants]
+            docs = await self.retriever.abatch_retrieve(query_variants, weights=weights, collections=collections)
+        else:
+            docs = await self.retriever.ainvoke(search_query)
+        self.latency.observe("retrieve", time.perf_counter() - started)
+        return docs
+
+    @staticmethod
+    def _top_score(docs: List[Document]) -> float:
+        return max((doc.metadata["score"] for doc in docs if doc.metadata.get("score") is not None), default=0.0)
+
+    @staticmethod
+    def _unjudged(signals: dict) -> bool:
+        """Whether the judge was skipped for lack of calls, tokens or time rather than by the policy."""
+        return any(signals.get(flag) for flag in ("budget_exhausted", "token_budget_exhausted", "deadline"))
+
+    @staticmethod
+    def _degrade(run_info: dict, reason: str) -> dict:
+        """Records a deadline degradation in the telemetry and returns the event announcing it."""
+        degraded = run_info.setdefault("degraded", [])
+        if reason not in degraded:
+            degraded.append(reason)
+        return {"type": "degraded", "reason": reason}
+
+    def _reflection_mode(self, query: str, docs: List[Document], answer: str, llm_calls: int, calls_needed: int, deadline: Deadline = None) -> tuple[str, dict]:
+        """
+        Picks skip / light / full judging for an answer; without a policy every answer gets
+        the full judge. When fewer than `calls_needed` LLM calls are left, or a judge call
+        would overrun the deadline, the judge is skipped.
+        """
+        mode, signals = FULL, {}
+        if self.reflection_policy is not None:
+            mode, signals = self.reflection_policy.decide(query, docs, answer)
+        if self.max_llm_calls - llm_calls < calls_needed:
+            mode = SKIP
+            signals["budget_exhausted"] = True
+        if mode != SKIP and deadline is not None and not deadline.fits(self.latency.estimate("judge")):
+            mode = SKIP
+            signals["deadline"] = True
+        return mode, signals
+
+    async def _asequential(self, query: str, search_query: str, formatted_history: str, stream_tokens: bool, run_info: dict, prefetched: List[Document] = None, deadline: Deadline = None, collections: list = None):
+        """
+        The retry loop: retrieve -> generate -> judge, refining the search query and trying
+        again while the judge rejects the answer. `prefetched` holds results for the raw query,
+        used for the first round when the search query is the raw query. Near the `deadline`
+        the judge is skipped, or refining stops and the best answer so far is returned.
+
+        Yields ("event", dict) progress events, then ("result", (answer, is_satisfactory, search_query, trusted)).
+        """
+        # Every round searches with all query variants seen so far (original query, rewrite,
+        # refinements) in one batch, giving the current search query the most weight.
+        query_variants = [query]
+        deadline = deadline or Deadline()
+        drafts = []  # (top retrieval score, answer) of every attempt
         
         for attempt in range(self.max_retries + 1):
             print(f"--- Attempt {attempt + 1} ---")
             print(f"Search Query: {search_query}")
+            run_info["attempts"] = attempt + 1
             
-            docs = self.retriever.invoke(search_query)
-            context = format_docs(docs)
-            
-            formatted_history = ""
-            if chat_history:
-                for msg in chat_history:
-                    formatted_history += f"{msg['role'].capitalize()}: {msg['content']}\n"
-
-            final_prompt = self.prompt.format(context=context, query=query, chat_history=formatted_history) # Use original user query for answer generation
-            answer_response = self.llm.invoke(final_prompt)
+            if search_query not in query_variants:
+                query_variants.append(search_query)
+            if attempt == 0 and prefetched is not None and query_variants == [query]:
+                docs = prefetched
+            else:
+                docs = await self._aretrieve(query_variants, search_query, collections)
+            yield "event", {"type": "retrieval", "attempt": attempt + 1, "query": search_query, "variants": len(query_variants), "documents": len(docs)}
+            final_prompt, run_info["context"] = self._build_prompt(query, docs, formatted_history)
+            # The draft is streamed to the client as it is generated and judged once complete;
+            # if the judge rejects it a "retracted" event tells the client to discard it.
+            async for kind, value in self._agenerate(final_prompt, stream_tokens):
+                if kind == "token":
+                    yield "event", {"type": "token", "content": value}
+                else:
+                    answer_response = value
+            run_info["llm_calls"] += 1
             current_answer = answer_response.content
+            drafts.append((self._top_score(docs), answer_response))
             
-            # Reflection Step
-            is_satisfactory, feedback = self._get_judge_feedback(query, current_answer)
+            # Reflection Step. A retry costs judge + refine + generate, so once the call
+            # budget cannot cover that the judge is pointless.
+            mode, signals = self._reflection_mode(query, docs, current_answer, run_info["llm_calls"], 3, deadline)
+            run_info["reflection"].append({"mode": mode, **signals})
+            if signals.get("deadline"):
+                yield "event", self._degrade(run_info, "judge_skipped")
+
+            if mode == SKIP:
+                is_satisfactory, feedback = None, ""
+            else:
+                is_satisfactory, feedback = await self._aget_judge_feedback(query, current_answer, light=(mode == LIGHT))
+                run_info["llm_calls"] += 1
+            yield "event", {"type": "judge", "attempt": attempt + 1, "mode": mode, "satisfactory": is_satisfactory, "feedback": feedback}
             
-            if is_satisfactory:
+            if is_satisfactory is None:
+                print(f"Judge: skipped ({signals})")
+                break
+            elif is_satisfactory:
                 print("Judge: SATISFACTORY")
-                final_answer = answer_response
                 break
             else:
                 print(f"Judge: UNSATISFACTORY. Feedback: {feedback}")
-                if attempt < self.max_retries:
+                can_retry = attempt < self.max_retries and self.max_llm_calls - run_info["llm_calls"] >= 2
+                if can_retry and not deadline.fits(self.latency.estimate("refine", "retrieve", "generate")):
+                    # Another round would overrun the deadline: stop with the draft that had
+                    # the most confident retrieval
+                    print("Deadline reached. Returning the best answer so far.")
+                    yield "event", self._degrade(run_info, "refine_stopped")
+                    best = max(drafts, key=lambda draft: draft[0])[1]
+                    if best is not answer_response:
+                        answer_response = best
+                        if stream_tokens:
+                            yield "event", {"type": "retracted", "attempt": attempt + 1}
+                            yield "event", {"type": "token", "content": best.content}
+                    break
+                if can_retry:
+                    if stream_tokens:
+                        yield "event", {"type": "retracted", "attempt": attempt + 1}
                     # Refine Query
                     refine_input = self.refine_prompt.format(query=query, feedback=feedback)
-                    search_query = self.llm.invoke(refine_input).content.strip()
+                    search_query = (await self._allm("refine", refine_input)).content.strip()
+                    run_info["llm_calls"] += 1
+                    record_retry()
+                    yield "event", {"type": "refine", "query": search_query}
                 else:
                     print("Max retries reached. Returning last answer.")
-                    final_answer = answer_response
+                    break
 
-        return final_answer
-    
-    def stream(self, query: str, chat_history: list = None):
-        # For stream, we ideally want to stream the process or just the final answer.
-        # Since the interface usually expects the final answer stream, we will buffer until final answer is found
-        # then stream the final answer.
-        # Note: This effectively defeats the purpose of 'streaming' as in 'immediate tokens', 
-        # but is necessary for validation loops unless we stream status updates.
+        # A judge skipped by the policy means it trusts the answer; one skipped for lack of
+        # budget or time says nothing about it
+        trusted = is_satisfactory is True or (is_satisfactory is None and not self._unjudged(signals))
+        yield "result", (answer_response, is_satisfactory, search_query, trusted)
+
+    async def _aspeculate(self, query: str, search_query: str, formatted_history: str, run_info: dict, prefetched: List[Document] = None, deadline: Deadline = None, collections: list = None):
+        """
+        Speculative alternative to the judge -> refine retry loop: writes query variants up
+        front, then retrieves, generates and judges a candidate for each of them concurrently.
+        The first candidate accepted by the judge wins and the others are cancelled; if none
+        is accepted, one comparative judge call picks the best. Near the `deadline` variants,
+        judges and the comparison are skipped and slow candidates abandoned.
+
+        Yields ("event", dict) progress events, then ("result", (answer, is_satisfactory, search_query, trusted)).
+        """
+        # Call budget: variants + (generate + judge) per candidate + one comparative judge
+        remaining = self.max_llm_calls - run_info["llm_calls"]
+        n_candidates = max(min(self.speculative_candidates, (remaining - 2) // 2), 1)
+        deadline = deadline or Deadline()
+        if n_candidates > 1 and not deadline.fits(self.latency.estimate("variants", "retrieve", "generate")):
+            n_candidates = 1
+            yield "event", self._degrade(run_info, "variants_skipped")
+        variants = [search_query]
+        if n_candidates > 1:
+            variants_input = self.variants_prompt.format(n=n_candidates - 1, query=query, search_query=search_query)
+            response = await self._allm("variants", variants_input)
+            run_info["llm_calls"] += 1
+            variants += parse_variants(response.content, [query, search_query], n_candidates - 1)
+        yield "event", {"type": "variants", "queries": variants}
+
+        budget = TokenBudget(self.speculative_token_budget)
+        semaphore = asyncio.Semaphore(self.speculative_concurrency)
+        judge_overhead = estimate_tokens(self.judge_prompt.template)
+
+        async def run_candidate(index: int, variant: str):
+            async with semaphore:
+                if variant == query and prefetched is not None:
+                    docs = prefetched
+                else:
+                    docs = await self._aretrieve([query, variant] if variant != query else [query], variant, collections)
+                final_prompt, context_stats = self._build_prompt(query, docs, formatted_history)
+                # The first candidate always runs so there is an answer whatever the budget
+                prompt_tokens = estimate_tokens(final_prompt)
+                if index == 0:
+                    budget.charge(prompt_tokens)
+                elif not budget.reserve(prompt_tokens):
+                    return None
+                answer = await self._allm("generate", final_prompt)
+                run_info["llm_calls"] += 1
+                budget.charge(estimate_tokens(answer.content))
+
+                mode, signals = self._reflection_mode(query, docs, answer.content, run_info["llm_calls"], 1, deadline)
+                if mode != SKIP and not budget.reserve(judge_overhead + estimate_tokens(answer.content)):
+                    mode, signals = SKIP, {**signals, "token_budget_exhausted": True}
+                if mode == SKIP:
+                    is_satisfactory, feedback = None, ""
+                else:
+                    is_satisfactory, feedback = await self._aget_judge_feedback(query, answer.content, light=(mode == LIGHT))
+                    run_info["llm_calls"] += 1
+                return {
+                    "index": index, "query": variant, "answer": answer, "mode": mode, "signals": signals,
+                    "satisfactory": is_satisfactory, "feedback": feedback, "top_score": self._top_score(docs), "context": context_stats,
+                }
+
+        tasks = [asyncio.create_task(run_candidate(i, variant)) for i, variant in enumerate(variants)]
+        candidates = []
+        winner = None
+        pending = set(tasks)
+        try:
+            while pending and winner is None:
+                # Once there is an answer, the others are only waited for until the deadline
+                timeout = max(deadline.remaining(), 0) if candidates and deadline.limited else None
+                done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    yield "event", self._degrade(run_info, "candidates_abandoned")
+                    break
+                for task in sorted(done, key=tasks.index):
+                    candidate = task.result()
+                    if candidate is None:
+                        continue
+                    candidates.append(candidate)
+                    run_info["reflection"].append({"mode": candidate["mode"], "candidate": candidate["index"], **candidate["signals"]})
+                    yield "event", {"type": "candidate", "index": candidate["index"], "query": candidate["query"], "mode": candidate["mode"], "satisfactory": candidate["satisfactory"]}
+                    if candidate["signals"].get("deadline"):
+                        yield "event", self._degrade(run_info, "judge_skipped")
+                    # A judge skipped by the policy means it trusts the answer, same as the sequential
+                    # loop; one skipped for lack of budget or time says nothing about the answer.
+                    if candidate["satisfactory"] is not False and not self._unjudged(candidate["signals"]):
+                        winner = candidate
+                        break
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        compared = False
+        if winner is None and len(candidates) == 1:
+            winner = candidates[0]
+        elif winner is None:
+            candidates.sort(key=lambda c: c["index"])
+            compare_input = self.compare_prompt.format(query=query, candidates=format_candidates([c["answer"].content for c in candidates]))
+            in_time = deadline.fits(self.latency.estimate("judge"))
+            if not in_time:
+                yield "event", self._degrade(run_info, "compare_skipped")
+            if in_time and self.max_llm_calls - run_info["llm_calls"] >= 1 and budget.reserve(estimate_tokens(compare_input)):
+                response = (await self._allm("judge", compare_input)).content
+                run_info["llm_calls"] += 1
+                best, is_satisfactory, feedback = parse_comparative_response(response, len(candidates))
+                winner = {**candidates[best], "satisfactory": is_satisfactory, "feedback": feedback}
+                compared = True
+            else:
+                # No budget left for the comparison, fall back to retrieval confidence
+                winner = max(candidates, key=lambda c: c["top_score"])
+
+        run_info["context"] = winner["context"]
+        run_info["speculative"] = {
+            "candidates": len(variants), "completed": len(candidates), "winner": winner["index"],
+            "compared": compared, "tokens": budget.used,
+        }
+        yield "event", {"type": "judge", "attempt": 1, "mode": "comparative" if compared else winner["mode"], "satisfactory": winner["satisfactory"], "feedback": winner["feedback"]}
+        trusted = winner["satisfactory"] is True or (winner["satisfactory"] is None and not compared and not self._unjudged(winner["signals"]))
+        yield "result", (winner["answer"], winner["satisfactory"], winner["query"], trusted)
+
+    async def _apipeline(self, query: str, chat_history: list = None, stream_tokens: bool = False, bypass_cache: bool = False, deadline: float = None,
+                         collections: list = None):
+        """
+        Runs rewrite -> retrieve -> generate -> judge (-> refine) and yields typed events:
+        rewrite, cache_hit, retrieval, token, judge, retracted, refine and finally final.
+        In speculative mode retrieval/retracted/refine are replaced by variants and candidate.
+        The final answer carries cache info in response_metadata["rag"]. `chat_history` is a
+        list of {"role", "content"} turns or a utils.sessions.Session.
+
+        `deadline` is a latency budget in seconds. Steps that no longer fit are dropped (a
+        "degraded" event each, listed in response_metadata["rag"]["degraded"]); the first
+        answer is always generated.
+
+        `collections` scopes retrieval to those collections (namespaces); None searches the
+        retriever's default ones.
+        """
+        # Per-request telemetry, returned in the final answer's response_metadata["rag"]
+        run_info = {"llm_calls": 0, "attempts": 0, "reflection": []}
+        # Callers (e.g. the API) may have started the request trace already
+        trace = current_trace() or start_trace()
+        deadline = Deadline(deadline)
+
+        # Long conversations are cut down to the history token budget for every prompt
+        if self.context_packer is not None:
+            formatted_history, run_info["history"] = self.context_packer.pack_history(chat_history)
+        else:
+            formatted_history = format_history(chat_history)
         
-        final_response = self.invoke(query, chat_history)
-        # We can't easily "stream" a completed AIMessage response in the same way as a generator
-        # So we will just yield the content if it's already done.
-        # Or better, we can re-generate the final known good answer with stream=True if we want that UX,
-        # but that wastes tokens. 
-        # Let's just yield the final content as a single chunk or simulate streaming.
+        # Query rewriting. Only uncached follow-ups cost an LLM call; meanwhile retrieval on
+        # the raw query runs speculatively and is used if the rewrite is late or near-identical.
+        prefetch = None
+        if needs_rewrite(query, chat_history) and (self.rewrite_cache is None or not self.rewrite_cache.contains(query, chat_history)):
+            prefetch = asyncio.create_task(self._aretrieve([query], query, collections))
+        rewrite_timeout = self.rewrite_timeout
+        if deadline.limited:
+            # The rewrite may only use a share of the budget; the answer needs the rest
+            rewrite_timeout = min(rewrite_timeout or math.inf, deadline.remaining() * REWRITE_DEADLINE_SHARE)
+        rewrite_task = asyncio.create_task(
+            aretrieve_query(query, self._scheduled_llm, chat_history, cache=self.rewrite_cache, formatted_history=formatted_history)
+        )
+        try:
+            with span("rewrite"):
+                # Shielded so a late rewrite still completes and lands in the rewrite cache
+                retrieved_query_obj = await asyncio.wait_for(
+                    asyncio.shield(rewrite_task),
+                    timeout=rewrite_timeout if prefetch is not None else None,
+                )
+            rewrite = retrieved_query_obj.response_metadata.get("rewrite", "llm")
+            search_query = retrieved_query_obj.content
+            if rewrite == "llm":
+                record_tokens("rewrite", retrieved_query_obj)
+        except asyncio.CancelledError:
+            rewrite_task.cancel()
+            if prefetch is not None:
+                prefetch.cancel()
+            raise
+        except asyncio.TimeoutError:
+            print(f"Query rewrite timed out after {rewrite_timeout:.2f}s, searching with the raw query.")
+            _finish_in_background(rewrite_task)
+            rewrite, search_query = "timeout", query
+            if rewrite_timeout != self.rewrite_timeout:
+                yield self._degrade(run_info, "rewrite_skipped")
+        if rewrite in ("llm", "timeout"):
+            run_info["llm_calls"] += 1
+        if rewrite == "llm" and is_near_identical(search_query, query):
+            rewrite, search_query = "near_identical", query
+        run_info["rewrite"] = rewrite
+
+        prefetched = None
+        if prefetch is not None:
+            if search_query == query:
+                prefetched = await prefetch
+            else:
+                prefetch.cancel()
+        yield {"type": "rewrite", "query": search_query, "source": rewrite}
+
+        # Semantic cache lookup on the rewritten query. The embedding is cached by the
+        # retriever, so the first retrieval round below does not embed it again.
+        # Cached answers may come from any collection, so scoped requests skip the cache. A
+        # follow-up whose rewrite timed out only has its raw query, which depends on this
+        # conversation, so it must neither match nor create entries other requests can hit.
+        standalone = not (rewrite == "timeout" and needs_rewrite(query, chat_history))
+        use_cache = self.answer_cache is not None and not bypass_cache and not collections and standalone
+        if use_cache:
+            cache_query = search_query
+            cache_vector = await self.retriever.aembed_query(cache_query)
+            match = self.answer_cache.lookup(cache_vector)
+            if match is not None:
+                entry_id, entry, similarity = match
+                print(f"Semantic cache hit ({similarity:.3f}): {entry['query']}")
+                yield {"type": "cache_hit", "similarity": similarity}
+                if stream_tokens:
+                    yield {"type": "token", "content": entry["answer"]}
+                cached_answer = AIMessage(content=entry["answer"])
+                cached_answer.response_metadata["rag"] = {**run_info, "cache": "hit", "cache_entry": entry_id, "timings": trace.summary()}
+                yield {"type": "final", "answer": cached_answer}
+                return
         
-        yield final_response
+        if self.speculative_candidates > 1:
+            run_info["attempts"] = 1
+            async for kind, value in self._aspeculate(query, search_query, formatted_history, run_info, prefetched, deadline, collections):
+                if kind == "event":
+                    yield value
+                else:
+                    final_answer, is_satisfactory, search_query, trusted = value
+            if stream_tokens:
+                yield {"type": "token", "content": final_answer.content}
+        else:
+            async for kind, value in self._asequential(query, search_query, formatted_history, stream_tokens, run_info, prefetched, deadline, collections):
+                if kind == "event":
+                    yield value
+                else:
+                    final_answer, is_satisfactory, search_query, trusted = value
+
+        run_info["cache"] = "bypass"
+        if use_cache:
+            run_info["cache"] = "miss"
+            # Only answers the judge accepted, or the policy trusted without judging, are served
+            # to later requests, and none cut short by a deadline (later requests may have more
+            # time). The entry is labelled with the query its vector was embedded from.
+            if trusted and not run_info.get("degraded"):
+                run_info["cache_entry"] = self.answer_cache.add(cache_vector, cache_query, final_answer.content, preferred=bool(is_satisfactory))
+        run_info["timings"] = trace.summary()
+        final_answer.response_metadata["rag"] = run_info
+
+        yield {"type": "final", "answer": final_answer}
+
+    def _aevents(self, query: str, chat_history: list, stream_tokens: bool, bypass_cache: bool, deadline: float, collections: list = None) -> tuple:
+        """
+        Returns (events, leader). With a coalescer, identical requests in flight share one
+        pipeline run and `leader` tells whether this request started it. Requests only
+        share a run if they asked for the same deadline and collections.
+        """
+        collections = sorted(set(collections)) if collections else None
+        if self.coalescer is None:
+            return self._apipeline(query, chat_history, stream_tokens=stream_tokens, bypass_cache=bypass_cache, deadline=deadline, collections=collections), True
+        key = f"{int(bypass_cache)}\x00{deadline}\x00{collections}\x00{history_digest(chat_history)}\x00{normalize_query(query)}"
+        # A shared run serves all its subscribers, so its LLM calls go at the most urgent
+        # priority among them (a fresh context starts at the lowest)
+        priority = get_priority()
+        def prepare():
+            set_priority(min(priority, get_priority()))
+        # Shared runs always stream tokens, in case a websocket client attaches to them
+        events, leader = self.coalescer.join(
+            key, lambda: self._apipeline(query, chat_history, stream_tokens=True, bypass_cache=bypass_cache, deadline=deadline, collections=collections), prepare
+        )
+        return self._absorb_timings(events), leader
+
+    @staticmethod
+    async def _absorb_timings(events):
+        """Copies a shared run's stage timings into the subscriber's own trace."""
+        async for event in events:
+            if event["type"] == "final":
+                trace = current_trace()
+                if trace is not None:
+                    trace.absorb(event["answer"].response_metadata.get("rag", {}).get("timings", {}))
+            yield event
+
+    @staticmethod
+    def _follower_answer(answer: AIMessage) -> AIMessage:
+        """A copy of the shared answer, marked as coalesced in its telemetry."""
+        rag_info = {**answer.response_metadata.get("rag", {}), "coalesced": True}
+        return answer.model_copy(update={"response_metadata": {**answer.response_metadata, "rag": rag_info}})
+
+    async def ainvoke(self, query: str, chat_history: list = None, bypass_cache: bool = False, deadline: float = None, collections: list = None):
+        events, leader = self._aevents(query, chat_history, False, bypass_cache, deadline, collections)
+        answer = None
+        async for event in events:
+            if event["type"] == "final":
+                answer = event["answer"]
+        return answer if leader else self._follower_answer(answer)
+
+    async def astream(self, query: str, chat_history: list = None, bypass_cache: bool = False, deadline: float = None, collections: list = None):
+        """
+        Streams pipeline events as they happen, including the answer tokens of every draft.
+        """
+        events, leader = self._aevents(query, chat_history, True, bypass_cache, deadline, collections)
+        async for event in events:
+            if event["type"] == "final" and not leader:
+                event = {**event, "answer": self._follower_answer(event["answer"])}
+            yield event
+
+    def invoke(self, query: str, chat_history: list = None, bypass_cache: bool = False, deadline: float = None, collections: list = None):
+        # The pipeline is implemented once, asynchronously. Sync callers (scripts, tests)
+        # drive it on a private event loop.
+        return _run_sync(self.ainvoke(query, chat_history, bypass_cache, deadline, collections))
+    
+    def stream(self, query: str, chat_history: list = None, bypass_cache: bool = False, deadline: float = None, collections: list = None):
+        yield from _iter_sync(self.astream(query, chat_history, bypass_cache, deadline, collections))
+
+
+# Tasks left running past their caller, referenced here so they are not garbage collected
+_background_tasks = set()
 
+def _finish_in_background(task):
+    """Keeps `task` alive until it finishes and swallows its outcome."""
+    def done(t):
+        _background_tasks.discard(t)
+        if not t.cancelled() and t.exception() is not None:
+            print(f"Background task failed: {t.exception()}")
+    _background_tasks.add(task)
+    task.add_done_callback(done)
+
+
+# Background event loop used by the sync entry points of RAGChain
+_sync_loop = None
+_sync_loop_lock = threading.Lock()
+
+def _get_sync_loop():
+    global _sync_loop
+    with _sync_loop_lock:
+        if _sync_loop is None:
+            _sync_loop = asyncio.new_event_loop()
+            threading.Thread(target=_sync_loop.run_forever, name="rag-sync-loop", daemon=True).start()
+    return _sync_loop
+
+def _run_sync(coro):
+    """Runs a coroutine on the background loop and blocks until it finishes."""
+    return asyncio.run_coroutine_threadsafe(coro, _get_sync_loop()).result()
+
+def _iter_sync(agen):
+    """Iterates an async generator from sync code, one item at a time."""
+    while True:
+        try:
+            yield _run_sync(agen.__anext__())
+        except StopAsyncIteration:
+            return
+
+async def aclose_clients():
+    """Closes the async Pinecone clients of the running loop and of the sync entry points' loop."""
+    await _close_async_pinecone()
+    if _sync_loop is not None:
+        await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(_close_async_pinecone(), _sync_loop))
+
+
+rag_chain = RAGChain(
+    None, retriever, custom_rag_prompt, custom_judge_prompt, custom_refine_prompt,
+    answer_cache=answer_cache,
+    reflection_policy=reflection_policy,
+    light_judge_prompt=custom_light_judge_prompt,
+    max_llm_calls=MAX_LLM_CALLS,
+    speculative_candidates=SPECULATIVE_CANDIDATES,
+    speculative_concurrency=SPECULATIVE_CONCURRENCY,
+    speculative_token_budget=SPECULATIVE_TOKEN_BUDGET,
+    variants_prompt=custom_variants_prompt,
+    compare_prompt=custom_comparative_judge_prompt,
+    rewrite_cache=rewrite_cache,
+    rewrite_timeout=REWRITE_TIMEOUT,
+    context_packer=context_packer,
+    coalescer=coalescer,
+    scheduler=llm_scheduler
+)
 
-rag_chain = RAGChain(llm, retriever, custom_rag_prompt, custom_judge_prompt, custom_refine_prompt)
+# Canary query embedded and searched by warmup()
+WARMUP_QUERY = os.getenv("WARMUP_QUERY", "What topics does this course cover?")
 
+async def warmup(canary_query: str = WARMUP_QUERY) -> dict:
+    """
+    Gets ready for the first request: creates the Gemini client and embeds and searches
+    `canary_query`, which opens the Pinecone connection pools for the running loop (or
+    loads the local index). Returns {component: "ok" or the error}.
+    """
+    checks = {
+        # Client creation only; a Gemini call would cost tokens on every start
+        "llm": lambda: asyncio.to_thread(lambda: rag_chain.llm),
+        "retriever": lambda: rag_chain.retriever.ainvoke(canary_query),
+    }
+    status = {}
+    for component, check in checks.items():
+        try:
+            with span(f"warmup_{component}"):
+                await check()
+            status[component] = "ok"
+        except Exception as e:
+            print(f"Warmup of {component} failed: {e}")
+            status[component] = f"error: {e}"
+    return status
 
 '''
 class RAGChain:
     def __init__(
         self,
-        retriever: VectorStoreRetriever,
+        retriever: "VectorStoreRetriever",
         prompt: PromptTemplate
     ):
         self.retriever = retriever
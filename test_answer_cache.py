@@ -0,0 +1,41 @@
+import os
+import asyncio
+
+os.environ.setdefault("GOOGLE_API_KEY", "test")
+os.environ.setdefault("PINECONE_API_KEY", "test")
+
+import pytest
+import rag_chain as rag_chain_module
+from benchmarks import fakes
+from utils.semantic_cache import SemanticCache
+
+@pytest.fixture
+def fake_chain(monkeypatch):
+    # install() assigns module attributes directly; register them so monkeypatch restores them
+    for name in ("pc", "_get_index", "_get_async_pinecone"):
+        monkeypatch.setattr(rag_chain_module, name, getattr(rag_chain_module, name))
+    chain = rag_chain_module.rag_chain
+    monkeypatch.setattr(chain, "llm", chain.llm)
+    fakes.install(rag_chain_module, llm_latency=fakes.Latency(50, sigma=0.01))
+    monkeypatch.setattr(chain, "answer_cache", SemanticCache())
+    monkeypatch.setattr(chain, "rewrite_cache", None)
+    return chain
+
+def test_timed_out_follow_up_does_not_share_cached_answers(fake_chain, monkeypatch):
+    monkeypatch.setattr(fake_chain, "rewrite_timeout", 0.005)
+    query = "and how does it work?"
+    tcp = [{"role": "user", "content": "What is TCP?"}, {"role": "assistant", "content": "A transport protocol."}]
+    photosynthesis = [{"role": "user", "content": "What is photosynthesis?"}, {"role": "assistant", "content": "How plants make sugar."}]
+
+    first = asyncio.run(fake_chain.ainvoke(query, tcp)).response_metadata["rag"]
+    assert first["rewrite"] == "timeout"
+    assert first["cache"] == "bypass"
+    assert fake_chain.answer_cache.stats()["size"] == 0
+
+    other = asyncio.run(fake_chain.ainvoke(query, photosynthesis)).response_metadata["rag"]
+    assert other["cache"] == "bypass"
+
+    # A first-turn query is standalone, so it still uses the cache, but finds nothing from above
+    first_turn = asyncio.run(fake_chain.ainvoke(query)).response_metadata["rag"]
+    assert first_turn["rewrite"] == "skipped"
+    assert first_turn["cache"] == "miss"
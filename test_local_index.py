@@ -0,0 +1,34 @@
+import os
+import pytest
+from utils.local_index import LocalVectorIndex
+
+def test_unknown_namespaces_are_not_created(tmp_path):
+    index = LocalVectorIndex(str(tmp_path))
+    index.upsert([{"id": "a", "values": [1.0, 0.0], "metadata": {"text": "a"}}], namespace="default")
+    index.save()
+
+    assert index.query([1.0, 0.0], top_k=3, namespace="typo-course") == {"matches": []}
+    index.delete(["a"], namespace="typo-course")
+    assert index.list_namespaces() == ["default"]
+    assert os.listdir(tmp_path) == ["default"]
+
+def test_namespace_names_cannot_leave_the_index(tmp_path):
+    index = LocalVectorIndex(str(tmp_path / "index"))
+    for name in ("../../etc", "..", "a/b", ""):
+        with pytest.raises(ValueError):
+            index.query([1.0, 0.0], top_k=3, namespace=name)
+    assert index.list_namespaces() == []
+
+def test_overwrites_replace_rows_before_and_after_save(tmp_path):
+    index = LocalVectorIndex(str(tmp_path), dtype="int8")
+    index.upsert([{"id": "a", "values": [1.0, 0.0]}, {"id": "b", "values": [0.0, 1.0]}])
+    # Overwrites a row that is still buffered, then one already in the saved matrix
+    index.upsert([{"id": "b", "values": [1.0, 1.0], "metadata": {"v": 2}}])
+    index.save()
+    index = LocalVectorIndex(str(tmp_path), dtype="int8")
+    index.upsert([{"id": "a", "values": [0.0, 1.0], "metadata": {"v": 3}}, {"id": "c", "values": [-1.0, 0.0]}])
+
+    matches = index.query([0.0, 1.0], top_k=3)["matches"]
+    assert [m["id"] for m in matches] == ["a", "b", "c"]
+    assert [m["metadata"] for m in matches] == [{"v": 3}, {"v": 2}, {}]
+    assert abs(matches[0]["score"] - 1.0) < 1e-2
@@ -0,0 +1,37 @@
+import random
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+from utils.pdfreader import iter_pdf_chunks
+
+def random_pages(rng):
+    words = ["".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rng.randint(2, 9))) for _ in range(300)]
+    blank_lines = rng.choice([0, 0.05, 0.3])
+    pages = []
+    for page_number in range(1, rng.randint(2, 30)):
+        lines = []
+        for _ in range(rng.randint(0, 40)):
+            lines.append(" ".join(rng.choice(words) for _ in range(rng.randint(1, 14))))
+            if rng.random() < blank_lines:
+                lines.append("")
+        pages.append((page_number, "\n".join(lines)))
+    return pages
+
+def test_chunks_match_whole_document_split():
+    rng = random.Random(0)
+    for _ in range(40):
+        pages = random_pages(rng)
+        chunk_size, chunk_overlap = rng.choice([(1000, 200), (300, 50), (50, 10)])
+        document = "".join(text + "\n" for _, text in pages if text)
+        expected = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap).split_text(document)
+        chunks = list(iter_pdf_chunks(pages, chunk_size, chunk_overlap))
+        assert [text for text, _, _ in chunks] == expected
+
+def test_chunks_report_their_page_range():
+    pages = [(1, "alpha " * 10), (2, ""), (3, "beta " * 10), (4, "gamma " * 30)]
+    chunks = list(iter_pdf_chunks(pages, 200, 40))
+    texts = dict(pages)
+    for text, page_start, page_end in chunks:
+        assert page_start <= page_end
+        assert text.split()[0] in texts[page_start]
+        assert text.split()[-1] in texts[page_end]
+    assert (chunks[0][1], chunks[-1][2]) == (1, 4)
+    assert any(page_start != page_end for _, page_start, page_end in chunks)
@@ -1,9 +1,17 @@
 import os
 import glob
+import time
+import queue
+import argparse
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from dotenv import load_dotenv
 from pinecone import Pinecone
-from pypdf import PdfReader
-from langchain_text_splitters import RecursiveCharacterTextSplitter
+from utils.local_index import LocalVectorIndex
+from utils.bm25 import BM25Index
+from utils.manifest import IngestManifest, file_sha256, chunk_hash
+from utils.pdfreader import iter_pdf_pages, iter_pdf_chunks
 
 # Load environment variables
 load_dotenv(".env")
@@ -19,108 +27,417 @@ pc = Pinecone(api_key=PINECONE_API_KEY)
 INDEX_NAME = "acadgpt"
 MODEL_NAME = "llama-text-embed-v2"
 NAMESPACE = "default"  # As per request
+# Touched after every ingestion run; the API drops its semantic answer cache when it changes
+CORPUS_VERSION_PATH = os.getenv("CORPUS_VERSION_PATH", ".corpus_version")
+# Inverted index for hybrid (BM25 + dense) retrieval, rebuilt on every ingestion run
+BM25_INDEX_DIR = os.getenv("BM25_INDEX_DIR", "bm25_index")
 
-def extract_text_from_pdf(pdf_path):
-    """Extracts text from a single PDF file."""
-    reader = PdfReader(pdf_path)
-    text = ""
-    for page in reader.pages:
-        text += page.extract_text()
-    return text
+# Per-file and per-chunk content hashes of everything ingested, used to skip unchanged work
+MANIFEST_PATH = os.getenv("INGEST_MANIFEST_PATH", "ingest_manifest.json")
+CHUNK_SIZE = int(os.getenv("CHUNK_SIZE", "1000"))
+# The API reads the same variable to drop this overlap when it merges adjacent chunks
+CHUNK_OVERLAP = int(os.getenv("CHUNK_OVERLAP", "200"))
+# Bump when extraction/chunking output changes so the manifest triggers a re-ingest
+EXTRACTOR_VERSION = "pages-v3"
 
-def upload_pdfs(pdf_dir):
-    """Uploads all PDFs in the specified directory to Pinecone."""
+# Pinecone Inference accepts up to 96 passages per embed call; upserts go in batches of ~100
+EMBED_BATCH_SIZE = 96
+UPSERT_BATCH_SIZE = 100
+DELETE_BATCH_SIZE = 1000
+
+# PDFs directly in the data directory go to the NAMESPACE namespace; PDFs in a subdirectory
+# form a collection (e.g. one per course) with a namespace of its own:
+# data/thermo/lecture1.pdf -> namespace "thermo", file key "thermo/lecture1.pdf".
+# Vector ids are "<file key>_chunk_<n>" and chunks carry the file key as their source, so
+# top-level files keep their ids and files of the same name in two collections stay apart.
+def file_key(collection, filename):
+    return filename if collection == NAMESPACE else f"{collection}/{filename}"
+
+def collection_of(key):
+    """Collection (namespace) of a file key or vector id."""
+    return key.split("/", 1)[0] if "/" in key else NAMESPACE
+
+def find_pdfs(pdf_dir):
+    """Returns {file key: path} for the PDFs in `pdf_dir` and its collection subdirectories."""
+    files = {file_key(NAMESPACE, os.path.basename(path)): path for path in glob.glob(os.path.join(pdf_dir, "*.pdf"))}
+    for path in glob.glob(os.path.join(pdf_dir, "*", "*.pdf")):
+        files[file_key(os.path.basename(os.path.dirname(path)), os.path.basename(path))] = path
+    return files
+
+def mark_corpus_updated():
+    """Bumps the corpus version so cached answers built on the old corpus are invalidated."""
+    with open(CORPUS_VERSION_PATH, "a"):
+        os.utime(CORPUS_VERSION_PATH, None)
+
+def embed_passages(texts):
+    """Embeds one batch of chunk texts with Pinecone Inference (llama-text-embed-v2, 1024 dims)."""
+    # Input type 'passage' is usually recommended for storing in DB to be searched against 'query'
+    embeddings = pc.inference.embed(
+        model=MODEL_NAME,
+        inputs=texts,
+        parameters={"input_type": "passage", "truncate": "END"}
+    )
+    return [embedding_obj['values'] for embedding_obj in embeddings]
+
+class StageStats:
+    """Thread-safe item/time counters for one ingestion stage."""
+    def __init__(self, name, unit):
+        self.name = name
+        self.unit = unit
+        self.items = 0
+        self.busy = 0.0
+        self.first_start = None
+        self.last_end = None
+        self._lock = threading.Lock()
+
+    def record(self, items, started, ended):
+        with self._lock:
+            self.items += items
+            self.busy += ended - started
+            self.first_start = started if self.first_start is None else min(self.first_start, started)
+            self.last_end = ended if self.last_end is None else max(self.last_end, ended)
+
+    def report(self):
+        wall = (self.last_end - self.first_start) if self.items else 0.0
+        rate = self.items / wall if wall else 0.0
+        return f"  {self.name:<8} {self.items:>7} {self.unit:<7} in {wall:7.1f}s wall ({rate:8.1f} {self.unit}/s, {self.busy:7.1f}s busy)"
+
+# Set in each extraction worker process by _init_extract_worker
+_chunk_queue = None
+
+def _init_extract_worker(chunk_queue):
+    global _chunk_queue
+    _chunk_queue = chunk_queue
+
+def _put_chunk_batch(pdf_file, start, batch):
+    texts = [text for text, _, _ in batch]
+    pages = [(page_start, page_end) for _, page_start, page_end in batch]
+    # The page range is part of the hash so shifted pages refresh the chunk's metadata
+    hashes = [chunk_hash(f"{page_start}-{page_end}:{text}") for text, page_start, page_end in batch]
+    _chunk_queue.put(("chunks", pdf_file, start, texts, pages, hashes))
+
+def _chunk_file(pdf_file):
+    """
+    Runs in a worker process: extracts and splits one PDF, streaming chunk batches to the
+    parent through the bounded chunk queue (put blocks when the embed stage falls behind).
+    The last message for a file is always ("done", ...) or ("error", ...).
+    """
+    started = time.time()
+    try:
+        # Pages are read lazily and split as they arrive, so a batch can be embedded
+        # while later pages of the same file are still being parsed.
+        chunks = iter_pdf_chunks(iter_pdf_pages(pdf_file), CHUNK_SIZE, CHUNK_OVERLAP)
+        n_chunks = 0
+        batch = []
+        for chunk in chunks:
+            batch.append(chunk)
+            if len(batch) == EMBED_BATCH_SIZE:
+                _put_chunk_batch(pdf_file, n_chunks, batch)
+                n_chunks += len(batch)
+                batch = []
+        if batch:
+            _put_chunk_batch(pdf_file, n_chunks, batch)
+            n_chunks += len(batch)
+        _chunk_queue.put(("done", pdf_file, n_chunks, started, time.time()))
+    except Exception as e:
+        _chunk_queue.put(("error", pdf_file, str(e)))
+
+def _upsert_worker(upsert_queue, index, bm25, bm25_lock, stats, failed_sources):
+    """
+    Drains embedded vectors from upsert_queue and writes them in UPSERT_BATCH_SIZE batches,
+    one batch per collection namespace.
+    """
+    batches = {}  # namespace -> pending vectors
+    def flush(namespace, batch):
+        started = time.time()
+        try:
+            index.upsert(vectors=batch, namespace=namespace)
+        except Exception as e:
+            # Keep draining, otherwise the embed stage would block on a full queue forever
+            print(f"  - Error upserting {len(batch)} vectors: {e}")
+            failed_sources.update(v["metadata"]["source"] for v in batch)
+            return
+        with bm25_lock:
+            bm25.upsert([
+                (v["id"], v["metadata"]["text"], {k: val for k, val in v["metadata"].items() if k != "text"})
+                for v in batch
+            ])
+        stats.record(len(batch), started, time.time())
+
+    while True:
+        vectors = upsert_queue.get()
+        if vectors is None:
+            break
+        for v in vectors:
+            batches.setdefault(v["metadata"]["collection"], []).append(v)
+        for namespace, batch in batches.items():
+            while len(batch) >= UPSERT_BATCH_SIZE:
+                flush(namespace, batch[:UPSERT_BATCH_SIZE])
+                del batch[:UPSERT_BATCH_SIZE]
+    for namespace, batch in batches.items():
+        if batch:
+            flush(namespace, batch)
+
+def _delete_vectors(index, bm25, ids):
+    by_namespace = {}
+    for vector_id in ids:
+        by_namespace.setdefault(collection_of(vector_id), []).append(vector_id)
+    for namespace, namespace_ids in by_namespace.items():
+        for i in range(0, len(namespace_ids), DELETE_BATCH_SIZE):
+            index.delete(ids=namespace_ids[i : i + DELETE_BATCH_SIZE], namespace=namespace)
+    bm25.delete(ids)
+
+def upload_pdfs(pdf_dir, index=None, bm25_dir=BM25_INDEX_DIR, extract_workers=None, embed_workers=4, upsert_workers=2, queue_size=8,
+                manifest_path=MANIFEST_PATH, full=False, dry_run=False):
+    """
+    Uploads all PDFs in the specified directory to Pinecone (or to `index`, e.g. a LocalVectorIndex).
+    PDFs in subdirectories are uploaded to one namespace per subdirectory (see find_pdfs).
+
+    Ingestion is a three-stage pipeline connected by bounded queues, so memory stays flat
+    regardless of PDF size: a process pool extracts and chunks PDFs, a thread pool embeds
+    chunk batches, and upsert threads write the vectors out.
+
+    Runs are incremental: files whose hash matches the manifest are skipped, only chunks
+    whose text changed are re-embedded, and vectors of removed files or of chunks beyond a
+    file's new chunk count are deleted. `full` ignores the manifest; `dry_run` only prints
+    the planned changes.
+    """
     
     # 1. Find all PDF files
-    pdf_files = glob.glob(os.path.join(pdf_dir, "*.pdf"))
-    if not pdf_files:
+    files = find_pdfs(pdf_dir)
+    if not files:
         print(f"No PDF files found in {pdf_dir}")
         return
+    pdf_files = list(files.values())
+    key_of = {path: name for name, path in files.items()}
 
-    print(f"Found {len(pdf_files)} PDF files to process.")
+    print(f"Found {len(pdf_files)} PDF files to process in {len({collection_of(name) for name in files})} collection(s).")
 
-    # 2. Initialize Text Splitter
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=1000,
-        chunk_overlap=200,
-        length_function=len,
-        is_separator_regex=False,
+    # The target names the default namespace; files of other collections are told apart by
+    # their key, so manifests written before collections existed stay valid.
+    if index is None:
+        index = pc.Index(INDEX_NAME)
+        target = f"pinecone:{INDEX_NAME}/{NAMESPACE}"
+    elif isinstance(index, LocalVectorIndex):
+        target = f"local:{os.path.abspath(index.path)}/{NAMESPACE}"
+    else:
+        target = f"{type(index).__name__}/{NAMESPACE}"
+    manifest = IngestManifest(
+        manifest_path, target,
+        {"model": MODEL_NAME, "chunk_size": CHUNK_SIZE, "chunk_overlap": CHUNK_OVERLAP, "extractor": EXTRACTOR_VERSION}
     )
+    if full:
+        manifest.previous_counts = {name: manifest.known_chunk_count(name) for name in manifest.known_files()}
+        manifest.files = {}
 
-    index = pc.Index(INDEX_NAME)
+    # Existing postings are loaded so files ingested in earlier runs stay searchable
+    bm25 = BM25Index(bm25_dir)
+    bm25_lock = threading.Lock()
+    if manifest.files and not len(bm25):
+        print(f"Warning: BM25 index '{bm25_dir}' is empty but the manifest is not; run with --full to rebuild it.")
 
+    # 2. Diff files against the manifest
+    file_hashes = {}
+    changed_files = []
     for pdf_file in pdf_files:
-        print(f"Processing: {pdf_file}")
-        
+        name = key_of[pdf_file]
+        file_hashes[name] = file_sha256(pdf_file)
+        if manifest.is_unchanged(name, file_hashes[name]):
+            continue
+        changed_files.append(pdf_file)
+    removed_files = sorted(manifest.known_files() - set(file_hashes))
+    print(f"{len(pdf_files) - len(changed_files)} unchanged, {len(changed_files)} new or changed, {len(removed_files)} removed.")
+
+    stats = {
+        "extract": StageStats("extract", "chunks"),
+        "embed": StageStats("embed", "chunks"),
+        "upsert": StageStats("upsert", "vectors"),
+    }
+    chunk_queue = multiprocessing.Queue(maxsize=queue_size)
+    upsert_queue = queue.Queue(maxsize=queue_size)
+    # Bounds the number of chunk batches being embedded or waiting for an embed thread
+    embed_slots = threading.BoundedSemaphore(queue_size)
+    failed_files = set()
+    new_chunk_hashes = {}  # file name -> chunk hashes in order
+    plan = []              # (file name, re-embedded, unchanged, orphaned ids)
+    orphan_ids = [
+        f"{name}_chunk_{idx}" for name in removed_files for idx in range(manifest.known_chunk_count(name))
+    ]
+
+    def embed_batch(name, chunk_indices, batch_texts, batch_pages):
         try:
-            # Extract text
-            raw_text = extract_text_from_pdf(pdf_file)
-            
-            # Create chunks
-            chunks = text_splitter.create_documents([raw_text])
-            
-            print(f"  - Split into {len(chunks)} chunks.")
-            
-            # Prepare data for embedding
-            chunk_texts = [chunk.page_content for chunk in chunks]
-            
-            # Generate Embeddings using Pinecone Inference
-            # The model is 'llama-text-embed-v2', dimension should be 1024
-            # We process in batches to avoid hitting API limits if files are large
-            batch_size = 96 # generic safe batch size
-            
-            vectors_to_upsert = []
-            
-            for i in range(0, len(chunk_texts), batch_size):
-                batch_texts = chunk_texts[i : i + batch_size]
-                
-                # Input type 'passage' is usually recommended for storing in DB to be searched against 'query'
-                embeddings = pc.inference.embed(
-                    model=MODEL_NAME,
-                    inputs=batch_texts,
-                    parameters={"input_type": "passage", "truncate": "END"}
-                )
-                
-                # Prepare vectors
-                for j, embedding_obj in enumerate(embeddings):
-                    # We need a unique ID. Using filename + chunk index
-                    # Sanitizing filename for ID might be needed but simple string is usually fine in Pinecone
-                    file_basename = os.path.basename(pdf_file)
-                    chunk_idx = i + j
-                    vector_id = f"{file_basename}_chunk_{chunk_idx}"
-                    
-                    metadata = {
-                        "text": batch_texts[j],
-                        "source": file_basename,
-                        "chunk_index": chunk_idx
-                    }
-                    
-                    vectors_to_upsert.append({
-                        "id": vector_id,
-                        "values": embedding_obj['values'],
-                        "metadata": metadata
-                    })
-            
-            # Upsert efficiently
-            # Pinecone recommends upserting in batches of 100 or so
-            upsert_batch_size = 100
-            for i in range(0, len(vectors_to_upsert), upsert_batch_size):
-                batch = vectors_to_upsert[i : i + upsert_batch_size]
-                index.upsert(vectors=batch, namespace=NAMESPACE)
-                
-            print(f"  - Successfully uploaded {len(vectors_to_upsert)} chunks to Pinecone.")
+            if name in failed_files:
+                return
+            started = time.time()
+            values = embed_passages(batch_texts)
+            stats["embed"].record(len(batch_texts), started, time.time())
 
+            vectors = []
+            for chunk_idx, text, (page_start, page_end), embedding in zip(chunk_indices, batch_texts, batch_pages, values):
+                # We need a unique ID. Using file key + chunk index
+                vectors.append({
+                    "id": f"{name}_chunk_{chunk_idx}",
+                    "values": embedding,
+                    "metadata": {
+                        "text": text,
+                        "source": name,
+                        "collection": collection_of(name),
+                        "chunk_index": chunk_idx,
+                        "page_start": page_start,
+                        "page_end": page_end
+                    }
+                })
+            upsert_queue.put(vectors)
         except Exception as e:
-            print(f"  - Error processing {pdf_file}: {e}")
+            failed_files.add(name)
+            print(f"  - Error embedding {name}: {e}")
+        finally:
+            embed_slots.release()
+
+    upserters = [
+        threading.Thread(target=_upsert_worker, args=(upsert_queue, index, bm25, bm25_lock, stats["upsert"], failed_files), daemon=True)
+        for _ in range(0 if dry_run else upsert_workers)
+    ]
+    for t in upserters:
+        t.start()
+
+    with ProcessPoolExecutor(max_workers=extract_workers, initializer=_init_extract_worker, initargs=(chunk_queue,)) as extract_pool, \
+            ThreadPoolExecutor(max_workers=embed_workers, thread_name_prefix="embed") as embed_pool:
+        extract_futures = [extract_pool.submit(_chunk_file, pdf_file) for pdf_file in changed_files]
+        embedded_counts = {}
+
+        files_left = len(changed_files)
+        while files_left:
+            try:
+                message = chunk_queue.get(timeout=1.0)
+            except queue.Empty:
+                # _chunk_file reports its own errors, so an exception here means a worker died
+                for future in extract_futures:
+                    if future.done() and future.exception() is not None:
+                        raise future.exception()
+                continue
+
+            if message[0] == "chunks":
+                _, pdf_file, start, batch_texts, batch_pages, batch_hashes = message
+                name = key_of[pdf_file]
+                old_hashes = manifest.chunk_hashes(name)
+                new_chunk_hashes.setdefault(name, []).extend(batch_hashes)
+                # Only chunks whose text changed at this position need a new embedding
+                changed = [
+                    j for j, h in enumerate(batch_hashes)
+                    if start + j >= len(old_hashes) or old_hashes[start + j] != h
+                ]
+                embedded_counts[name] = embedded_counts.get(name, 0) + len(changed)
+                if changed and not dry_run:
+                    embed_slots.acquire()
+                    embed_pool.submit(
+                        embed_batch, name, [start + j for j in changed],
+                        [batch_texts[j] for j in changed], [batch_pages[j] for j in changed]
+                    )
+            elif message[0] == "done":
+                _, pdf_file, n_chunks, started, ended = message
+                name = key_of[pdf_file]
+                stats["extract"].record(n_chunks, started, ended)
+                new_chunk_hashes.setdefault(name, [])
+                stale = [f"{name}_chunk_{idx}" for idx in range(n_chunks, manifest.known_chunk_count(name))]
+                orphan_ids.extend(stale)
+                plan.append((name, embedded_counts.get(name, 0), n_chunks - embedded_counts.get(name, 0), len(stale)))
+                print(f"Processed: {pdf_file} ({n_chunks} chunks, {embedded_counts.get(name, 0)} to embed)")
+                files_left -= 1
+            else:
+                _, pdf_file, error = message
+                failed_files.add(key_of[pdf_file])
+                print(f"  - Error processing {pdf_file}: {error}")
+                files_left -= 1
+
+    if dry_run:
+        print("Dry run, planned changes:")
+        for name, embed_count, unchanged, stale in sorted(plan):
+            print(f"  ~ {name}: re-embed {embed_count}, keep {unchanged}, delete {stale}")
+        for name in removed_files:
+            print(f"  - {name}: delete {manifest.known_chunk_count(name)}")
+        print(f"Total: {sum(p[1] for p in plan)} chunks to embed, {len(orphan_ids)} vectors to delete.")
+        return
+
+    # Embed pool has drained; tell the upserters to flush and stop
+    for _ in upserters:
+        upsert_queue.put(None)
+    for t in upserters:
+        t.join()
+
+    # 3. Delete vectors of removed files and of chunks past a file's new end
+    if orphan_ids:
+        started = time.time()
+        _delete_vectors(index, bm25, orphan_ids)
+        print(f"Deleted {len(orphan_ids)} stale vectors in {time.time() - started:.1f}s.")
+
+    print("Stage throughput:")
+    for stage in stats.values():
+        print(stage.report())
+    if failed_files:
+        print(f"{len(failed_files)} file(s) failed: {sorted(failed_files)}")
+
+    # Failed files keep their old manifest entry so the next run retries them
+    for name, hashes in new_chunk_hashes.items():
+        if name not in failed_files:
+            manifest.set_file(name, file_hashes[name], hashes)
+    for name in removed_files:
+        manifest.remove_file(name)
+    manifest.save()
+
+    bm25.save()
+    print(f"Saved BM25 index ({len(bm25)} chunks) to '{bm25_dir}'.")
+
+    if isinstance(index, LocalVectorIndex):
+        index.save()
+        print(f"Saved local index to '{index.path}'.")
+
+    if stats["upsert"].items or orphan_ids:
+        mark_corpus_updated()
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Embed the PDFs in a directory and upload them to the vector index.")
     # You can change this path to wherever your PDFs are located
     # For now, defaulting to a 'data' folder in the current directory
-    TARGET_DIR = "data" 
+    parser.add_argument("target_dir", nargs="?", default="data")
+    parser.add_argument("--backend", choices=["pinecone", "local"], default="pinecone",
+                        help="Write to the hosted Pinecone index or to a local in-process index")
+    parser.add_argument("--local-dir", default=os.getenv("LOCAL_INDEX_DIR", "local_index"))
+    parser.add_argument("--dtype", choices=["float32", "int8"], default="float32",
+                        help="Storage type of the local embedding matrix")
+    parser.add_argument("--ivf-lists", type=int, default=0,
+                        help="Build an IVF partitioning with this many cells for large local corpora")
+    parser.add_argument("--bm25-dir", default=BM25_INDEX_DIR,
+                        help="Where to write the inverted index used by RETRIEVAL_MODE=hybrid")
+    parser.add_argument("--extract-workers", type=int, default=None,
+                        help="Processes used to parse and chunk PDFs (default: CPU count)")
+    parser.add_argument("--embed-workers", type=int, default=4,
+                        help="Concurrent Pinecone Inference embed calls")
+    parser.add_argument("--upsert-workers", type=int, default=2,
+                        help="Concurrent upsert threads")
+    parser.add_argument("--manifest", default=MANIFEST_PATH,
+                        help="Ingestion manifest used to skip unchanged files and chunks")
+    parser.add_argument("--full", action="store_true",
+                        help="Ignore the manifest and re-ingest every file")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="Print which chunks would be embedded and which vectors deleted, then exit")
+    args = parser.parse_args()
+    TARGET_DIR = args.target_dir
     
     # Create data dir if it doesn't exist for convenience
     if not os.path.exists(TARGET_DIR):
         os.makedirs(TARGET_DIR)
         print(f"Created directory '{TARGET_DIR}'. Please place PDF files there and run the script again.")
     else:
-        upload_pdfs(TARGET_DIR)
+        index = None
+        if args.backend == "local":
+            index = LocalVectorIndex(args.local_dir, dtype=args.dtype, ivf_lists=args.ivf_lists)
+        upload_pdfs(
+            TARGET_DIR, index, args.bm25_dir,
+            extract_workers=args.extract_workers,
+            embed_workers=args.embed_workers,
+            upsert_workers=args.upsert_workers,
+            manifest_path=args.manifest,
+            full=args.full,
+            dry_run=args.dry_run,
+        )
@@ -0,0 +1,156 @@
+import os
+import re
+import json
+import numpy as np
+from collections import Counter
+from langchain_core.documents import Document
+from utils.local_index import metadata_filter_mask
+
+# Keeps dotted/hyphenated terms such as "cs-101", "3.2" or "l2-norm" intact
+_TOKEN_RE = re.compile(r"\w+(?:[-.]\w+)*")
+_STOPWORDS = frozenset(
+    "a an and are as at be by for from has have in is it its of on or that the this to was were what which with".split()
+)
+
+def tokenize(text: str) -> list:
+    return [t for t in _TOKEN_RE.findall(text.lower()) if t not in _STOPWORDS]
+
+class BM25Index:
+    """
+    Okapi BM25 over the ingested chunks, built at ingest time and saved to `path`:
+
+        bm25.npz         CSR postings (indptr, doc, tf) + per-doc lengths
+        bm25_docs.json   vocabulary and [id, text, metadata] per doc
+
+    Doc ids are the vector ids, so BM25 hits line up with dense hits when fused.
+    """
+    def __init__(self, path: str = None, k1: float = 1.5, b: float = 0.75):
+        self.path = path
+        self.k1 = k1
+        self.b = b
+        self._docs = {}  # id -> (text, metadata), the source of truth for rebuilds
+        self._built = False
+        self._columns = {}
+        self._masks = {}  # filter -> row mask, for repeated scoped searches
+        if path and os.path.exists(os.path.join(path, "bm25.npz")):
+            self.load()
+
+    def __len__(self):
+        return len(self._docs)
+
+    # -- writes ----------------------------------------------------------
+
+    def upsert(self, records: list):
+        """records: [(id, text, metadata), ...]"""
+        for doc_id, text, metadata in records:
+            self._docs[doc_id] = (text, metadata)
+        self._built = False
+
+    def delete(self, ids: list):
+        for doc_id in ids:
+            self._docs.pop(doc_id, None)
+        self._built = False
+
+    def _build(self):
+        self.ids = list(self._docs)
+        self.metadata = [self._docs[doc_id][1] for doc_id in self.ids]
+        self._columns = {}
+        self._masks = {}
+
+        postings = {}  # term -> ([doc rows], [tf])
+        doc_len = np.zeros(len(self.ids), dtype=np.float32)
+        for row, doc_id in enumerate(self.ids):
+            counts = Counter(tokenize(self._docs[doc_id][0]))
+            doc_len[row] = sum(counts.values())
+            for term, tf in counts.items():
+                rows, tfs = postings.setdefault(term, ([], []))
+                rows.append(row)
+                tfs.append(tf)
+
+        self.vocab = {term: i for i, term in enumerate(postings)}
+        lengths = [len(rows) for rows, _ in postings.values()]
+        self.indptr = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=self.indptr[1:])
+        self.post_docs = np.fromiter((r for rows, _ in postings.values() for r in rows), dtype=np.int32, count=int(self.indptr[-1]))
+        self.post_tfs = np.fromiter((t for _, tfs in postings.values() for t in tfs), dtype=np.float32, count=int(self.indptr[-1]))
+        self.doc_len = doc_len
+        self._built = True
+
+    # -- persistence -----------------------------------------------------
+
+    def save(self, path: str = None):
+        path = path or self.path
+        if not self._built:
+            self._build()
+        os.makedirs(path, exist_ok=True)
+        np.savez(os.path.join(path, "bm25.npz"), indptr=self.indptr, post_docs=self.post_docs, post_tfs=self.post_tfs, doc_len=self.doc_len)
+        with open(os.path.join(path, "bm25_docs.json"), "w") as f:
+            json.dump({
+                "vocab": list(self.vocab),
+                "docs": [[doc_id, self._docs[doc_id][0], self._docs[doc_id][1]] for doc_id in self.ids],
+            }, f)
+
+    def load(self):
+        arrays = np.load(os.path.join(self.path, "bm25.npz"))
+        with open(os.path.join(self.path, "bm25_docs.json")) as f:
+            saved = json.load(f)
+        self._docs = {doc_id: (text, metadata) for doc_id, text, metadata in saved["docs"]}
+        self.ids = [doc[0] for doc in saved["docs"]]
+        self.metadata = [doc[2] for doc in saved["docs"]]
+        self.vocab = {term: i for i, term in enumerate(saved["vocab"])}
+        self.indptr = arrays["indptr"]
+        self.post_docs = arrays["post_docs"]
+        self.post_tfs = arrays["post_tfs"]
+        self.doc_len = arrays["doc_len"]
+        self._columns = {}
+        self._masks = {}
+        self._built = True
+
+    # -- search ----------------------------------------------------------
+
+    def _column(self, key: str) -> np.ndarray:
+        if key not in self._columns:
+            self._columns[key] = np.array([m.get(key) for m in self.metadata], dtype=object)
+        return self._columns[key]
+
+    def scores(self, query: str) -> np.ndarray:
+        """BM25 score of every doc for `query`, accumulated one posting list at a time."""
+        if not self._built:
+            self._build()
+        n_docs = len(self.ids)
+        scores = np.zeros(n_docs, dtype=np.float32)
+        if not n_docs:
+            return scores
+        norm = self.k1 * (1 - self.b + self.b * self.doc_len / self.doc_len.mean())
+        for term, qtf in Counter(tokenize(query)).items():
+            term_id = self.vocab.get(term)
+            if term_id is None:
+                continue
+            start, end = self.indptr[term_id], self.indptr[term_id + 1]
+            docs, tfs = self.post_docs[start:end], self.post_tfs[start:end]
+            df = end - start
+            idf = np.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+            # Each doc appears once per posting list, so plain fancy-index += is safe
+            scores[docs] += qtf * idf * tfs * (self.k1 + 1) / (tfs + norm[docs])
+        return scores
+
+    def search(self, query: str, top_k: int = 5, filter: dict = None) -> list:
+        scores = self.scores(query)
+        if filter:
+            key = json.dumps(filter, sort_keys=True, default=str)
+            if key not in self._masks:
+                self._masks[key] = metadata_filter_mask(self._column, len(self.ids), filter)
+            scores[~self._masks[key]] = 0
+        candidates = np.flatnonzero(scores > 0)
+        if not candidates.size:
+            return []
+        k = min(top_k, candidates.size)
+        top = candidates[np.argpartition(-scores[candidates], k - 1)[:k]]
+        top = top[np.argsort(-scores[top])]
+
+        documents = []
+        for row in top:
+            doc_id = self.ids[row]
+            text, metadata = self._docs[doc_id]
+            documents.append(Document(id=doc_id, page_content=text, metadata={**metadata, "bm25_score": float(scores[row])}))
+        return documents
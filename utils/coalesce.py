@@ -0,0 +1,113 @@
+import asyncio
+import contextvars
+import threading
+import weakref
+from prometheus_client import Counter, Gauge
+
+COALESCED = Counter("rag_coalesced_requests_total", "Requests that started a pipeline run (leader) or joined one in flight (follower)", ["role"])
+IN_FLIGHT = Gauge("rag_pipelines_in_flight", "Shared pipeline runs in flight")
+
+_DONE = object()
+
+class _Failed:
+    def __init__(self, error: BaseException):
+        self.error = error
+
+class _Flight:
+    def __init__(self):
+        self.events = []       # every event so far, replayed to late subscribers
+        self.subscribers = []  # one asyncio.Queue per attached caller
+        self.task = None
+        self.context = contextvars.Context()  # the run's own, not its leader's
+
+class SingleFlight:
+    """
+    Coalesces identical concurrent requests. The first caller for a key starts the run;
+    callers arriving while it is in flight attach to it instead of starting their own.
+    Every subscriber receives all events of the run, including those emitted before it
+    attached. Once a run finishes its key is free again.
+
+    The run is a task of its own, so it survives any one subscriber going away; it is
+    cancelled when the last one does. It runs in a fresh context rather than inheriting
+    the leader's context variables (trace, priority, ...). Runs are kept per event loop.
+    """
+    def __init__(self):
+        self._flights = weakref.WeakKeyDictionary()  # loop -> {key: _Flight}
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.followers = 0
+
+    def join(self, key: str, start, prepare=None) -> tuple:
+        """
+        Returns (events, leader): an async iterator over the events of the run for `key`,
+        and whether this call started it. `start()` returns the run's async event iterator.
+        `prepare()`, if given, is called in the run's context for every caller that joins,
+        e.g. to set context variables from the caller's.
+        """
+        loop = asyncio.get_running_loop()
+        flights = self._flights.setdefault(loop, {})
+        flight = flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = flights[key] = _Flight()
+            flight.task = loop.create_task(self._drive(flights, key, flight, start()), context=flight.context)
+        if prepare is not None:
+            # The run is suspended (we are on its loop), so its context can be entered here
+            flight.context.run(prepare)
+        queue = asyncio.Queue()
+        for event in flight.events:
+            queue.put_nowait(event)
+        flight.subscribers.append(queue)
+
+        with self._lock:
+            if leader:
+                self.leaders += 1
+            else:
+                self.followers += 1
+        COALESCED.labels("leader" if leader else "follower").inc()
+        return self._listen(flight, queue), leader
+
+    async def _drive(self, flights: dict, key: str, flight: _Flight, events):
+        IN_FLIGHT.inc()
+        end = _DONE
+        try:
+            async for event in events:
+                flight.events.append(event)
+                for queue in flight.subscribers:
+                    queue.put_nowait(event)
+        except asyncio.CancelledError as e:
+            end = _Failed(e)
+            raise
+        except Exception as e:
+            end = _Failed(e)
+        finally:
+            # Later identical requests start a new run rather than replaying this one
+            if flights.get(key) is flight:
+                del flights[key]
+            IN_FLIGHT.dec()
+            for queue in flight.subscribers:
+                queue.put_nowait(end)
+            await events.aclose()
+
+    async def _listen(self, flight: _Flight, queue: asyncio.Queue):
+        try:
+            while True:
+                item = await queue.get()
+                if item is _DONE:
+                    return
+                if isinstance(item, _Failed):
+                    raise item.error
+                yield item
+        finally:
+            flight.subscribers.remove(queue)
+            if not flight.subscribers and not flight.task.done():
+                flight.task.cancel()
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.leaders + self.followers
+            return {
+                "leaders": self.leaders,
+                "followers": self.followers,
+                "coalescing_ratio": self.followers / total if total else 0.0,
+            }
@@ -0,0 +1,45 @@
+import math
+import time
+import threading
+
+class Deadline:
+    """Latency budget of one request; `seconds=None` means no deadline."""
+    def __init__(self, seconds: float = None):
+        self.limited = seconds is not None
+        self.expires = time.monotonic() + seconds if self.limited else math.inf
+
+    def remaining(self) -> float:
+        return self.expires - time.monotonic()
+
+    def fits(self, seconds: float) -> bool:
+        """Whether work expected to take `seconds` can finish before the deadline."""
+        return not self.limited or self.remaining() >= seconds
+
+class LatencyEstimator:
+    """
+    Moving average of how long each pipeline step takes (judge, generate, refine,
+    retrieve), used to decide whether another step fits in a request's deadline.
+    Estimates start at `defaults`, are replaced by the first observation and then follow
+    observations with weight `alpha`.
+    """
+    def __init__(self, defaults: dict = None, alpha: float = 0.2):
+        self.alpha = alpha
+        self._seconds = dict(defaults or {"retrieve": 0.5, "generate": 4.0, "judge": 2.0, "refine": 1.5})
+        self._observed = set()
+        self._lock = threading.Lock()
+
+    def observe(self, step: str, seconds: float):
+        with self._lock:
+            if step in self._observed:
+                self._seconds[step] += self.alpha * (seconds - self._seconds[step])
+            else:
+                self._seconds[step] = seconds
+                self._observed.add(step)
+
+    def estimate(self, *steps: str) -> float:
+        with self._lock:
+            return sum(self._seconds.get(step, 0.0) for step in steps)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {step: round(seconds, 3) for step, seconds in self._seconds.items()}
@@ -0,0 +1,93 @@
+import os
+import json
+import time
+import threading
+from collections import OrderedDict
+
+def normalize_query(text: str) -> str:
+    """Casefolds and collapses whitespace so trivially different queries share an entry."""
+    return " ".join(text.casefold().split())
+
+class EmbeddingCache:
+    """
+    Bounded LRU cache of query embeddings keyed by (model, normalized query).
+
+    Entries expire after `ttl` seconds. If `path` is given the cache is loaded from
+    and saved to that JSON file, so it survives restarts.
+    """
+    def __init__(self, max_size: int = 4096, ttl: float = 7 * 24 * 3600, path: str = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (created_at, vector)
+        self._lock = threading.Lock()
+        if path:
+            self.load()
+
+    @staticmethod
+    def _key(text: str, model: str) -> str:
+        return f"{model}\x00{normalize_query(text)}"
+
+    def get(self, text: str, model: str):
+        key = self._key(text, model)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.time() - entry[0] > self.ttl:
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, text: str, model: str, vector: list):
+        key = self._key(text, model)
+        with self._lock:
+            self._entries[key] = (time.time(), list(vector))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r") as f:
+                saved = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Could not load embedding cache from {self.path}: {e}")
+            return
+
+        now = time.time()
+        with self._lock:
+            # Saved oldest first, so re-inserting keeps the LRU order
+            for key, created_at, vector in saved:
+                if now - created_at <= self.ttl:
+                    self._entries[key] = (created_at, vector)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def save(self):
+        if not self.path:
+            return
+        with self._lock:
+            snapshot = [[key, created_at, vector] for key, (created_at, vector) in self._entries.items()]
+        # Write to a temp file first so a crash never leaves a truncated cache behind
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(snapshot, f)
+        os.replace(tmp_path, self.path)
@@ -1,2 +1,128 @@
+from langchain_core.documents import Document
+from typing import List
+from utils.sessions import format_turn, format_history
+from utils.speculative import estimate_tokens
+
+_SEPARATOR = "\n\n"
+# Shortest suffix/prefix match treated as chunk overlap rather than coincidence
+_MIN_OVERLAP = 20
+
 def format_docs(docs):
-    return "\n\n".join(doc.page_content for doc in docs)
\ No newline at end of file
+    return "\n\n".join(doc.page_content for doc in docs)
+
+def _rank_score(doc: Document):
+    """Fused rank score for hybrid results, dense similarity otherwise."""
+    score = doc.metadata.get("rrf_score", doc.metadata.get("score"))
+    return float("-inf") if score is None else score
+
+def _overlap(previous: str, text: str, max_overlap: int) -> int:
+    """Length of the longest prefix of `text` that `previous` ends with (0 if shorter than _MIN_OVERLAP)."""
+    for size in range(min(max_overlap, len(previous), len(text)), _MIN_OVERLAP - 1, -1):
+        if previous.endswith(text[:size]):
+            return size
+    return 0
+
+def merge_adjacent_chunks(docs: List[Document], max_overlap: int = 200) -> List[Document]:
+    """
+    Merges chunks of the same source with consecutive chunk indices into one document,
+    dropping the text the splitter repeats between neighbours (up to `max_overlap`
+    characters, the ingestion chunk_overlap). A merged document keeps the best score of
+    its parts and lists them in metadata["chunks"]. Documents without source/chunk_index
+    are returned unchanged. Runs never span collections.
+    """
+    runs = {}  # (collection, source) -> {chunk_index: doc}
+    merged = []
+    for doc in docs:
+        if "source" in doc.metadata and "chunk_index" in doc.metadata:
+            runs.setdefault((doc.metadata.get("collection"), doc.metadata["source"]), {}).setdefault(doc.metadata["chunk_index"], doc)
+        else:
+            merged.append(doc)
+
+    for chunks in runs.values():
+        current = None
+        for index in sorted(chunks):
+            doc = chunks[index]
+            if current is not None and index == current.metadata["chunks"][-1] + 1:
+                previous = current.page_content.rstrip()
+                text = doc.page_content.lstrip()
+                size = _overlap(previous, text, max_overlap)
+                current.page_content = previous + text[size:] if size else previous + "\n" + text
+                current.metadata["chunks"].append(index)
+                current.metadata["page_end"] = doc.metadata.get("page_end", current.metadata.get("page_end"))
+                for key in ("score", "rrf_score"):
+                    if doc.metadata.get(key) is not None and (current.metadata.get(key) is None or doc.metadata[key] > current.metadata[key]):
+                        current.metadata[key] = doc.metadata[key]
+                continue
+            current = doc.model_copy(deep=True)
+            current.metadata["chunks"] = [index]
+            merged.append(current)
+    return merged
+
+class ContextPacker:
+    """
+    Fits retrieved context and chat history into token budgets (0 = unlimited).
+
+    Context: adjacent chunks are merged (see merge_adjacent_chunks) and added best score
+    first until `context_tokens` is used up; the first one that does not fit is cut off
+    if enough room is left for it to be useful.
+
+    History: the most recent turns are kept verbatim; older turns are shortened to their
+    first `clip_chars` characters while they fit, and the rest are replaced by a one-line
+    note saying how many were left out.
+    """
+    def __init__(self, context_tokens: int = 3000, history_tokens: int = 1000, max_overlap: int = 200,
+                 clip_chars: int = 160, min_fragment_tokens: int = 100):
+        self.context_tokens = context_tokens
+        self.history_tokens = history_tokens
+        self.max_overlap = max_overlap
+        self.clip_chars = clip_chars
+        self.min_fragment_tokens = min_fragment_tokens
+
+    def pack_context(self, docs: List[Document]) -> tuple[str, dict]:
+        """Returns (context, stats)."""
+        merged = sorted(merge_adjacent_chunks(docs, self.max_overlap), key=_rank_score, reverse=True)
+        parts, used, truncated = [], 0, False
+        for doc in merged:
+            tokens = estimate_tokens(doc.page_content)
+            remaining = self.context_tokens - used if self.context_tokens else None
+            if remaining is not None and tokens > remaining:
+                if remaining >= self.min_fragment_tokens:
+                    parts.append(doc.page_content[:(remaining - 2) * 4].rstrip() + " ...")
+                    truncated = True
+                break
+            parts.append(doc.page_content)
+            used += tokens
+        context = _SEPARATOR.join(parts)
+        return context, {
+            "tokens": estimate_tokens(context),
+            "chunks": len(docs),
+            "passages": len(merged),
+            "packed": len(parts),
+            "truncated": truncated,
+        }
+
+    def pack_history(self, chat_history) -> tuple[str, dict]:
+        """Returns (formatted history, stats); `chat_history` may be a list of turns or a Session."""
+        formatted = format_history(chat_history)
+        turns = len(chat_history or [])
+        tokens = estimate_tokens(formatted) if formatted else 0
+        if not self.history_tokens or tokens <= self.history_tokens:
+            return formatted, {"tokens": tokens, "turns": turns, "clipped": 0, "omitted": 0}
+
+        kept, used, clipped = [], 0, 0
+        for i in range(turns - 1, -1, -1):
+            turn = chat_history[i]
+            line = format_turn(turn)
+            if used + estimate_tokens(line) > self.history_tokens:
+                if len(turn["content"]) <= self.clip_chars:
+                    break
+                line = format_turn({"role": turn["role"], "content": turn["content"][:self.clip_chars].rstrip() + " ..."})
+                if used + estimate_tokens(line) > self.history_tokens:
+                    break
+                clipped += 1
+            kept.append(line)
+            used += estimate_tokens(line)
+        omitted = turns - len(kept)
+        note = f"({omitted} earlier turns omitted)\n" if omitted else ""
+        formatted = note + "".join(reversed(kept))
+        return formatted, {"tokens": estimate_tokens(formatted), "turns": len(kept), "clipped": clipped, "omitted": omitted}
@@ -0,0 +1,54 @@
+from langchain_core.documents import Document
+from typing import List
+
+def doc_key(doc: Document):
+    """Stable identity for a retrieved chunk: the vector id if known, else collection + source + chunk index."""
+    if doc.id:
+        return doc.id
+    if "source" in doc.metadata and "chunk_index" in doc.metadata:
+        return (doc.metadata.get("collection"), doc.metadata["source"], doc.metadata["chunk_index"])
+    return doc.page_content
+
+def reciprocal_rank_fusion(result_lists: List[List[Document]], weights: List[float] = None, k: int = 60, top_k: int = None) -> List[Document]:
+    """
+    Merges several ranked result lists with weighted reciprocal rank fusion:
+    score(d) = sum_i weight_i / (k + rank_i(d)).
+
+    Each fused document keeps the best raw 'score' it had in any list and gets an
+    'rrf_score' in its metadata.
+    """
+    if weights is None:
+        weights = [1.0] * len(result_lists)
+
+    fused = {}
+    for results, weight in zip(result_lists, weights):
+        for rank, doc in enumerate(results, start=1):
+            key = doc_key(doc)
+            if key not in fused:
+                fused[key] = [doc.model_copy(deep=True), 0.0]
+            entry = fused[key]
+            entry[1] += weight / (k + rank)
+            best = entry[0].metadata.get("score")
+            if doc.metadata.get("score") is not None and (best is None or doc.metadata["score"] > best):
+                entry[0].metadata["score"] = doc.metadata["score"]
+
+    ranked = sorted(fused.values(), key=lambda entry: entry[1], reverse=True)
+    documents = []
+    for doc, rrf_score in ranked[:top_k]:
+        doc.metadata["rrf_score"] = rrf_score
+        documents.append(doc)
+    return documents
+
+def merge_by_score(result_lists: List[List[Document]], top_k: int = None) -> List[Document]:
+    """
+    Merges results of the same query against different partitions of one index (e.g.
+    namespaces) by raw similarity score, which is comparable across them since they share
+    an embedding model.
+    """
+    merged = {}
+    for results in result_lists:
+        for doc in results:
+            key = doc_key(doc)
+            if key not in merged or doc.metadata.get("score", 0) > merged[key].metadata.get("score", 0):
+                merged[key] = doc
+    return sorted(merged.values(), key=lambda doc: doc.metadata.get("score", float("-inf")), reverse=True)[:top_k]
@@ -0,0 +1,221 @@
+import os
+import time
+import queue
+import random
+import threading
+from bson import ObjectId, json_util
+from pymongo.errors import BulkWriteError
+from prometheus_client import Counter, Gauge
+from utils.tracing import span
+
+WRITTEN = Counter("rag_interactions_written_total", "Interactions inserted into MongoDB")
+DROPPED = Counter("rag_interactions_dropped_total", "Interactions dropped because the queue was full or Mongo kept failing")
+SPILLED = Counter("rag_interactions_spilled_total", "Interactions written to the spill file instead of MongoDB")
+QUEUE_DEPTH = Gauge("rag_interaction_queue_depth", "Interactions waiting to be written")
+
+# Mongo error code for a duplicate _id: the document made it in on an earlier attempt
+_DUPLICATE_KEY = 11000
+
+class InteractionWriter:
+    """
+    Writes interaction documents to MongoDB from a background thread so request handlers
+    never wait on Mongo.
+
+    Documents get their ObjectId in submit(), so the id can be returned to the client
+    right away. The worker drains a bounded queue with insert_many, flushing every
+    `batch_size` documents or `flush_interval` seconds, and retries failed batches with
+    exponential backoff. When the queue is full, or a batch keeps failing, documents are
+    dropped (overflow="drop") or appended to `spill_path` as JSON lines (overflow="spill");
+    spilled documents are replayed the next time the writer starts.
+    """
+    def __init__(self, collection, max_queue: int = 10000, batch_size: int = 100, flush_interval: float = 0.5,
+                 max_retries: int = 5, backoff: float = 0.5, overflow: str = "drop", spill_path: str = "interaction_spill.jsonl"):
+        if overflow not in ("drop", "spill"):
+            raise ValueError(f"Unknown overflow policy: {overflow}")
+        self.collection = collection
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.overflow = overflow
+        self.spill_path = spill_path
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._pending = {}       # _id -> document, until it is confirmed written
+        self._in_flight = set()  # ids of the batch currently being inserted
+        self._late_updates = {}  # _id -> fields set while its batch was in flight
+        self._lock = threading.Lock()
+        self._spill_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    # -- lifecycle -------------------------------------------------------
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="interaction-writer", daemon=True)
+            self._thread.start()
+
+    def flush(self, timeout: float = 10.0) -> bool:
+        """Waits until every submitted document has been written (or given up on)."""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            with self._lock:
+                if not self._pending:
+                    return True
+            time.sleep(0.01)
+        return False
+
+    def close(self, timeout: float = 10.0):
+        """Stops the worker after it has drained the queue."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        with self._lock:
+            left = list(self._pending.values())
+            self._pending.clear()
+        if left:
+            print(f"Interaction writer stopped with {len(left)} unwritten interactions.")
+            self._overflow(left)
+
+    # -- producer side ---------------------------------------------------
+
+    def submit(self, document: dict) -> ObjectId:
+        """Queues `document` for insertion and returns its _id."""
+        document.setdefault("_id", ObjectId())
+        self.start()
+        with self._lock:
+            self._pending[document["_id"]] = document
+        try:
+            self._queue.put_nowait(document)
+        except queue.Full:
+            with self._lock:
+                self._pending.pop(document["_id"], None)
+            self._overflow([document])
+        QUEUE_DEPTH.set(self._queue.qsize())
+        return document["_id"]
+
+    def update(self, document_id: ObjectId, fields: dict):
+        """
+        Applies `fields` to a document that has not been written yet and returns a copy of
+        it, or returns None if the document is not pending (it is already in Mongo, or
+        unknown) and the caller should update Mongo itself.
+        """
+        with self._lock:
+            document = self._pending.get(document_id)
+            if document is None:
+                return None
+            document.update(fields)
+            if document_id in self._in_flight:
+                self._late_updates.setdefault(document_id, {}).update(fields)
+            return dict(document)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"queued": self._queue.qsize(), "pending": len(self._pending)}
+
+    # -- worker side -----------------------------------------------------
+
+    def _run(self):
+        self._replay_spill()
+        while True:
+            batch = self._next_batch()
+            if batch:
+                self._write(batch)
+            elif self._stop.is_set() and self._queue.empty():
+                return
+
+    def _next_batch(self) -> list:
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=min(remaining, 0.1)))
+            except queue.Empty:
+                if self._stop.is_set():
+                    break
+        QUEUE_DEPTH.set(self._queue.qsize())
+        return batch
+
+    def _write(self, batch: list):
+        with self._lock:
+            ids = [document["_id"] for document in batch]
+            self._in_flight.update(ids)
+            documents = [dict(document) for document in batch]
+
+        written = self._insert_with_retry(documents)
+
+        with self._lock:
+            late_updates = {i: self._late_updates.pop(i) for i in ids if i in self._late_updates}
+            self._in_flight.difference_update(ids)
+            for i in ids:
+                self._pending.pop(i, None)
+        if not written:
+            # The originals carry any updates made while the batch was in flight
+            self._overflow(batch)
+            return
+        WRITTEN.inc(len(documents))
+        # Updates (e.g. feedback) that arrived while the batch was being inserted
+        for document_id, fields in late_updates.items():
+            try:
+                self.collection.update_one({"_id": document_id}, {"$set": fields})
+            except Exception as e:
+                print(f"Error applying late interaction update: {e}")
+
+    def _insert_with_retry(self, documents: list) -> bool:
+        for attempt in range(self.max_retries + 1):
+            try:
+                with span("mongo_insert"):
+                    self.collection.insert_many(documents, ordered=False)
+                return True
+            except BulkWriteError as e:
+                # A retried batch may be partly written already; duplicates are fine
+                if all(error.get("code") == _DUPLICATE_KEY for error in e.details.get("writeErrors", [])) and not e.details.get("writeConcernErrors"):
+                    return True
+                error = e
+            except Exception as e:
+                error = e
+            if attempt < self.max_retries:
+                delay = self.backoff * 2 ** attempt * (0.5 + random.random())
+                print(f"Error logging {len(documents)} interactions to Mongo ({error}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+        print(f"Giving up on {len(documents)} interactions after {self.max_retries + 1} attempts: {error}")
+        return False
+
+    # -- overflow --------------------------------------------------------
+
+    def _overflow(self, documents: list):
+        if self.overflow == "drop" or not self.spill_path:
+            DROPPED.inc(len(documents))
+            print(f"Dropped {len(documents)} interactions.")
+            return
+        with self._spill_lock, open(self.spill_path, "a") as f:
+            for document in documents:
+                f.write(json_util.dumps(document) + "\n")
+        SPILLED.inc(len(documents))
+
+    def _replay_spill(self):
+        """Re-inserts documents spilled by an earlier run."""
+        if self.overflow != "spill" or not self.spill_path or not os.path.exists(self.spill_path):
+            return
+        replay_path = f"{self.spill_path}.replay"
+        with self._spill_lock:
+            os.replace(self.spill_path, replay_path)
+        with open(replay_path) as f:
+            documents = [json_util.loads(line) for line in f if line.strip()]
+        replayed = 0
+        for start in range(0, len(documents), self.batch_size):
+            batch = documents[start:start + self.batch_size]
+            if self._insert_with_retry(batch):
+                WRITTEN.inc(len(batch))
+                replayed += len(batch)
+            else:
+                self._overflow(batch)
+        os.remove(replay_path)
+        if replayed:
+            print(f"Replayed {replayed} spilled interactions.")
@@ -0,0 +1,255 @@
+import math
+import time
+import heapq
+import random
+import asyncio
+import itertools
+import threading
+from contextvars import ContextVar
+from prometheus_client import Counter, Gauge, Histogram
+from utils.tracing import span
+
+# Priorities, lower is served first. The API marks websocket traffic interactive and /rag
+# standard; everything else (scripts, sync invoke, batch jobs) is background.
+INTERACTIVE = 0
+STANDARD = 1
+BACKGROUND = 2
+_PRIORITY_NAMES = {INTERACTIVE: "interactive", STANDARD: "standard", BACKGROUND: "background"}
+
+QUEUE_DEPTH = Gauge("rag_llm_queue_depth", "LLM calls waiting for a concurrency slot", ["priority"])
+QUEUE_WAIT = Histogram("rag_llm_queue_wait_seconds", "Time LLM calls waited for a slot and the rate limit", ["priority"],
+                       buckets=(0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60))
+IN_FLIGHT = Gauge("rag_llm_in_flight", "LLM calls in progress")
+RATE_LIMITED = Counter("rag_llm_rate_limited_total", "Rate limit (429) errors returned by the LLM provider")
+REJECTED = Counter("rag_llm_rejected_total", "Requests refused because the LLM queue was full", ["priority"])
+
+_priority = ContextVar("llm_priority", default=BACKGROUND)
+
+def set_priority(priority: int):
+    """Sets the priority of the LLM calls made by the current request."""
+    _priority.set(priority)
+
+def get_priority() -> int:
+    return _priority.get()
+
+class SchedulerFull(Exception):
+    """The LLM queue is full; `retry_after` is a hint in seconds for the client."""
+    def __init__(self, retry_after: float):
+        super().__init__(f"LLM queue is full, retry in {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+def is_rate_limited(error: Exception) -> bool:
+    """True for provider rate limit errors (HTTP 429 / RESOURCE_EXHAUSTED), whatever the client library."""
+    if getattr(error, "code", None) == 429 or getattr(error, "status_code", None) == 429:
+        return True
+    name = type(error).__name__
+    return "RateLimit" in name or "ResourceExhausted" in name or "RESOURCE_EXHAUSTED" in str(error)
+
+class TokenBucket:
+    """
+    `rate` calls per second with bursts of up to `burst`; rate <= 0 means unlimited.
+    take() reserves a token and returns how long the caller has to wait for it.
+    """
+    def __init__(self, rate: float, burst: int = 10):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self) -> float:
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            self._refill()
+            self.tokens -= 1
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def pause(self, seconds: float):
+        """Hands out no tokens for `seconds`, e.g. after the provider said to slow down."""
+        if self.rate <= 0:
+            return
+        with self._lock:
+            self._refill()
+            self.tokens = min(self.tokens, -seconds * self.rate)
+
+class _ScheduledLLM:
+    """`llm` with its ainvoke/astream calls going through a scheduler."""
+    def __init__(self, scheduler, llm):
+        self.scheduler = scheduler
+        self.llm = llm
+
+    async def ainvoke(self, prompt):
+        return await self.scheduler.ainvoke(self.llm, prompt)
+
+    def astream(self, prompt):
+        return self.scheduler.astream(self.llm, prompt)
+
+class LLMScheduler:
+    """
+    Admission control for LLM calls, shared by every request:
+
+    - at most `max_concurrency` calls in flight; callers wait in a priority queue
+      (interactive before standard before background, FIFO within a priority)
+    - a token bucket of `rate_per_minute` calls (0 = no rate limit)
+    - rate limit errors are retried up to `max_retries` times with jittered exponential
+      backoff, and pause the bucket so other callers back off too
+    - with `max_queue` callers already waiting, new calls fail fast with SchedulerFull
+
+    Works across event loops (the API loop and the sync invoke loop): waiters are woken
+    on their own loop.
+    """
+    def __init__(self, max_concurrency: int = 8, rate_per_minute: float = 0, burst: int = 10, max_queue: int = 200,
+                 max_retries: int = 4, backoff: float = 1.0, max_backoff: float = 30.0):
+        self.max_concurrency = max_concurrency
+        self.bucket = TokenBucket(rate_per_minute / 60, burst)
+        self.max_queue = max_queue
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._active = 0
+        self._waiters = []  # heap of [priority, seq, loop, future]
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self._call_seconds = 2.0  # moving average of call duration, for Retry-After
+
+    def bind(self, llm) -> _ScheduledLLM:
+        return _ScheduledLLM(self, llm)
+
+    # -- admission -------------------------------------------------------
+
+    def retry_after(self) -> int:
+        """Seconds until the current queue should have drained, for Retry-After headers."""
+        with self._lock:
+            depth = len(self._waiters)
+        return max(1, math.ceil((depth / max(self.max_concurrency, 1) + 1) * self._call_seconds))
+
+    def check_admission(self, priority: int = None):
+        """Raises SchedulerFull if the queue is full, so requests can be refused before doing any work."""
+        with self._lock:
+            full = len(self._waiters) >= self.max_queue
+        if full:
+            REJECTED.labels(_PRIORITY_NAMES[_priority.get() if priority is None else priority]).inc()
+            raise SchedulerFull(self.retry_after())
+
+    async def _acquire(self, priority: int):
+        """Waits for a concurrency slot, then for a rate limit token."""
+        name = _PRIORITY_NAMES[priority]
+        started = time.perf_counter()
+        with span("llm_queue"):
+            with self._lock:
+                granted = self._active < self.max_concurrency and not self._waiters
+                full = not granted and len(self._waiters) >= self.max_queue
+                if granted:
+                    self._active += 1
+                elif not full:
+                    loop = asyncio.get_running_loop()
+                    future = loop.create_future()
+                    entry = [priority, next(self._seq), loop, future]
+                    heapq.heappush(self._waiters, entry)
+                    QUEUE_DEPTH.labels(name).inc()
+            if full:
+                REJECTED.labels(name).inc()
+                raise SchedulerFull(self.retry_after())
+            if not granted:
+                try:
+                    await future
+                except asyncio.CancelledError:
+                    with self._lock:
+                        queued = entry in self._waiters
+                        if queued:
+                            self._waiters.remove(entry)
+                            heapq.heapify(self._waiters)
+                            QUEUE_DEPTH.labels(name).dec()
+                    # A slot already handed over is released by _grant if the future was
+                    # cancelled first, otherwise it is ours to give back
+                    if not queued and not future.cancelled():
+                        self._release()
+                    raise
+            try:
+                delay = self.bucket.take()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            except BaseException:
+                self._release()
+                raise
+        QUEUE_WAIT.labels(name).observe(time.perf_counter() - started)
+        IN_FLIGHT.inc()
+
+    def _release(self):
+        """Hands the slot to the best waiter, or frees it."""
+        with self._lock:
+            while self._waiters:
+                priority, _, loop, future = heapq.heappop(self._waiters)
+                QUEUE_DEPTH.labels(_PRIORITY_NAMES[priority]).dec()
+                try:
+                    loop.call_soon_threadsafe(self._grant, future)
+                    return
+                except RuntimeError:
+                    # The waiter's loop is closed
+                    continue
+            self._active -= 1
+
+    def _grant(self, future: asyncio.Future):
+        if future.cancelled():
+            self._release()
+        else:
+            future.set_result(None)
+
+    def _done(self, started: float):
+        IN_FLIGHT.dec()
+        self._call_seconds = 0.9 * self._call_seconds + 0.1 * (time.perf_counter() - started)
+        self._release()
+
+    async def _backoff(self, attempt: int, error: Exception):
+        RATE_LIMITED.inc()
+        delay = min(self.max_backoff, self.backoff * 2 ** attempt) * random.uniform(0.5, 1.0)
+        self.bucket.pause(delay)
+        print(f"LLM rate limited ({error}), retrying in {delay:.1f}s")
+        await asyncio.sleep(delay)
+
+    # -- calls -----------------------------------------------------------
+
+    async def ainvoke(self, llm, prompt, priority: int = None):
+        priority = _priority.get() if priority is None else priority
+        for attempt in range(self.max_retries + 1):
+            await self._acquire(priority)
+            started = time.perf_counter()
+            try:
+                return await llm.ainvoke(prompt)
+            except Exception as e:
+                if not is_rate_limited(e) or attempt == self.max_retries:
+                    raise
+                error = e
+            finally:
+                self._done(started)
+            await self._backoff(attempt, error)
+
+    async def astream(self, llm, prompt, priority: int = None):
+        """Streams chunks; a rate limit error is only retried before the first chunk."""
+        priority = _priority.get() if priority is None else priority
+        for attempt in range(self.max_retries + 1):
+            await self._acquire(priority)
+            started = time.perf_counter()
+            streaming = False
+            try:
+                async for chunk in llm.astream(prompt):
+                    streaming = True
+                    yield chunk
+                return
+            except Exception as e:
+                if streaming or not is_rate_limited(e) or attempt == self.max_retries:
+                    raise
+                error = e
+            finally:
+                self._done(started)
+            await self._backoff(attempt, error)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"in_flight": self._active, "queued": len(self._waiters)}
@@ -0,0 +1,335 @@
+import os
+import json
+import threading
+import numpy as np
+
+def metadata_filter_mask(column, size: int, filter: dict) -> np.ndarray:
+    """
+    Boolean row mask for the Pinecone filter subset {field: value} and
+    {field: {"$eq"|"$ne"|"$in"|"$nin": ...}}. `column(key)` returns that metadata field
+    for every row as an object array.
+    """
+    mask = np.ones(size, dtype=bool)
+    for key, condition in filter.items():
+        values_of = column(key)
+        if not isinstance(condition, dict):
+            condition = {"$eq": condition}
+        for op, value in condition.items():
+            if op == "$eq":
+                mask &= values_of == value
+            elif op == "$ne":
+                mask &= values_of != value
+            elif op in ("$in", "$nin"):
+                values = set(value)
+                member = np.fromiter((x in values for x in values_of), dtype=bool, count=size)
+                mask &= member if op == "$in" else ~member
+            else:
+                raise ValueError(f"Unsupported filter operator: {op}")
+    return mask
+
+class _Namespace:
+    """
+    One namespace of a LocalVectorIndex, stored in its own directory:
+
+        meta.json        dim, dtype, row count, IVF settings
+        vectors.f32|i8   row-major embedding matrix (memory-mapped on load)
+        scales.f32       per-row dequantization scales (int8 only)
+        records.json     [[id, metadata], ...] in row order
+        ivf.npz          centroids + row -> list assignment (optional)
+
+    Vectors are unit-normalized on write, so a dot product is the cosine similarity.
+    """
+    def __init__(self, path: str, dtype: str = "float32"):
+        self.path = path
+        self.dtype = dtype
+        self.ids = []
+        self.metadata = []
+        self._row_of = {}
+        self._vectors = None  # float32 array or memmap, or int8 codes
+        self._scales = None
+        self._centroids = None
+        self._lists = None    # list of row-index arrays, one per IVF cell
+        self._columns = {}    # cached metadata columns for filtering
+        self._pending = []    # normalized rows appended since the matrix was last rebuilt
+        self._updates = {}    # matrix row -> normalized row overwritten since then
+        self._dirty = False
+        self.load()
+
+    def __len__(self):
+        return len(self.ids)
+
+    # -- persistence -----------------------------------------------------
+
+    def load(self):
+        meta_path = os.path.join(self.path, "meta.json")
+        if not os.path.exists(meta_path):
+            return
+        with open(meta_path) as f:
+            meta = json.load(f)
+        with open(os.path.join(self.path, "records.json")) as f:
+            records = json.load(f)
+
+        self.dtype = meta["dtype"]
+        self.ids = [record[0] for record in records]
+        self.metadata = [record[1] for record in records]
+        self._row_of = {vector_id: row for row, vector_id in enumerate(self.ids)}
+        shape = (meta["count"], meta["dim"])
+        if meta["count"]:
+            if self.dtype == "int8":
+                self._vectors = np.memmap(os.path.join(self.path, "vectors.i8"), dtype=np.int8, mode="r", shape=shape)
+                self._scales = np.fromfile(os.path.join(self.path, "scales.f32"), dtype=np.float32)
+            else:
+                self._vectors = np.memmap(os.path.join(self.path, "vectors.f32"), dtype=np.float32, mode="r", shape=shape)
+
+        ivf_path = os.path.join(self.path, "ivf.npz")
+        if os.path.exists(ivf_path):
+            ivf = np.load(ivf_path)
+            self._centroids = ivf["centroids"]
+            self._lists = self._group_lists(ivf["assignments"], len(self._centroids))
+
+    def save(self, ivf_lists: int = 0):
+        """
+        Writes the namespace to disk. With ivf_lists > 0 an IVF partitioning is (re)built.
+        """
+        if not self._dirty and (not ivf_lists or self._centroids is not None):
+            return
+        self._materialize()
+        os.makedirs(self.path, exist_ok=True)
+        dim = self._vectors.shape[1] if self._vectors is not None else 0
+
+        if self._vectors is not None:
+            ext = "i8" if self.dtype == "int8" else "f32"
+            tmp_path = os.path.join(self.path, f"vectors.{ext}.tmp")
+            np.ascontiguousarray(self._vectors).tofile(tmp_path)
+            os.replace(tmp_path, os.path.join(self.path, f"vectors.{ext}"))
+            if self.dtype == "int8":
+                self._scales.astype(np.float32).tofile(os.path.join(self.path, "scales.f32"))
+
+        with open(os.path.join(self.path, "records.json"), "w") as f:
+            json.dump([[vector_id, metadata] for vector_id, metadata in zip(self.ids, self.metadata)], f)
+
+        ivf_path = os.path.join(self.path, "ivf.npz")
+        if ivf_lists and len(self.ids) > ivf_lists:
+            centroids, assignments = self._kmeans(ivf_lists)
+            np.savez(ivf_path, centroids=centroids, assignments=assignments)
+            self._centroids = centroids
+            self._lists = self._group_lists(assignments, len(centroids))
+        elif os.path.exists(ivf_path):
+            # Rows changed without a rebuild, the old partitioning no longer matches
+            os.remove(ivf_path)
+            self._centroids = self._lists = None
+
+        with open(os.path.join(self.path, "meta.json"), "w") as f:
+            json.dump({"dim": dim, "dtype": self.dtype, "count": len(self.ids), "ivf_lists": ivf_lists}, f)
+        self._dirty = False
+
+    # -- writes ----------------------------------------------------------
+
+    def _dense(self) -> np.ndarray:
+        """Dequantized float32 copy of all rows."""
+        if self.dtype == "int8":
+            return self._vectors.astype(np.float32) * self._scales[:, None]
+        # Loaded matrices are read-only memmaps; writers need their own copy
+        return np.array(self._vectors, dtype=np.float32)
+
+    def _set_rows(self, matrix: np.ndarray):
+        if self.dtype == "int8":
+            scales = np.abs(matrix).max(axis=1) / 127.0
+            scales[scales == 0] = 1.0
+            self._vectors = np.round(matrix / scales[:, None]).astype(np.int8)
+            self._scales = scales.astype(np.float32)
+        else:
+            self._vectors = matrix.astype(np.float32, copy=False)
+        self._columns = {}
+        self._dirty = True
+
+    def _materialize(self):
+        """Folds rows buffered by upsert into the matrix, with one copy for all of them."""
+        if not self._pending and not self._updates:
+            return
+        count = 0 if self._vectors is None else len(self._vectors)
+        dim = self._vectors.shape[1] if self._vectors is not None else len(self._pending[0])
+        matrix = np.empty((count + len(self._pending), dim), dtype=np.float32)
+        if count:
+            if self.dtype == "int8":
+                np.multiply(self._vectors, self._scales[:, None], out=matrix[:count])
+            else:
+                matrix[:count] = self._vectors
+        if self._updates:
+            rows = np.fromiter(self._updates, dtype=np.int64, count=len(self._updates))
+            matrix[rows] = np.asarray(list(self._updates.values()), dtype=np.float32)
+        if self._pending:
+            matrix[count:] = np.asarray(self._pending, dtype=np.float32)
+        self._pending, self._updates = [], {}
+        self._set_rows(matrix)
+
+    def upsert(self, vectors: list):
+        if not vectors:
+            return
+        new_rows = np.asarray([v["values"] for v in vectors], dtype=np.float32)
+        norms = np.linalg.norm(new_rows, axis=1, keepdims=True)
+        new_rows /= np.where(norms == 0, 1.0, norms)
+
+        # Appends and overwrites are both buffered until the next query or save, so
+        # re-ingesting changed chunks does not copy the matrix once per batch
+        count = 0 if self._vectors is None else len(self._vectors)
+        for v, row in zip(vectors, new_rows):
+            existing = self._row_of.get(v["id"])
+            if existing is None:
+                self._row_of[v["id"]] = len(self.ids)
+                self.ids.append(v["id"])
+                self.metadata.append(v.get("metadata", {}))
+                self._pending.append(row)
+                continue
+            self.metadata[existing] = v.get("metadata", {})
+            if existing >= count:
+                self._pending[existing - count] = row
+            else:
+                self._updates[existing] = row
+        self._columns = {}
+        self._dirty = True
+
+    def delete(self, ids: list):
+        drop = {self._row_of[i] for i in ids if i in self._row_of}
+        if not drop:
+            return
+        self._materialize()
+        keep = np.array([row for row in range(len(self.ids)) if row not in drop], dtype=np.int64)
+        matrix = self._dense()[keep]
+        self.ids = [self.ids[row] for row in keep]
+        self.metadata = [self.metadata[row] for row in keep]
+        self._row_of = {vector_id: row for row, vector_id in enumerate(self.ids)}
+        self._set_rows(matrix)
+
+    # -- search ----------------------------------------------------------
+
+    def _column(self, key: str) -> np.ndarray:
+        if key not in self._columns:
+            self._columns[key] = np.array([m.get(key) for m in self.metadata], dtype=object)
+        return self._columns[key]
+
+    def _filter_mask(self, filter: dict) -> np.ndarray:
+        return metadata_filter_mask(self._column, len(self.ids), filter)
+
+    def _score_rows(self, rows, vector: np.ndarray) -> np.ndarray:
+        block = self._vectors if rows is None else self._vectors[rows]
+        if self.dtype == "int8":
+            scales = self._scales if rows is None else self._scales[rows]
+            return (block @ vector) * scales
+        return block @ vector
+
+    def query(self, vector, top_k: int, filter: dict = None, nprobe: int = 8) -> list:
+        if not self.ids:
+            return []
+        self._materialize()
+        v = np.asarray(vector, dtype=np.float32)
+        v /= np.linalg.norm(v) or 1.0
+
+        rows = None
+        if self._lists is not None:
+            # IVF: only scan the nprobe cells whose centroids are closest to the query
+            probe = np.argsort(-(self._centroids @ v))[:nprobe]
+            rows = np.concatenate([self._lists[c] for c in probe])
+        if filter:
+            mask = self._filter_mask(filter)
+            rows = np.flatnonzero(mask) if rows is None else rows[mask[rows]]
+        if rows is not None and rows.size == 0:
+            return []
+
+        scores = self._score_rows(rows, v)
+        k = min(top_k, scores.shape[0])
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        hits = top if rows is None else rows[top]
+        return [(self.ids[row], float(scores[i]), self.metadata[row]) for i, row in zip(top, hits)]
+
+    # -- IVF -------------------------------------------------------------
+
+    @staticmethod
+    def _group_lists(assignments: np.ndarray, n_lists: int) -> list:
+        order = np.argsort(assignments, kind="stable")
+        bounds = np.searchsorted(assignments[order], np.arange(n_lists + 1))
+        return [order[bounds[c]:bounds[c + 1]] for c in range(n_lists)]
+
+    def _kmeans(self, n_lists: int, iterations: int = 20, seed: int = 0):
+        """Spherical k-means over the (normalized) rows."""
+        data = self._dense()
+        rng = np.random.default_rng(seed)
+        centroids = data[rng.choice(len(data), n_lists, replace=False)].copy()
+        for _ in range(iterations):
+            assignments = np.argmax(data @ centroids.T, axis=1)
+            for c in range(n_lists):
+                members = data[assignments == c]
+                if len(members):
+                    centroid = members.sum(axis=0)
+                    centroids[c] = centroid / (np.linalg.norm(centroid) or 1.0)
+        assignments = np.argmax(data @ centroids.T, axis=1)
+        return centroids.astype(np.float32), assignments.astype(np.int32)
+
+
+class LocalVectorIndex:
+    """
+    In-process replacement for a Pinecone index. Exposes the subset of the Pinecone
+    Index API used by this project (upsert / query / delete by namespace), so it can be
+    passed wherever a pc.Index handle is expected.
+    """
+    def __init__(self, path: str, dtype: str = "float32", ivf_lists: int = 0, nprobe: int = 8):
+        self.path = path
+        self.dtype = dtype
+        self.ivf_lists = ivf_lists
+        self.nprobe = nprobe
+        self._namespaces = {}
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def _check_name(name: str):
+        # Namespace names come from requests and become directory names
+        separators = {"/", os.sep, os.altsep} - {None}
+        if not name or ".." in name or any(sep in name for sep in separators):
+            raise ValueError(f"Invalid namespace name: {name!r}")
+
+    def namespace(self, name: str, create: bool = True) -> _Namespace:
+        """
+        Returns the namespace `name`. Unless `create` is set, a namespace that is neither
+        loaded nor on disk is not created and None is returned.
+        """
+        self._check_name(name)
+        with self._lock:
+            if name not in self._namespaces:
+                path = os.path.join(self.path, name)
+                if not create and not os.path.isdir(path):
+                    return None
+                self._namespaces[name] = _Namespace(path, self.dtype)
+            return self._namespaces[name]
+
+    def list_namespaces(self) -> list:
+        if not os.path.isdir(self.path):
+            return sorted(self._namespaces)
+        on_disk = [d for d in os.listdir(self.path) if os.path.isdir(os.path.join(self.path, d))]
+        return sorted(set(on_disk) | set(self._namespaces))
+
+    def upsert(self, vectors: list, namespace: str = "default"):
+        with self._lock:
+            self.namespace(namespace).upsert(vectors)
+
+    def delete(self, ids: list, namespace: str = "default"):
+        with self._lock:
+            ns = self.namespace(namespace, create=False)
+            if ns is not None:
+                ns.delete(ids)
+
+    def query(self, vector, top_k: int, namespace: str = "default", filter: dict = None, include_values: bool = False, include_metadata: bool = True):
+        # Like Pinecone, an unknown namespace has no matches
+        ns = self.namespace(namespace, create=False)
+        hits = ns.query(vector, top_k, filter=filter, nprobe=self.nprobe) if ns is not None else []
+        return {
+            "matches": [
+                {"id": vector_id, "score": score, "metadata": metadata if include_metadata else {}}
+                for vector_id, score, metadata in hits
+            ]
+        }
+
+    def save(self):
+        with self._lock:
+            for ns in self._namespaces.values():
+                ns.save(ivf_lists=self.ivf_lists)
@@ -0,0 +1,74 @@
+import os
+import json
+import hashlib
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def chunk_hash(text: str) -> str:
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+class IngestManifest:
+    """
+    Records what has been ingested into one index target: per file the content hash and
+    the hash of every chunk, in chunk order.
+
+    The manifest only applies to the `target` (index + namespace) and `config` (embedding
+    model, chunking parameters) it was written for; if either differs, nothing is skipped
+    and everything is re-ingested.
+    """
+    def __init__(self, path: str, target: str, config: dict):
+        self.path = path
+        self.target = target
+        self.config = config
+        self.files = {}  # file name -> {"sha256": ..., "chunks": [chunk hash, ...]}
+        # Chunk counts from a manifest for the same target written with another config:
+        # nothing can be skipped, but their vector ids are still known for cleanup.
+        self.previous_counts = {}
+        self.load()
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        with open(self.path) as f:
+            saved = json.load(f)
+        if saved.get("target") != self.target:
+            print(f"Manifest '{self.path}' was written for a different index, ignoring it.")
+            return
+        if saved.get("config") != self.config:
+            print(f"Manifest '{self.path}' was written with a different embedding/chunking config, re-ingesting everything.")
+            self.previous_counts = {name: len(entry["chunks"]) for name, entry in saved.get("files", {}).items()}
+            return
+        self.files = saved.get("files", {})
+
+    def save(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"target": self.target, "config": self.config, "files": self.files}, f)
+        os.replace(tmp_path, self.path)
+
+    def is_unchanged(self, name: str, sha256: str) -> bool:
+        entry = self.files.get(name)
+        return entry is not None and entry["sha256"] == sha256
+
+    def chunk_hashes(self, name: str) -> list:
+        entry = self.files.get(name)
+        return entry["chunks"] if entry else []
+
+    def known_chunk_count(self, name: str) -> int:
+        """Number of vectors that may exist in the index for `name`."""
+        return max(len(self.chunk_hashes(name)), self.previous_counts.get(name, 0))
+
+    def known_files(self) -> set:
+        return set(self.files) | set(self.previous_counts)
+
+    def set_file(self, name: str, sha256: str, chunk_hashes: list):
+        self.files[name] = {"sha256": sha256, "chunks": chunk_hashes}
+
+    def remove_file(self, name: str):
+        self.files.pop(name, None)
+        self.previous_counts.pop(name, None)
@@ -1,12 +1,187 @@
+import sys
+from bisect import bisect_right
 from pypdf import PdfReader
-reader = PdfReader("yolo_test/input/bottleneck.pdf")
-pages = len(reader.pages)
-pages = reader.pages
 
-page_schema = []
+# A text layer bigger than this on a single page is almost always OCR garbage or a
+# broken content stream; cap it so one page cannot blow up memory.
+MAX_PAGE_CHARS = 200_000
 
-for page in pages:
-    text = page.extract_text()
-    page_schema.append(text)
+def iter_pdf_pages(source, max_page_chars=MAX_PAGE_CHARS):
+    """
+    Yields (page_number, text) one page at a time. `source` is a path or a binary file
+    object. Pages without a text layer (e.g. scanned images) yield an empty string.
+    """
+    reader = PdfReader(source)
+    for page_number, page in enumerate(reader.pages, start=1):
+        text = page.extract_text() or ""
+        yield page_number, text[:max_page_chars]
 
-print(page_schema)
\ No newline at end of file
+# RecursiveCharacterTextSplitter's default separators, strongest first
+SEPARATORS = ["\n\n", "\n", " ", ""]
+
+class _StreamingSplitter:
+    """
+    RecursiveCharacterTextSplitter(chunk_size, chunk_overlap).split_text for text that
+    arrives a bit at a time, with the same chunks. Each chunk is passed to `emit` with its
+    offset in the text as soon as no later text can change it.
+
+    The splitter cuts a text on the strongest separator it contains, which is only known
+    once the text has ended. Until a stronger one shows up, everything so far is the first
+    split of that stronger level, so the state moves into a child for that split
+    (`_promote`). Splits of at least `chunk_size` are split recursively by a child that is
+    fed as they grow; runs of shorter splits are merged exactly like `_merge_splits`.
+    """
+    def __init__(self, separators, chunk_size, chunk_overlap, emit, start=0):
+        self.separators = separators
+        self.level = len(separators) - 1
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.emit = emit
+        self.start = start
+        self.end = start     # offset just past the text received so far
+        self.head = ""       # all text received so far, while it is shorter than a chunk
+        self.split = ""      # the open split, until it is known to need splitting itself
+        self.split_start = start
+        self.child = None    # splitter of the open split once it does
+        self.run = []        # (split, offset) of short splits waiting to be merged
+        self.total = 0
+
+    def feed(self, text):
+        stronger = next((i for i, sep in enumerate(self.separators[:self.level]) if sep and sep in text), None)
+        if stronger is None:
+            self._feed_level(text)
+            return
+        cut = text.index(self.separators[stronger])
+        self.feed(text[:cut])
+        self._promote(stronger)
+        self._feed_level(text[cut:])
+
+    def close(self):
+        self._close_split()
+        self._flush()
+
+    def _promote(self, level):
+        inner = _StreamingSplitter(self.separators[level + 1:], self.chunk_size, self.chunk_overlap, self.emit, self.start)
+        inner.level = self.level - level - 1
+        inner.end, inner.split, inner.split_start, inner.child = self.end, self.split, self.split_start, self.child
+        inner.run, inner.total = self.run, self.total
+        self.level, self.split, self.child, self.run, self.total = level, "", None, [], 0
+        if self.head is None:
+            inner.close()
+        elif self.head:
+            # A short first split has emitted nothing yet and is merged like any other
+            self._add(self.head, self.start)
+
+    def _feed_level(self, text):
+        if self.head is not None:
+            self.head = self.head + text if len(self.head) + len(text) < self.chunk_size else None
+        separator = self.separators[self.level]
+        if not separator:
+            for char in text:
+                self._extend(char)
+                self._close_split()
+            return
+        # Separators are kept at the start of the split that follows them
+        parts = text.split(separator)
+        self._extend(parts[0])
+        for part in parts[1:]:
+            self._close_split()
+            self._extend(separator + part)
+
+    def _extend(self, text):
+        if not self.split and self.child is None:
+            self.split_start = self.end
+        self.end += len(text)
+        if self.child is not None:
+            self.child.feed(text)
+            return
+        self.split += text
+        if len(self.split) >= self.chunk_size and self.level + 1 < len(self.separators):
+            self._flush()
+            self.child = _StreamingSplitter(self.separators[self.level + 1:], self.chunk_size, self.chunk_overlap, self.emit, self.split_start)
+            self.child.feed(self.split)
+            self.split = ""
+
+    def _close_split(self):
+        if self.child is not None:
+            self.child.close()
+            self.child = None
+        elif len(self.split) >= self.chunk_size:
+            self._flush()
+            self.emit(self.split, self.split_start)
+        elif self.split:
+            self._add(self.split, self.split_start)
+        self.split = ""
+
+    def _add(self, split, offset):
+        if self.total + len(split) > self.chunk_size:
+            self._emit_run()
+            while self.total > self.chunk_overlap or (self.total + len(split) > self.chunk_size and self.total > 0):
+                self.total -= len(self.run.pop(0)[0])
+        self.run.append((split, offset))
+        self.total += len(split)
+
+    def _emit_run(self):
+        text = "".join(split for split, _ in self.run)
+        chunk = text.strip()
+        if chunk:
+            self.emit(chunk, self.run[0][1] + len(text) - len(text.lstrip()))
+
+    def _flush(self):
+        self._emit_run()
+        self.run, self.total = [], 0
+
+def _settled(text):
+    """Length of the prefix of `text` whose separator matches cannot change with more text."""
+    longest = max(len(sep) for sep in SEPARATORS)
+    end = max(len(text) - longest + 1, 0)
+    moved = True
+    while moved:
+        moved = False
+        for i in range(max(end - longest + 1, 0), end):
+            if any(sep and text.startswith(sep, i) and i + len(sep) > end for sep in SEPARATORS):
+                end, moved = i, True
+                break
+    return end
+
+def iter_pdf_chunks(pages, chunk_size, chunk_overlap):
+    """
+    Splits pages incrementally and yields (text, page_start, page_end).
+
+    The chunks are exactly those of RecursiveCharacterTextSplitter(chunk_size,
+    chunk_overlap).split_text on the non-empty pages joined with newlines, but only about
+    a chunk of text per separator level is buffered, however long the document is.
+    """
+    emitted = []
+    splitter = _StreamingSplitter(SEPARATORS, chunk_size, chunk_overlap, lambda chunk, offset: emitted.append((chunk, offset)))
+    pending = ""  # text not fed to the splitter yet, because a separator may continue into the next page
+    page_offsets = []  # offset of each page in the document, ascending
+    page_numbers = []
+    length = 0
+
+    def located():
+        for chunk, offset in emitted:
+            end = offset + max(len(chunk) - 1, 0)
+            yield chunk, page_numbers[bisect_right(page_offsets, offset) - 1], page_numbers[bisect_right(page_offsets, end) - 1]
+        emitted.clear()
+
+    for page_number, text in pages:
+        if not text:
+            continue
+        page_offsets.append(length)
+        page_numbers.append(page_number)
+        length += len(text) + 1
+        pending += text + "\n"
+        settled = _settled(pending)
+        splitter.feed(pending[:settled])
+        pending = pending[settled:]
+        yield from located()
+
+    splitter.feed(pending)
+    splitter.close()
+    yield from located()
+
+if __name__ == "__main__":
+    path = sys.argv[1] if len(sys.argv) > 1 else "yolo_test/input/bottleneck.pdf"
+    page_schema = [text for _, text in iter_pdf_pages(path)]
+    print(page_schema)
@@ -56,4 +56,45 @@ def query_refining_prompt():
     
     New Query:
     """
-    return PromptTemplate.from_template(prompt_template)
\ No newline at end of file
+    return PromptTemplate.from_template(prompt_template)
+
+def light_judge_prompt():
+    prompt_template = """
+    Does this answer correctly and fully address the query? Reply with exactly one line:
+    SATISFACTORY
+    or
+    UNSATISFACTORY: <what is missing, in one sentence>
+
+    Query: {query}
+    Answer: {answer}
+    """
+    return PromptTemplate.from_template(prompt_template)
+
+def query_variants_prompt():
+    prompt_template = """
+    You are an expert search query writer for an academic document search engine.
+    Write {n} different search queries that could each retrieve the information needed to answer the question below.
+    Vary the wording, terminology and level of detail. Do not add any preamble or numbering, one query per line.
+
+    Question: {query}
+    Current Search Query: {search_query}
+
+    Queries:
+    """
+    return PromptTemplate.from_template(prompt_template)
+
+def comparative_judge_prompt():
+    prompt_template = """
+    You are a strict evaluator. Several candidate answers were generated for the same query.
+    Pick the candidate that answers the query most correctly and completely.
+
+    Query: {query}
+
+    {candidates}
+
+    Provide your output in the following format:
+    Best: [candidate number]
+    Status: [SATISFACTORY or UNSATISFACTORY, for the best candidate]
+    Feedback: [If UNSATISFACTORY, provide concise feedback on what is missing or wrong. If SATISFACTORY, leave empty.]
+    """
+    return PromptTemplate.from_template(prompt_template)
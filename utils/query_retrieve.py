@@ -1,11 +1,15 @@
+import threading
+from collections import OrderedDict
 from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage
+from utils.embedding_cache import normalize_query
+from utils.sessions import format_history, history_digest
 
-def retrieve_query(query:str, llm:BaseChatModel, chat_history: list = None):
-    
-    formatted_history = ""
-    if chat_history:
-        for msg in chat_history:
-            formatted_history += f"{msg['role'].capitalize()}: {msg['content']}\n"
+def _rewrite_prompt(query:str, chat_history: list = None, formatted_history: str = None):
+
+    # Callers may pass the history already formatted (e.g. packed to a token budget)
+    if formatted_history is None:
+        formatted_history = format_history(chat_history)
 
     # Rewritten Query Prompt
     query_rewrite_prompt = f"""You are a helpful assistant that takes a
@@ -14,7 +18,7 @@ def retrieve_query(query:str, llm:BaseChatModel, chat_history: list = None):
     return the most similar chunks of content based on the rewritten query.
     If the user's query is a follow-up question, use the chat history to provide context.
     Please make no comments, just return the rewritten query.
-    
+
     Chat History:
     {formatted_history}
 
@@ -22,8 +26,107 @@ def retrieve_query(query:str, llm:BaseChatModel, chat_history: list = None):
 
     ai: """
 
+    return query_rewrite_prompt
+
+def needs_rewrite(query: str, chat_history: list = None) -> bool:
+    """
+    Only follow-ups need rewriting: a first-turn question is already standalone and the
+    rewrite barely changes it.
+    """
+    return bool(chat_history)
+
+def is_near_identical(a: str, b: str, threshold: float = 0.8) -> bool:
+    """Token-set Jaccard similarity of the normalized texts is at least `threshold`."""
+    a_terms, b_terms = set(normalize_query(a).split()), set(normalize_query(b).split())
+    if not a_terms or not b_terms:
+        return a_terms == b_terms
+    return len(a_terms & b_terms) / len(a_terms | b_terms) >= threshold
+
+class RewriteCache:
+    """
+    Bounded LRU cache of rewritten queries keyed by (normalized query, chat history digest).
+    """
+    def __init__(self, max_size: int = 1024):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(query: str, chat_history: list = None) -> str:
+        return f"{history_digest(chat_history)}\x00{normalize_query(query)}"
+
+    def get(self, query: str, chat_history: list = None):
+        key = self._key(query, chat_history)
+        with self._lock:
+            rewritten = self._entries.get(key)
+            if rewritten is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return rewritten
+
+    def contains(self, query: str, chat_history: list = None) -> bool:
+        """Membership check that does not touch the LRU order or the hit statistics."""
+        with self._lock:
+            return self._key(query, chat_history) in self._entries
+
+    def put(self, query: str, chat_history: list, rewritten: str):
+        key = self._key(query, chat_history)
+        with self._lock:
+            self._entries[key] = rewritten
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
+
+def _cached_rewrite(query: str, chat_history: list = None, cache: RewriteCache = None):
+    """Returns the rewrite as an AIMessage when no LLM call is needed, otherwise None."""
+    if not needs_rewrite(query, chat_history):
+        return AIMessage(content=query, response_metadata={"rewrite": "skipped"})
+    if cache is not None:
+        rewritten = cache.get(query, chat_history)
+        if rewritten is not None:
+            return AIMessage(content=rewritten, response_metadata={"rewrite": "cached"})
+    return None
+
+def retrieve_query(query:str, llm:BaseChatModel, chat_history: list = None, cache: RewriteCache = None, formatted_history: str = None):
+
+    free = _cached_rewrite(query, chat_history, cache)
+    if free is not None:
+        return free
+
     # Invoke LLM
-    retrieval_query = llm.invoke(query_rewrite_prompt)
+    retrieval_query = llm.invoke(_rewrite_prompt(query, chat_history, formatted_history))
+    retrieval_query.response_metadata["rewrite"] = "llm"
+    if cache is not None:
+        cache.put(query, chat_history, retrieval_query.content)
+
+    # Return Generated Retrieval Query
+    return retrieval_query
+
+async def aretrieve_query(query:str, llm:BaseChatModel, chat_history: list = None, cache: RewriteCache = None, formatted_history: str = None):
+
+    free = _cached_rewrite(query, chat_history, cache)
+    if free is not None:
+        return free
+
+    # Invoke LLM without blocking the event loop
+    retrieval_query = await llm.ainvoke(_rewrite_prompt(query, chat_history, formatted_history))
+    retrieval_query.response_metadata["rewrite"] = "llm"
+    if cache is not None:
+        cache.put(query, chat_history, retrieval_query.content)
 
     # Return Generated Retrieval Query
     return retrieval_query
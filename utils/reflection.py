@@ -0,0 +1,72 @@
+from utils.bm25 import tokenize
+
+SKIP = "skip"
+LIGHT = "light"
+FULL = "full"
+
+# Phrases that signal the model could not answer from the context
+_HEDGES = ("does not contain", "doesn't contain", "not provided", "no information", "i don't know", "i do not know", "unable to")
+
+def parse_judge_response(response: str) -> tuple[bool, str]:
+    """
+    Returns (is_satisfactory, feedback) from a judge reply in either the full
+    "Status: ... / Feedback: ..." format or the light "SATISFACTORY | UNSATISFACTORY: ..." one.
+    """
+    # "UNSATISFACTORY" contains "SATISFACTORY", so it has to be ruled out explicitly
+    is_satisfactory = "SATISFACTORY" in response and "UNSATISFACTORY" not in response
+    feedback = ""
+    if not is_satisfactory:
+        # simple parsing assuming the format is strictly followed or at least contains Feedback:
+        parts = response.split("Feedback:")
+        if len(parts) > 1:
+            feedback = parts[1].strip()
+        elif "UNSATISFACTORY:" in response:
+            feedback = response.split("UNSATISFACTORY:", 1)[1].strip()
+        else:
+            feedback = response # fallback
+    return is_satisfactory, feedback
+
+class ReflectionPolicy:
+    """
+    Decides how much reflection an answer gets, from signals that are free to compute:
+
+    - retrieval confidence: best dense similarity score among the retrieved chunks
+    - context coverage: share of the query's terms that appear in the retrieved context
+    - answer shape: very short answers or answers that hedge always get the full judge
+
+    High confidence skips the judge, medium confidence uses the short judge prompt,
+    everything else gets the full judge.
+    """
+    def __init__(self, high_score: float = 0.6, medium_score: float = 0.45, min_coverage: float = 0.6, min_answer_chars: int = 80):
+        self.high_score = high_score
+        self.medium_score = medium_score
+        self.min_coverage = min_coverage
+        self.min_answer_chars = min_answer_chars
+
+    @staticmethod
+    def coverage(query: str, docs: list) -> float:
+        terms = set(tokenize(query))
+        if not terms:
+            return 0.0
+        context_terms = set()
+        for doc in docs:
+            context_terms.update(tokenize(doc.page_content))
+        return len(terms & context_terms) / len(terms)
+
+    def decide(self, query: str, docs: list, answer: str) -> tuple[str, dict]:
+        """
+        Returns (mode, signals) where mode is "skip", "light" or "full".
+        """
+        scores = [doc.metadata["score"] for doc in docs if doc.metadata.get("score") is not None]
+        top_score = max(scores) if scores else None
+        coverage = self.coverage(query, docs)
+        signals = {"top_score": top_score, "coverage": round(coverage, 3), "answer_chars": len(answer)}
+
+        lowered = answer.lower()
+        if top_score is None or len(answer) < self.min_answer_chars or any(h in lowered for h in _HEDGES):
+            return FULL, signals
+        if top_score >= self.high_score and coverage >= self.min_coverage:
+            return SKIP, signals
+        if top_score >= self.medium_score:
+            return LIGHT, signals
+        return FULL, signals
@@ -0,0 +1,141 @@
+import os
+import time
+import threading
+import numpy as np
+
+class SemanticCache:
+    """
+    In-memory semantic answer cache backed by a NumPy matrix of unit-normalized query
+    embeddings. A lookup returns the cached answer whose query embedding has the highest
+    cosine similarity with the new one, provided it clears `threshold`.
+
+    Entries flagged as preferred (judge said SATISFACTORY, or the user voted "up") win
+    over plain entries on lookup and are evicted last.
+
+    If `version_path` is set, its mtime is treated as the corpus version: when the
+    ingestion script touches it, the whole cache is dropped on the next lookup.
+    """
+    def __init__(self, capacity: int = 1024, threshold: float = 0.95, version_path: str = None):
+        self.capacity = capacity
+        self.threshold = threshold
+        self.version_path = version_path
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._vectors = None  # (capacity, dim) float32, allocated on first add
+        self._used = np.zeros(capacity, dtype=bool)
+        self._preferred = np.zeros(capacity, dtype=bool)
+        self._last_used = np.zeros(capacity, dtype=np.float64)
+        self._entry_ids = np.full(capacity, -1, dtype=np.int64)
+        self._entries = [None] * capacity
+        self._next_id = 0
+        self._corpus_version = self._read_corpus_version()
+
+    def _read_corpus_version(self):
+        if not self.version_path:
+            return None
+        try:
+            return os.stat(self.version_path).st_mtime_ns
+        except OSError:
+            return None
+
+    def _check_corpus_version(self):
+        version = self._read_corpus_version()
+        if version != self._corpus_version:
+            print("Corpus changed, invalidating semantic answer cache.")
+            self._clear()
+            self._corpus_version = version
+
+    def _clear(self):
+        self._used[:] = False
+        self._preferred[:] = False
+        self._entry_ids[:] = -1
+        self._entries = [None] * self.capacity
+
+    def invalidate(self):
+        with self._lock:
+            self._clear()
+
+    @staticmethod
+    def _normalize(vector) -> np.ndarray:
+        v = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(v)
+        return v / norm if norm else v
+
+    def lookup(self, vector):
+        """
+        Returns (entry_id, entry, similarity) for the best match above the threshold, or None.
+        """
+        with self._lock:
+            self._check_corpus_version()
+            if self._vectors is None or not self._used.any():
+                self.misses += 1
+                return None
+
+            sims = self._vectors @ self._normalize(vector)
+            candidates = self._used & (sims >= self.threshold)
+            if not candidates.any():
+                self.misses += 1
+                return None
+
+            # Prefer judged/upvoted answers if any clear the threshold
+            if (candidates & self._preferred).any():
+                candidates &= self._preferred
+            slot = int(np.argmax(np.where(candidates, sims, -np.inf)))
+
+            self._last_used[slot] = time.monotonic()
+            self.hits += 1
+            return int(self._entry_ids[slot]), self._entries[slot], float(sims[slot])
+
+    def add(self, vector, query: str, answer: str, preferred: bool = False) -> int:
+        """
+        Stores an answer and returns its entry id (used later to record feedback).
+        """
+        v = self._normalize(vector)
+        with self._lock:
+            if self._vectors is None:
+                self._vectors = np.zeros((self.capacity, v.shape[0]), dtype=np.float32)
+
+            free = np.flatnonzero(~self._used)
+            if free.size:
+                slot = int(free[0])
+            else:
+                # Evict the least recently used entry, plain entries before preferred ones
+                age_rank = np.where(self._preferred, self._last_used + 1e12, self._last_used)
+                slot = int(np.argmin(age_rank))
+
+            entry_id = self._next_id
+            self._next_id += 1
+            self._vectors[slot] = v
+            self._used[slot] = True
+            self._preferred[slot] = preferred
+            self._last_used[slot] = time.monotonic()
+            self._entry_ids[slot] = entry_id
+            self._entries[slot] = {"query": query, "answer": answer}
+            return entry_id
+
+    def record_feedback(self, entry_id: int, feedback: str):
+        """
+        "up" promotes the entry to preferred, "down" drops it from the cache.
+        """
+        with self._lock:
+            slots = np.flatnonzero(self._used & (self._entry_ids == entry_id))
+            if not slots.size:
+                return
+            slot = int(slots[0])
+            if feedback == "up":
+                self._preferred[slot] = True
+            elif feedback == "down":
+                self._used[slot] = False
+                self._preferred[slot] = False
+                self._entry_ids[slot] = -1
+                self._entries[slot] = None
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": int(self._used.sum()),
+                "preferred": int((self._used & self._preferred).sum()),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
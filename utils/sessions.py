@@ -0,0 +1,131 @@
+import uuid
+import hashlib
+import threading
+from datetime import datetime
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+def format_turn(turn: dict) -> str:
+    return f"{turn['role'].capitalize()}: {turn['content']}\n"
+
+def _chain_digest(digest: str, turn: dict) -> str:
+    return hashlib.sha1(f"{digest}\x00{turn['role']}\x00{turn['content']}".encode("utf-8")).hexdigest()
+
+class Session:
+    """
+    One conversation. Behaves like the plain history list it replaces (iterable of
+    {"role", "content"} turns), and also keeps the prompt-ready formatted history and a
+    digest of the turns, both extended incrementally as turns are appended.
+    """
+    def __init__(self, session_id: str, turns: list = None):
+        self.id = session_id
+        self.turns = []
+        self.formatted = ""
+        self.digest = ""
+        self.lock = threading.Lock()
+        for turn in turns or []:
+            self._add(turn)
+
+    def _add(self, turn: dict):
+        turn = {"role": turn["role"], "content": turn["content"]}
+        self.turns.append(turn)
+        self.formatted += format_turn(turn)
+        self.digest = _chain_digest(self.digest, turn)
+
+    def __iter__(self):
+        return iter(self.turns)
+
+    def __len__(self):
+        return len(self.turns)
+
+    def __getitem__(self, index):
+        return self.turns[index]
+
+def format_history(chat_history) -> str:
+    """Prompt-ready history; sessions return their cached copy."""
+    if isinstance(chat_history, Session):
+        return chat_history.formatted
+    return "".join(format_turn(turn) for turn in chat_history or [])
+
+def history_digest(chat_history) -> str:
+    """Digest of the turns, equal for a Session and a plain list with the same turns."""
+    if isinstance(chat_history, Session):
+        return chat_history.digest
+    digest = ""
+    for turn in chat_history or []:
+        digest = _chain_digest(digest, turn)
+    return digest
+
+class SessionStore:
+    """
+    Conversations stored once, in the `sessions` collection ({_id, turns, created_at,
+    updated_at}), with the most recently used `capacity` sessions kept in memory.
+
+    Appends update the in-memory session immediately; the Mongo writes run on a single
+    background thread, so they stay in order and off the request path.
+    """
+    def __init__(self, collection, capacity: int = 1024):
+        self.collection = collection
+        self.capacity = capacity
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self._writes = ThreadPoolExecutor(max_workers=1, thread_name_prefix="session-writer")
+
+    def _remember(self, session: Session):
+        with self._lock:
+            self._sessions[session.id] = session
+            self._sessions.move_to_end(session.id)
+            while len(self._sessions) > self.capacity:
+                self._sessions.popitem(last=False)
+
+    def get(self, session_id: str):
+        """Returns the session, from memory or Mongo, or None if it does not exist."""
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is not None:
+                self._sessions.move_to_end(session_id)
+                return session
+        document = self.collection.find_one({"_id": session_id}, projection={"turns": 1})
+        if document is None:
+            return None
+        session = Session(session_id, document.get("turns", []))
+        self._remember(session)
+        return session
+
+    def get_or_create(self, session_id: str = None, seed_history: list = None) -> Session:
+        """
+        Returns the session `session_id`, or starts a new one seeded with `seed_history`
+        (the history clients used to post with every request).
+        """
+        if session_id:
+            session = self.get(session_id)
+            if session is not None:
+                return session
+        session = Session(session_id or uuid.uuid4().hex, seed_history)
+        self._remember(session)
+        now = datetime.utcnow()
+        self._submit(self.collection.update_one, {"_id": session.id}, {"$setOnInsert": {"turns": list(session.turns), "created_at": now}, "$set": {"updated_at": now}}, upsert=True)
+        return session
+
+    def append(self, session: Session, turns: list) -> int:
+        """Appends turns to the session and returns the index of the first one."""
+        with session.lock:
+            first = len(session)
+            for turn in turns:
+                session._add(turn)
+            added = session.turns[first:]
+        self._remember(session)
+        self._submit(self.collection.update_one, {"_id": session.id}, {"$push": {"turns": {"$each": added}}, "$set": {"updated_at": datetime.utcnow()}})
+        return first
+
+    def _submit(self, fn, *args, **kwargs):
+        def run():
+            try:
+                fn(*args, **kwargs)
+            except Exception as e:
+                print(f"Error saving session: {e}")
+        self._writes.submit(run)
+
+    def close(self):
+        """Waits for the queued session writes."""
+        self._writes.shutdown(wait=True)
@@ -0,0 +1,55 @@
+import re
+import threading
+from utils.reflection import parse_judge_response
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (~4 characters per token), good enough for budgeting."""
+    return len(text) // 4 + 1
+
+class TokenBudget:
+    """
+    Token allowance shared by the concurrent candidates of one request. `limit=None`
+    means unlimited.
+    """
+    def __init__(self, limit: int = None):
+        self.limit = limit
+        self.used = 0
+        self._lock = threading.Lock()
+
+    def reserve(self, tokens: int) -> bool:
+        with self._lock:
+            if self.limit is not None and self.used + tokens > self.limit:
+                return False
+            self.used += tokens
+            return True
+
+    def charge(self, tokens: int):
+        with self._lock:
+            self.used += tokens
+
+def parse_variants(response: str, exclude: list, n: int) -> list:
+    """Up to `n` distinct query lines from a variants reply, minus the ones in `exclude`."""
+    seen = {q.strip().lower() for q in exclude}
+    variants = []
+    for line in response.splitlines():
+        # Models number or bullet their lists even when asked not to
+        line = re.sub(r"^\s*(?:[-*•]|\d+[.)])\s*", "", line).strip().strip('"')
+        if line and line.lower() not in seen:
+            seen.add(line.lower())
+            variants.append(line)
+    return variants[:n]
+
+def format_candidates(answers: list) -> str:
+    return "\n\n".join(f"Candidate {i}:\n{answer}" for i, answer in enumerate(answers, start=1))
+
+def parse_comparative_response(response: str, n_candidates: int) -> tuple[int, bool, str]:
+    """
+    Returns (best index, is_satisfactory, feedback) from a comparative judge reply.
+    Falls back to the first candidate when the reply names none.
+    """
+    match = re.search(r"Best:\s*\[?(?:Candidate\s*)?(\d+)", response, re.IGNORECASE)
+    best = int(match.group(1)) - 1 if match else 0
+    if not 0 <= best < n_candidates:
+        best = 0
+    is_satisfactory, feedback = parse_judge_response(response)
+    return best, is_satisfactory, feedback
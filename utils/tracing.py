@@ -0,0 +1,95 @@
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from prometheus_client import Counter, Histogram
+from utils.speculative import estimate_tokens
+
+# Buckets cover everything from a cache lookup to a slow multi-attempt generation
+_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+STAGE_SECONDS = Histogram("rag_stage_seconds", "Time spent in one pipeline stage", ["stage"], buckets=_BUCKETS)
+REQUEST_SECONDS = Histogram("rag_request_seconds", "End-to-end request latency", ["endpoint"], buckets=_BUCKETS)
+REQUESTS = Counter("rag_requests_total", "Answered requests", ["endpoint", "cache"])
+CANCELLED = Counter("rag_requests_cancelled_total", "Requests cancelled before they were answered", ["endpoint", "reason"])
+LLM_TOKENS = Counter("rag_llm_tokens_total", "LLM tokens by stage and direction (input/output)", ["stage", "direction"])
+RETRIES = Counter("rag_retries_total", "Judge rejections that triggered another attempt")
+
+_current_trace = ContextVar("rag_trace", default=None)
+
+class Trace:
+    """
+    Per-request timing breakdown: total time per stage, LLM tokens and retries.
+
+    Stage times are summed over every span of that stage, so stages that run
+    concurrently (e.g. speculative candidates) can add up to more than the wall time.
+    """
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = {}  # stage -> [total seconds, span count]
+        self.tokens = {"input": 0, "output": 0}
+        self.retries = 0
+
+    def add_span(self, stage: str, seconds: float):
+        total = self.stages.setdefault(stage, [0.0, 0])
+        total[0] += seconds
+        total[1] += 1
+
+    def absorb(self, summary: dict):
+        """Adds the stage times, tokens and retries of another trace's summary, e.g. of a shared run."""
+        for stage, ms in summary.get("stages_ms", {}).items():
+            self.add_span(stage, ms / 1000)
+        for direction, tokens in summary.get("tokens", {}).items():
+            self.tokens[direction] = self.tokens.get(direction, 0) + tokens
+        self.retries += summary.get("retries", 0)
+
+    def summary(self) -> dict:
+        """Compact breakdown for logs and stored interactions, times in milliseconds."""
+        return {
+            "total_ms": round((time.perf_counter() - self.started) * 1000, 1),
+            "stages_ms": {stage: round(seconds * 1000, 1) for stage, (seconds, _) in self.stages.items()},
+            "tokens": dict(self.tokens),
+            "retries": self.retries,
+        }
+
+def current_trace():
+    return _current_trace.get()
+
+def start_trace() -> Trace:
+    """Starts a trace for the current request; tasks created afterwards share it."""
+    trace = Trace()
+    _current_trace.set(trace)
+    return trace
+
+@contextmanager
+def span(stage: str):
+    """Times the enclosed block as `stage`, in the request trace and in Prometheus."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - started
+        STAGE_SECONDS.labels(stage).observe(seconds)
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.add_span(stage, seconds)
+
+def record_tokens(stage: str, message, prompt: str = None):
+    """
+    Counts the tokens of one LLM call, from the provider's usage metadata when it has
+    any and estimated from the text otherwise.
+    """
+    usage = getattr(message, "usage_metadata", None) or {}
+    input_tokens = usage.get("input_tokens") or (estimate_tokens(prompt) if prompt else 0)
+    output_tokens = usage.get("output_tokens") or estimate_tokens(message.content or "")
+    LLM_TOKENS.labels(stage, "input").inc(input_tokens)
+    LLM_TOKENS.labels(stage, "output").inc(output_tokens)
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.tokens["input"] += input_tokens
+        trace.tokens["output"] += output_tokens
+
+def record_retry():
+    RETRIES.inc()
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.retries += 1